@@ -0,0 +1,285 @@
+"""
+Road quality aggregated over many rides.
+
+Each ride is reduced to the mean attenuated acceleration of its track slices
+(the segments drawn on the map), and each slice's mean is assigned to the
+cells of a grid that the slice's positions pass through. Cells are the tiles
+of the Web Mercator tiling at a fixed zoom level, 19 by default, which are
+about 75 m wide at the equator and 50 m wide at 50 degrees latitude.
+
+RoadQualityStore keeps the number of slice means, their mean and the sum of
+their squared differences from the mean (M2, from which the variance follows)
+per cell in an SQLite database. Merging a ride only touches the cells it
+passes through, using the parallel variant of Welford's algorithm, and each
+ride is identified by a hash of its file, so it is only merged once. Cells
+are indexed by their coordinates, so bounding box queries only read the
+cells inside. Query a database with
+    python src/aggregation.py --bbox <min_lon>,<min_lat>,<max_lon>,<max_lat>
+        <database>
+"""
+import argparse
+import dataclasses as dc
+import datetime
+import json
+import logging
+import pathlib
+import sqlite3
+
+import numpy as np
+
+import tiles
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CELL_ZOOM = 19
+# Cell coordinates and slice indices are combined into int64 keys, which
+# limits the zoom level.
+MAX_CELL_ZOOM = 22
+
+
+@dc.dataclass
+class CellStats:
+    """
+    Statistics of slice means per cell: the cells' x and y at the store's
+    zoom level, the number of slice means, their mean and their sum of squared
+    differences from the mean.
+    """
+    xs: np.ndarray
+    ys: np.ndarray
+    counts: np.ndarray
+    means: np.ndarray
+    m2s: np.ndarray
+
+    def __len__(self):
+        return len(self.xs)
+
+    @property
+    def variances(self):
+        return self.m2s / self.counts
+
+
+def ride_cells(track, conf, cell_zoom=DEFAULT_CELL_ZOOM):
+    """
+    Return the CellStats of a track analyzed with an AnalysisConfig.
+
+    Each slice counts once for every cell its positions pass through. Slices
+    with an infinite mean, caused by saturated acceleration values, are
+    left out. Raises ValueError if the track has too many slices to be
+    combined with cells at cell_zoom in int64 keys.
+    """
+    if not len(track):
+        return _cell_stats([], [], cell_zoom)
+    att_abs_accels = track.rolling_average_absolute_accels(
+        conf.rolling_average_window_duration_seconds, conf.attenuator)
+    slice_means = track.slice_means(
+        conf.track_time_slice_seconds, att_abs_accels)
+    starts, stops = track.slice_bounds(conf.track_time_slice_seconds)
+    if len(starts) > 1 << (63 - 2 * cell_zoom):
+        raise ValueError(
+            f'Too many slices ({len(starts)}) to aggregate into cells at zoom '
+            f'level {cell_zoom}.')
+    slice_idxs = np.repeat(np.arange(len(starts)), stops - starts)
+    xs, ys = lon_lat_to_cells(track.lons, track.lats, cell_zoom)
+    cells = (xs << cell_zoom) | ys
+    # Each pair of slice and cell once.
+    pairs = np.unique((slice_idxs << (2 * cell_zoom)) | cells)
+    pair_slice_idxs = pairs >> (2 * cell_zoom)
+    pair_cells = pairs & ((1 << (2 * cell_zoom)) - 1)
+    values = slice_means[pair_slice_idxs]
+    finite = np.isfinite(values)
+    return _cell_stats(pair_cells[finite], values[finite], cell_zoom)
+
+
+def _cell_stats(cells, values, cell_zoom):
+    cells, idxs = np.unique(
+        np.asarray(cells, dtype=np.int64), return_inverse=True)
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(idxs, minlength=len(cells))
+    means = np.bincount(idxs, values, minlength=len(cells)) / np.maximum(
+        counts, 1)
+    m2s = np.bincount(idxs, (values - means[idxs])**2, minlength=len(cells))
+    return CellStats(
+        cells >> cell_zoom, cells & ((1 << cell_zoom) - 1), counts, means,
+        m2s)
+
+
+def lon_lat_to_cells(lons, lats, zoom):
+    """
+    Return arrays of x and y of the cells (tiles at zoom) containing points.
+
+    The vectorized tiles.lon_lat_to_tile().
+    """
+    num_cells = 1 << zoom
+    lats = np.clip(lats, -tiles.MAX_LATITUDE, tiles.MAX_LATITUDE)
+    xs = (np.asarray(lons) + 180) / 360 * num_cells
+    ys = (1 - np.arcsinh(np.tan(np.radians(lats))) / np.pi) / 2 * num_cells
+    return (
+        np.clip(xs.astype(np.int64), 0, num_cells - 1),
+        np.clip(ys.astype(np.int64), 0, num_cells - 1))
+
+
+def cell_bounds(xs, ys, zoom):
+    """
+    Return arrays of min_lon, min_lat, max_lon and max_lat of cells.
+    """
+    num_cells = 1 << zoom
+
+    def lons(xs):
+        return np.asarray(xs) / num_cells * 360 - 180
+
+    def lats(ys):
+        return np.degrees(np.arctan(np.sinh(
+            np.pi * (1 - 2 * np.asarray(ys) / num_cells))))
+
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    return lons(xs), lats(ys + 1), lons(xs + 1), lats(ys)
+
+
+class RoadQualityStore:
+    """
+    Per-cell statistics of many rides in an SQLite database.
+
+    The cell zoom level is fixed when the database is created, to cell_zoom
+    or DEFAULT_CELL_ZOOM if it's None. Opening an existing database with a
+    different cell_zoom raises ValueError. With read_only, the database must
+    exist (FileNotFoundError is raised otherwise) and is never written.
+    """
+
+    def __init__(self, path, cell_zoom=None, read_only=False):
+        if cell_zoom is not None and not 0 <= cell_zoom <= MAX_CELL_ZOOM:
+            raise ValueError(
+                f'Invalid cell zoom level {cell_zoom}, must be at most '
+                f'{MAX_CELL_ZOOM}.')
+        self.path = pathlib.Path(path)
+        if read_only:
+            if not self.path.exists():
+                raise FileNotFoundError(
+                    f'No road quality database at {self.path}.')
+            self._connection = sqlite3.connect(
+                f'{self.path.resolve().as_uri()}?mode=ro', uri=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._create_schema(
+                DEFAULT_CELL_ZOOM if cell_zoom is None else cell_zoom)
+        self.cell_zoom = int(self._metadata('cell_zoom'))
+        if cell_zoom is not None and self.cell_zoom != cell_zoom:
+            raise ValueError(
+                f'{self.path} uses cells at zoom level {self.cell_zoom}, not '
+                f'{cell_zoom}.')
+
+    def contains(self, ride_key):
+        """Return whether the ride with ride_key was merged."""
+        return self._connection.execute(
+            'SELECT 1 FROM rides WHERE ride_key = ?',
+            (ride_key,)).fetchone() is not None
+
+    def merge(self, ride_key, name, cells):
+        """
+        Merge the CellStats of a ride into the store.
+
+        ride_key identifies the ride, name describes it. Rides that were
+        already merged are skipped. Returns whether the ride was merged.
+        """
+        with self._connection:
+            inserted = self._connection.execute(
+                'INSERT OR IGNORE INTO rides (ride_key, name, merged, '
+                'num_cells) VALUES (?, ?, ?, ?)',
+                (ride_key, name,
+                 datetime.datetime.now().isoformat(timespec='seconds'),
+                 len(cells))).rowcount
+            if not inserted:
+                return False
+            # All expressions refer to the values before the update.
+            self._connection.executemany('''
+                INSERT INTO cells (x, y, count, mean, m2)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (x, y) DO UPDATE SET
+                    count = count + excluded.count,
+                    mean = mean + (excluded.mean - mean) * excluded.count
+                        / (count + excluded.count),
+                    m2 = m2 + excluded.m2 + (excluded.mean - mean)
+                        * (excluded.mean - mean) * count * excluded.count
+                        / (count + excluded.count)
+            ''', zip(
+                cells.xs.tolist(), cells.ys.tolist(), cells.counts.tolist(),
+                cells.means.tolist(), cells.m2s.tolist()))
+        return True
+
+    def query(self, bounds):
+        """
+        Return the CellStats of the cells intersecting bounds (min_lon,
+        min_lat, max_lon, max_lat).
+        """
+        xs, ys = tiles.tile_range(*bounds, self.cell_zoom)
+        rows = self._connection.execute(
+            'SELECT x, y, count, mean, m2 FROM cells '
+            'WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ?',
+            (xs.start, xs.stop - 1, ys.start, ys.stop - 1)).fetchall()
+        columns = zip(*rows) if rows else ([],) * 5
+        dtypes = (np.int64, np.int64, np.int64, np.float64, np.float64)
+        return CellStats(*(
+            np.array(column, dtype=dtype)
+            for column, dtype in zip(columns, dtypes)))
+
+    @property
+    def num_rides(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM rides').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def _metadata(self, name):
+        return self._connection.execute(
+            'SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()[0]
+
+    def _create_schema(self, cell_zoom):
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS rides (
+                    ride_key TEXT PRIMARY KEY, name TEXT, merged TEXT,
+                    num_cells INTEGER);
+                CREATE TABLE IF NOT EXISTS cells (
+                    x INTEGER, y INTEGER, count INTEGER, mean REAL, m2 REAL,
+                    PRIMARY KEY (x, y)) WITHOUT ROWID;
+            ''')
+            self._connection.execute(
+                'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                ('cell_zoom', str(cell_zoom)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the road quality of the cells within a bounding '
+        'box as lines of JSON.')
+    parser.add_argument('database', type=pathlib.Path)
+    parser.add_argument(
+        '--bbox', type=tiles.parse_bounds, required=True,
+        help='Bounding box as <min_lon>,<min_lat>,<max_lon>,<max_lat>.')
+    parser.add_argument(
+        '--min-count', type=int, default=1,
+        help='Only print cells with at least this many slice means.')
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f'No database at {args.database}.')
+    store = RoadQualityStore(args.database, read_only=True)
+    cells = store.query(args.bbox)
+    store.close()
+    columns = zip(
+        *cell_bounds(cells.xs, cells.ys, store.cell_zoom), cells.counts,
+        cells.means, cells.variances)
+    for min_lon, min_lat, max_lon, max_lat, count, mean, variance in columns:
+        if count < args.min_count:
+            continue
+        print(json.dumps({
+            'min_lon': min_lon, 'min_lat': min_lat, 'max_lon': max_lon,
+            'max_lat': max_lat, 'count': int(count),
+            'mean_attenuated_accel_millig': mean, 'variance': variance}))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,1046 @@
+"""
+Parsing and analysis of rides recorded by the BumpVisualizer.
+
+This module doesn't depend on the plotting stack, so it can be imported
+quickly by anything that only needs numbers.
+"""
+import collections.abc
+import dataclasses as dc
+import datetime
+import functools as ft
+import itertools as it
+import logging
+import math
+import re
+
+import numpy as np
+
+import decimation
+import fit_decoder
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+NANOSECONDS_PER_SECOND = 1_000_000_000
+DECODERS = ('native', 'fitparse')
+# Maximum number of map tiles (256x256 pixels each) drawn for one map.
+DEFAULT_MAX_TILES = 256
+
+
+def capped_fraction(value, reference):
+    # Works element-wise if value is an array.
+    return np.minimum(1, value / reference)
+
+
+def datetime_to_ns(dt):
+    """
+    Return a datetime as int nanoseconds since the epoch. Naive datetimes
+    are taken to be in UTC, aware ones are converted.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def ns_to_datetime(ns):
+    """Return nanoseconds since the epoch as a naive datetime in UTC."""
+    return EPOCH + datetime.timedelta(microseconds=int(ns) // 1000)
+
+
+class ParseError(Exception):
+    pass
+
+
+class IncompletePositionData(Exception):
+    """
+    Raised during message parsing if necessary position data is missing.
+
+    This can be the case simply if the message is not a position message, or if
+    some fields are missing (usually if there is no GNSS fix yet, but the
+    acceleration sensor already works).
+    """
+
+
+@dc.dataclass
+class Position:
+    ts: datetime.datetime
+    lon: float
+    lat: float
+    speed: float
+    accel: float
+    analysis_data: dict = dc.field(default_factory=dict)
+
+    @property
+    def speed_kph(self):
+        return self._mps_to_kph(self.speed)
+
+    @staticmethod
+    def _mps_to_kph(mps):
+        return mps * 3.6
+
+
+class PositionsView(collections.abc.Sequence):
+    """
+    A read-only sequence of Positions backed by the columns of a Track.
+
+    Positions are only created when they are accessed. This exists for
+    compatibility with code that wants to look at individual positions, bulk
+    processing should use the Track's arrays directly.
+    """
+
+    def __init__(self, track):
+        self._track = track
+
+    def __len__(self):
+        return len(self._track)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._track.position(i)
+                    for i in range(*idx.indices(len(self)))]
+        return self._track.position(idx)
+
+
+class Attenuator:
+    """
+    A method of attenuating acceleration by speed.
+
+    Attenuates a given acceleration a at speed v to a_att as
+
+    a_att = (1 - (min(1, v / v_cap) ** exp) * att) * a
+
+    Here, v_cap is the speed at which maximum attenuation is applied (i.e.
+    higher speeds get the same attenuation), exp is an exponent for nonlinear
+    attenuation, and att is the amount of attenuation to apply at the speed
+    cap.
+
+    Specify an attenation as a string with format
+    "(linear|quadratic|cubic),<v_cap>,<att>", where the first argument
+    determines exp.
+    """
+    _exponents = (('linear', 1), ('quadratic', 2), ('cubic', 3))
+
+    def __init__(self, spec):
+        try:
+            args = spec.split(',')
+            self.exponent = next(e for m, e in self._exponents if m == args[0])
+            self.speed_cap = float(args[1])
+            assert self.speed_cap > 0
+            self.attenuation_at_max_speed = float(args[2])
+            assert 0 <= self.attenuation_at_max_speed <= 1
+        except Exception as e:
+            raise ValueError(
+                'Invalid attenation specification, must be '
+                '"(linear|quadratic|cubic),<v_cap>,<att>" with 0 <= att <= 1 '
+                'and v_cap > 0.') from e
+
+    @property
+    def spec(self):
+        method = next(m for m, e in self._exponents if e == self.exponent)
+        return f'{method},{self.speed_cap},{self.attenuation_at_max_speed}'
+
+    def __eq__(self, other):
+        return self.spec == other.spec
+
+    def __hash__(self):
+        return hash(self.spec)
+
+    def attenuate(self, accel, speed_kph):
+        return self.factors(speed_kph) * accel
+
+    def factors(self, speeds_kph):
+        """
+        Return the factors by which accelerations at speeds_kph are scaled.
+
+        Works element-wise on arrays, so the factors for a whole track can be
+        computed once and applied with a single multiplication.
+        """
+        return self.factors_for_all([self], speeds_kph)[0].reshape(
+            np.shape(speeds_kph))
+
+    @classmethod
+    def factors_for_all(cls, attenuators, speeds_kph):
+        """
+        Return the attenuation factors of several attenuators at once.
+
+        The result has one row per attenuator, each containing the factors
+        for all of speeds_kph.
+        """
+        speeds_kph = np.atleast_1d(np.asarray(speeds_kph, dtype=np.float64))
+        speed_caps, exponents, attenuations = (
+            np.array(values, dtype=np.float64)[:, np.newaxis]
+            for values in zip(*(
+                (a.speed_cap, a.exponent, a.attenuation_at_max_speed)
+                for a in attenuators)))
+        fractions_of_max_speed = capped_fraction(speeds_kph, speed_caps)
+        return 1 - (fractions_of_max_speed**exponents) * attenuations
+
+
+@dc.dataclass
+class MessageColumns:
+    """
+    Per-message data of a track as decoded from a .fit file.
+
+    Timestamps are int64 nanoseconds since the epoch, positions are in
+    semicircles and speeds in m/s. accels contains the parsed (but not yet
+    adjusted) acceleration values of each message as a row.
+    messages_start_ts and messages_end_ts are the first and last timestamps of
+    any message in the file.
+    """
+    message_tss: np.ndarray
+    lons_semicircles: np.ndarray
+    lats_semicircles: np.ndarray
+    speeds: np.ndarray
+    accels: np.ndarray
+    messages_start_ts: datetime.datetime = None
+    messages_end_ts: datetime.datetime = None
+
+    def to_arrays(self):
+        messages_ts_range = [
+            ts for ts in (self.messages_start_ts, self.messages_end_ts)
+            if ts is not None]
+        return {
+            'message_tss': self.message_tss,
+            'lons_semicircles': self.lons_semicircles,
+            'lats_semicircles': self.lats_semicircles,
+            'speeds': self.speeds,
+            'accels': self.accels,
+            'messages_ts_range': np.array(
+                [datetime_to_ns(ts) for ts in messages_ts_range],
+                dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        messages_ts_range = [
+            ns_to_datetime(ns) for ns in arrays['messages_ts_range']]
+        if len(messages_ts_range) not in (0, 2):
+            raise ValueError('Invalid message timestamp range.')
+        return cls(
+            arrays['message_tss'], arrays['lons_semicircles'],
+            arrays['lats_semicircles'], arrays['speeds'], arrays['accels'],
+            *messages_ts_range)
+
+
+class Track:
+    """
+    A recorded ride as a set of columns with one entry per acceleration sample.
+
+    Timestamps are stored as int64 nanoseconds since the epoch (UTC),
+    longitude, latitude and speed (in m/s) as float64 and accelerations (in
+    millig, adjusted to make idling zero) as float32. The arrays returned by
+    the properties are read-only views of these columns.
+
+    Positions are ordered by strictly increasing timestamps, which rolling
+    averages and slices rely on. Tracks are created with positions in
+    timestamp order, and of positions with equal timestamps, e.g. records
+    written twice in smart recording mode, only the first is kept.
+    """
+    EXPECTED_ACCEL_VALUES_PER_MESSAGE = 25
+    # Increment whenever decoding changes, to invalidate cached tracks.
+    CACHE_VERSION = 1
+
+    def __init__(self, tss, lons, lats, speeds, accels):
+        self._tss = self._read_only_array(tss, np.int64)
+        self._lons = self._read_only_array(lons, np.float64)
+        self._lats = self._read_only_array(lats, np.float64)
+        self._speeds = self._read_only_array(speeds, np.float64)
+        self._accels = self._read_only_array(accels, np.float32)
+        if not (len(self._tss) == len(self._lons) == len(self._lats)
+                == len(self._speeds) == len(self._accels)):
+            raise ValueError('Track columns must have equal lengths.')
+        idxs = self._monotonic_indices(self._tss)
+        if idxs is not None:
+            logger.info(
+                f'Dropped {len(self._tss) - len(idxs)} positions with '
+                'duplicate timestamps.')
+            self._tss, self._lons, self._lats, self._speeds, self._accels = (
+                self._read_only_array(column[idxs], column.dtype)
+                for column in (
+                    self._tss, self._lons, self._lats, self._speeds,
+                    self._accels))
+        self._analysis_data = {}
+        self._slice_bounds = {}
+        self._positions = None
+
+    @classmethod
+    def _from_ordered_columns(cls, tss, lons, lats, speeds, accels):
+        """
+        Create a track from read-only columns of the right types that are
+        known to be in strictly increasing timestamp order, without checking
+        or copying them.
+        """
+        track = cls([], [], [], [], [])
+        track._tss, track._lons, track._lats, track._speeds, track._accels = (
+            tss, lons, lats, speeds, accels)
+        return track
+
+    @classmethod
+    def from_positions(cls, positions):
+        return cls(
+            [datetime_to_ns(p.ts) for p in positions],
+            [p.lon for p in positions], [p.lat for p in positions],
+            [p.speed for p in positions], [p.accel for p in positions])
+
+    @classmethod
+    def from_path(cls, file_path, decoder='native', cache=None):
+        """
+        Parse a .fit file recorded by the BumpVisualizer.
+
+        decoder is one of DECODERS. The native decoder only handles the
+        messages the BumpVisualizer writes and falls back to fitparse if it
+        encounters anything else. If a TrackCache is given, decoded columns
+        are taken from or stored in it.
+        """
+        with instrumentation.timed_stage('parse'):
+            columns = cls.read_message_columns(file_path, decoder, cache)
+            track = cls.from_message_columns(columns)
+        with instrumentation.timed_stage('continuity_check'):
+            track._check_position_continuity(
+                columns.messages_start_ts, columns.messages_end_ts)
+        return track
+
+    @classmethod
+    def read_message_columns(cls, file_path, decoder='native', cache=None):
+        """
+        Return the MessageColumns of a .fit file, decoded as by from_path().
+        """
+        if decoder not in DECODERS:
+            raise ValueError(f'Unknown decoder {decoder}.')
+        columns = cls._load_cached_columns(file_path, cache)
+        if columns is None:
+            columns = cls._decode(file_path, decoder)
+            if cache:
+                try:
+                    cache.store(file_path, columns.to_arrays())
+                except OSError as e:
+                    # The cache only saves time, the columns are still good.
+                    logger.warning(f'Failed to cache {file_path}: {e}')
+        return columns
+
+    @classmethod
+    def _load_cached_columns(cls, file_path, cache):
+        if not cache:
+            return None
+        arrays = cache.load(file_path)
+        if arrays is None:
+            return None
+        try:
+            return MessageColumns.from_arrays(arrays)
+        except (KeyError, ValueError) as e:
+            logger.warning(
+                f'Ignoring invalid cache entry for {file_path}: {e}')
+            return None
+
+    @classmethod
+    def _decode(cls, file_path, decoder):
+        if decoder == 'native':
+            try:
+                return cls._decode_native(file_path)
+            except fit_decoder.UnsupportedFitData as e:
+                logger.info(
+                    f'Native decoder can\'t handle {file_path} ({e}), '
+                    'falling back to fitparse.')
+        return cls._decode_fitparse(file_path)
+
+    @classmethod
+    def _decode_native(cls, file_path):
+        with open(file_path, 'rb') as file:
+            return cls._from_record_columns(
+                fit_decoder.decode_records(file.read()))
+
+    @classmethod
+    def _from_record_columns(cls, columns):
+        """Convert RecordColumns of the native decoder to MessageColumns."""
+        def to_datetime(unix_seconds):
+            if unix_seconds is None:
+                return None
+            return EPOCH + datetime.timedelta(seconds=unix_seconds)
+
+        return MessageColumns(
+            columns.timestamps * NANOSECONDS_PER_SECOND,
+            columns.lons_semicircles, columns.lats_semicircles,
+            columns.speeds, cls._parse_raw_accels(columns.accels),
+            to_datetime(columns.first_timestamp),
+            to_datetime(columns.last_timestamp))
+
+    @classmethod
+    def _decode_fitparse(cls, file_path):
+        # fitparse takes a while to import and isn't needed if the native
+        # decoder succeeds.
+        import fitparse
+        with open(file_path, 'rb') as file:
+            fit_file = fitparse.FitFile(file)
+            fit_file.parse()
+        message_tss = []
+        lons_semicircles = []
+        lats_semicircles = []
+        speeds = []
+        accels = []
+        for message in fit_file.messages:
+            try:
+                ts, lon_semicircles, lat_semicircles, speed, message_accels = (
+                    cls._extract_position_data(message))
+            except IncompletePositionData:
+                continue
+            message_tss.append(datetime_to_ns(ts))
+            lons_semicircles.append(lon_semicircles)
+            lats_semicircles.append(lat_semicircles)
+            speeds.append(speed)
+            accels.append(message_accels)
+        return MessageColumns(
+            np.asarray(message_tss, dtype=np.int64),
+            np.asarray(lons_semicircles, dtype=np.int32),
+            np.asarray(lats_semicircles, dtype=np.int32),
+            np.asarray(speeds, dtype=np.float64),
+            np.asarray(accels, dtype=np.float32).reshape(
+                -1, cls.EXPECTED_ACCEL_VALUES_PER_MESSAGE),
+            *cls._message_timestamp_range(fit_file.messages))
+
+    @classmethod
+    def from_message_columns(cls, columns):
+        """
+        Create a track from per-message columns.
+
+        Every message contributes EXPECTED_ACCEL_VALUES_PER_MESSAGE positions
+        spread evenly over the second following the message timestamp. All
+        positions of a message share its location and speed.
+        """
+        values_per_message = columns.accels.shape[1]
+        ns_per_accel = NANOSECONDS_PER_SECOND // values_per_message
+        tss = (
+            columns.message_tss[:, np.newaxis]
+            + np.arange(values_per_message, dtype=np.int64) * ns_per_accel)
+
+        def repeat(values):
+            return np.repeat(
+                np.asarray(values, dtype=np.float64), values_per_message)
+
+        return cls(
+            tss.ravel(),
+            cls._semicircles_to_deg(repeat(columns.lons_semicircles)),
+            cls._semicircles_to_deg(repeat(columns.lats_semicircles)),
+            repeat(columns.speeds),
+            cls._adjusted_accel(columns.accels.ravel()))
+
+    @classmethod
+    def _extract_position_data(cls, message):
+        ts = cls._field_value(message, 'timestamp', datetime.datetime)
+        lon_semicircles = cls._field_value(message, 'position_long')
+        lat_semicircles = cls._field_value(message, 'position_lat')
+        speed = cls._field_value(message, 'enhanced_speed')
+        accel_fields = sorted((
+            field for field in message.fields
+            if field.name.startswith('accel')), key=cls._accel_field_bounds)
+        accel_fields = accel_fields or None
+        data_fields = [lon_semicircles, lat_semicircles, speed, accel_fields]
+        if not all(v is not None for v in [ts] + data_fields):
+            if any(v is not None for v in data_fields):
+                raise IncompletePositionData(
+                    'Not all expected values were present, but some were.')
+            else:
+                raise IncompletePositionData('Not a position message.')
+        cls._assert_valid_accel_fields(accel_fields)
+        accels = cls._extract_accels(accel_fields)
+        return ts, lon_semicircles, lat_semicircles, speed, accels
+
+    @classmethod
+    def _field_value(cls, message, name, field_type=None):
+        try:
+            return next(
+                field.value
+                for field in message.fields
+                if field.name == name and (
+                    field_type is None or isinstance(field.value, field_type)))
+        except StopIteration:
+            return None
+
+    @classmethod
+    def _assert_valid_accel_fields(cls, accel_fields):
+        if cls._accel_field_bounds(accel_fields[0])[0] != 0:
+            raise ParseError('Acceleration fields don\'t start at 0.')
+        for f1, f2 in it.pairwise(accel_fields):
+            _, end1 = cls._accel_field_bounds(f1)
+            start2, _ = cls._accel_field_bounds(f2)
+            if start2 != end1:
+                raise ParseError('Acceleration fields aren\'t consecutive.')
+
+    @classmethod
+    def _accel_field_bounds(cls, field):
+        match = re.match(r'accel_z_(\d+)-(\d+)', field.name)
+        if not match or len(match.groups()) != 2:
+            raise ParseError(f'Invalid acceleration field name {field.name}.')
+        return int(match.group(1)), int(match.group(2))
+
+    @classmethod
+    def _extract_accels(cls, accel_fields):
+        accels = []
+        num_out_of_bounds = 0
+        reached_end = False
+        for f in accel_fields:
+            start, end = cls._accel_field_bounds(f)
+            if len(f.value) != end - start:
+                raise ParseError('Mismatched acceleration value counts.')
+            for raw_accel in f.value:
+                accel = cls._parse_raw_accel(raw_accel)
+                if accel is None:
+                    reached_end = True
+                    continue
+                elif reached_end:
+                    raise ParseError(
+                        'Encountered acceleration value after first null.')
+                if math.isinf(accel):
+                    num_out_of_bounds += 1
+                accels.append(accel)
+        if len(accels) != cls.EXPECTED_ACCEL_VALUES_PER_MESSAGE:
+            raise IncompletePositionData(
+                f'Unexpected number of acceleration values ({len(accels)}).')
+        return accels
+
+    @classmethod
+    def _parse_raw_accel(cls, raw_accel):
+        # fitparse returns None for 32767, the invalid value of sint16
+        # fields, which the sensor writes for saturated samples.
+        if raw_accel is None:
+            return float('inf')
+        if raw_accel == -32768:
+            return None
+        if raw_accel == -32767:
+            return float('-inf')
+        if raw_accel == 32767:
+            return float('inf')
+        return raw_accel
+
+    @classmethod
+    def _parse_raw_accels(cls, raw_accels):
+        """Vectorized _parse_raw_accel for arrays without nulls."""
+        accels = raw_accels.astype(np.float32)
+        accels[raw_accels == -32767] = float('-inf')
+        accels[raw_accels == 32767] = float('inf')
+        return accels
+
+    @classmethod
+    def _adjusted_accel(cls, accel):
+        # The sensor will show -1g in idle. Add 1g to make 0 the baseline.
+        return accel + 1000
+
+    @classmethod
+    def _semicircles_to_deg(cls, semicircles):
+        return np.degrees((semicircles * np.pi) / 0x80000000)
+
+    @classmethod
+    def _message_timestamp_range(cls, messages):
+        message_tss = [
+            ts for ts in (
+                cls._field_value(m, 'timestamp', datetime.datetime)
+                for m in messages) if ts is not None]
+        if not message_tss:
+            return None, None
+        return message_tss[0], message_tss[-1]
+
+    def _check_position_continuity(
+            self, messages_start_ts=None, messages_end_ts=None):
+        start_ts, end_ts = self._check_start_end_offsets(
+            messages_start_ts, messages_end_ts)
+        if start_ts is None:
+            return
+        gaps = self._gap_indices()
+        if not len(gaps):
+            return
+        discontinuous_duration = datetime.timedelta(microseconds=int(
+            (self._tss[gaps + 1] - self._tss[gaps]).sum()) // 1000)
+        discontinuous_fraction = discontinuous_duration / (end_ts - start_ts)
+        logger.info(
+            f'There are {len(gaps)} discontinuities totalling a '
+            f'duration of {discontinuous_duration}. This is '
+            f'{discontinuous_fraction*100:.2f}% of the total.')
+
+    def _gap_indices(self):
+        """
+        Return the indices of positions that are followed by a gap.
+
+        Positions more than a second apart start a new continuous interval.
+        """
+        return np.flatnonzero(np.diff(self._tss) > NANOSECONDS_PER_SECOND)
+
+    def _check_start_end_offsets(self, messages_start_ts, messages_end_ts):
+        if not len(self):
+            logger.warning('No complete positions in track.')
+            return None, None
+        start_ts = ns_to_datetime(self._tss[0])
+        end_ts = ns_to_datetime(self._tss[-1])
+        duration = end_ts - start_ts
+        logger.info(
+            f'Parsed track spanning {start_ts} - {end_ts} ({duration}).')
+        if messages_start_ts is None or messages_end_ts is None:
+            return start_ts, end_ts
+        start_offset = start_ts - messages_start_ts
+        end_offset = messages_end_ts - end_ts
+        if start_offset or end_offset:
+            logger.info(
+                f'Messages start {start_offset} earlier and end {end_offset} '
+                'later than positions.')
+        return start_ts, end_ts
+
+    @staticmethod
+    def _monotonic_indices(tss):
+        """
+        Return the indices that order tss, keeping only the first of equal
+        timestamps, or None if tss are strictly increasing already.
+        """
+        if np.all(np.diff(tss) > 0):
+            return None
+        # Uses a stable sort, so the first of equal timestamps is kept.
+        _, idxs = np.unique(tss, return_index=True)
+        return idxs
+
+    @staticmethod
+    def _read_only_array(values, dtype):
+        array = np.ascontiguousarray(values, dtype=dtype)
+        array.flags.writeable = False
+        return array
+
+    def __len__(self):
+        return len(self._tss)
+
+    def position(self, idx):
+        idx = range(len(self))[idx]
+        return Position(
+            ns_to_datetime(self._tss[idx]), float(self._lons[idx]),
+            float(self._lats[idx]), float(self._speeds[idx]),
+            float(self._accels[idx]), {
+                key: float(values[idx])
+                for key, values in self._analysis_data.items()})
+
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = PositionsView(self)
+        return self._positions
+
+    @ft.cached_property
+    def bounds(self):
+        if not len(self):
+            return (float('inf'), float('inf'), float('-inf'),
+                    float('-inf'))
+        return (
+            float(self._lons.min()), float(self._lats.min()),
+            float(self._lons.max()), float(self._lats.max()))
+
+    @property
+    def tss_ns(self):
+        return self._tss
+
+    @property
+    def tss(self):
+        return self._tss.view('datetime64[ns]')
+
+    @property
+    def lons(self):
+        return self._lons
+
+    @property
+    def lats(self):
+        return self._lats
+
+    @property
+    def speeds(self):
+        return self._speeds
+
+    @property
+    def accels(self):
+        return self._accels
+
+    @ft.cached_property
+    def speeds_kph(self):
+        return self._read_only_array(
+            Position._mps_to_kph(self._speeds), np.float64)
+
+    def rolling_average_absolute_accels(
+            self, window_duration_seconds, attenuator):
+        self.ensure_rolling_average_absolute_accels(
+            window_duration_seconds, attenuator)
+        return self._analysis_data[self._rolling_average_key(
+            window_duration_seconds, attenuator)]
+
+    def rolling_average_absolute_accels_for_all(
+            self, window_duration_seconds, attenuators):
+        """
+        Return rolling averages for several attenuators as a 2D array.
+
+        Each row contains the rolling averages attenuated by the
+        corresponding attenuator (which may be None). The rolling average is
+        only computed once and shared by all attenuators.
+        """
+        self.ensure_rolling_average_absolute_accels_for_all(
+            window_duration_seconds, attenuators)
+        return np.stack([
+            self._analysis_data[self._rolling_average_key(
+                window_duration_seconds, attenuator)]
+            for attenuator in attenuators]).reshape(len(attenuators), -1)
+
+    def ensure_rolling_average_absolute_accels(
+            self, window_duration_seconds, attenuator):
+        self.ensure_rolling_average_absolute_accels_for_all(
+            window_duration_seconds, [attenuator])
+
+    def ensure_rolling_average_absolute_accels_for_all(
+            self, window_duration_seconds, attenuators):
+        unattenuated_key = self._rolling_average_key(
+            window_duration_seconds, None)
+        if unattenuated_key not in self._analysis_data:
+            self._analysis_data[unattenuated_key] = self._read_only_array(
+                self._rolling_average_absolute_accels(
+                    window_duration_seconds), np.float64)
+        unattenuated = self._analysis_data[unattenuated_key]
+        missing_attenuators = [
+            attenuator for attenuator in dict.fromkeys(attenuators)
+            if attenuator and self._rolling_average_key(
+                window_duration_seconds, attenuator)
+            not in self._analysis_data]
+        if not missing_attenuators:
+            return
+        attenuated = unattenuated * Attenuator.factors_for_all(
+            missing_attenuators, self.speeds_kph)
+        for attenuator, averages in zip(missing_attenuators, attenuated):
+            self._analysis_data[self._rolling_average_key(
+                window_duration_seconds, attenuator)] = (
+                    self._read_only_array(averages, np.float64))
+
+    @staticmethod
+    def _rolling_average_key(window_duration_seconds, attenuator):
+        return (
+            'rolling_average_absolute_accels', window_duration_seconds,
+            attenuator)
+
+    def _rolling_average_absolute_accels(self, window_duration_seconds):
+        window_duration = int(window_duration_seconds * NANOSECONDS_PER_SECOND)
+        # The window for each position reaches back to the first position
+        # that is at most window_duration older.
+        window_starts = np.searchsorted(
+            self._tss, self._tss - window_duration, side='left')
+        window_stops = np.arange(1, len(self) + 1)
+        return self._window_means(
+            *self._cumulative_sums(np.abs(self._accels.astype(np.float64))),
+            window_starts, window_stops)
+
+    @staticmethod
+    def _cumulative_sums(values, initial_sum=0, initial_num_infinite=0):
+        """
+        Return the cumulative sums of the finite values and the cumulative
+        counts of infinite ones, each starting with the initial value.
+
+        Infinite values are counted separately, since they would poison the
+        sums.
+        """
+        infinite = np.isinf(values)
+        finite_values = np.where(infinite, 0, values)
+        sums = np.cumsum(np.concatenate(([initial_sum], finite_values)))
+        num_infinite = np.cumsum(
+            np.concatenate(([initial_num_infinite], infinite)))
+        return sums, num_infinite
+
+    @staticmethod
+    def _window_means(sums, num_infinite, starts, stops):
+        """
+        Return the means of values[start:stop] for all starts and stops.
+
+        sums and num_infinite are the _cumulative_sums() of values. Using
+        their differences, the cost doesn't depend on the window sizes. Any
+        window containing an infinite value has an infinite mean.
+        """
+        means = (sums[stops] - sums[starts]) / (stops - starts)
+        means[num_infinite[stops] > num_infinite[starts]] = np.inf
+        return means
+
+    def slice_bounds(self, duration_seconds):
+        """
+        Split the track into consecutive chunks of positions.
+
+        A chunk is closed by the first position that is at least
+        duration_seconds after the chunk's first position. Returns arrays of
+        start and stop indices of the chunks, which are cached per duration.
+        Since the chunks are consecutive, starts can be used directly with
+        ufunc.reduceat to aggregate over all chunks at once.
+        """
+        try:
+            return self._slice_bounds[duration_seconds]
+        except KeyError:
+            pass
+        slice_duration = int(duration_seconds * NANOSECONDS_PER_SECOND)
+        # Where a chunk starting at each position would end. Timestamps are
+        # strictly increasing, as ensured when the track was created.
+        stops_by_start = np.minimum(
+            np.searchsorted(
+                self._tss, self._tss + slice_duration, side='left') + 1,
+            len(self))
+        starts = []
+        start = 0
+        while start < len(self):
+            starts.append(start)
+            start = stops_by_start[start]
+        starts = np.array(starts, dtype=np.int64)
+        stops = np.append(starts[1:], len(self))
+        bounds = (
+            self._read_only_array(starts, np.int64),
+            self._read_only_array(stops, np.int64))
+        self._slice_bounds[duration_seconds] = bounds
+        return bounds
+
+    def time_slices(self, duration_seconds):
+        """
+        Yield the chunks of slice_bounds() as slice objects.
+        """
+        for start, stop in zip(*self.slice_bounds(duration_seconds)):
+            yield slice(start, stop)
+
+    def slice_means(self, duration_seconds, values):
+        """Return the mean of values within each chunk of slice_bounds()."""
+        if not len(self):
+            return np.empty(0)
+        starts, stops = self.slice_bounds(duration_seconds)
+        return np.add.reduceat(values, starts) / (stops - starts)
+
+    def spikes(self, duration_seconds, lower_limit_millig):
+        """
+        Find chunks of slice_bounds() with extreme accelerations.
+
+        A chunk contains a spike if its maximum absolute acceleration is at
+        least lower_limit_millig. Returns the indices of the positions in the
+        middle of these chunks and their maximum absolute accelerations.
+        """
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        starts, stops = self.slice_bounds(duration_seconds)
+        max_accels = np.maximum.reduceat(np.abs(self._accels), starts)
+        is_spike = max_accels >= lower_limit_millig
+        mids = starts + (stops - starts) // 2
+        return mids[is_spike], max_accels[is_spike]
+
+    def summary(self, conf):
+        """
+        Return key figures of the track's analysis with an AnalysisConfig.
+
+        All values are plain Python types, so the result can be serialized
+        directly.
+        """
+        if not len(self):
+            return {'num_positions': 0}
+        att_abs_accels = self.rolling_average_absolute_accels(
+            conf.rolling_average_window_duration_seconds, conf.attenuator)
+        avg_att_abs_accels = self.slice_means(
+            conf.track_time_slice_seconds, att_abs_accels)
+        spike_idxs, _ = self.spikes(
+            conf.spike_time_slice_seconds, conf.spike_lower_limit_millig)
+        return {
+            'start': ns_to_datetime(self._tss[0]).isoformat(),
+            'end': ns_to_datetime(self._tss[-1]).isoformat(),
+            'duration_seconds':
+                int(self._tss[-1] - self._tss[0]) / NANOSECONDS_PER_SECOND,
+            'num_positions': len(self),
+            'num_discontinuities': len(self._gap_indices()),
+            'mean_speed_kph': float(self.speeds_kph.mean()),
+            'max_speed_kph': float(self.speeds_kph.max()),
+            'max_abs_accel_millig': float(np.abs(self._accels).max()),
+            'mean_attenuated_accel_millig': float(att_abs_accels.mean()),
+            'max_attenuated_accel_millig': float(att_abs_accels.max()),
+            'num_track_slices': len(avg_att_abs_accels),
+            'bad_track_slice_fraction': float(np.mean(
+                avg_att_abs_accels >= conf.track_upper_limit_millig)),
+            'num_spikes': len(spike_idxs),
+        }
+
+
+class _AppendableArray:
+    """
+    A 1D array with spare capacity at the end, so that appending costs time
+    proportional to the appended values (amortized).
+    """
+
+    def __init__(self, values, dtype):
+        self._buffer = np.array(values, dtype=dtype)
+        self._size = len(self._buffer)
+
+    @property
+    def values(self):
+        """A read-only view of all values, unaffected by later appends."""
+        view = self._buffer[:self._size]
+        view.flags.writeable = False
+        return view
+
+    def append(self, values):
+        """Append values and return a read-only view of all values."""
+        size = self._size + len(values)
+        if size > len(self._buffer):
+            buffer = np.empty(
+                max(size, 2 * len(self._buffer)), dtype=self._buffer.dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:size] = values
+        self._size = size
+        return self.values
+
+
+class TrackTail:
+    """
+    Follows a .fit file that is still being written, e.g. a ride synced while
+    it is being recorded.
+
+    Each call of update() only decodes the records appended since the
+    previous call, with the native decoder (there is no fallback to
+    fitparse), and returns a Track of all positions so far. Its columns are
+    views of buffers with spare capacity that the new positions are appended
+    to, and rolling averages and slice bounds computed on the previous track
+    are extended to the new positions rather than computed again. So an
+    update costs time proportional to what was appended, apart from copying
+    the stops of the slices, which are a small fraction of the positions.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.track = Track([], [], [], [], [])
+        self._decoder = fit_decoder.IncrementalDecoder()
+        self._columns = [
+            _AppendableArray([], dtype) for dtype in
+            (np.int64, np.float64, np.float64, np.float64, np.float32)]
+        self._abs_accel_sums = _AppendableArray([0], np.float64)
+        self._num_infinite_abs_accels = _AppendableArray([0], np.int64)
+        self._analysis_data = {}
+        self._slice_starts = {}
+
+    def update(self):
+        """
+        Decode the records appended to the file and return the new track.
+
+        The track is the same as the previous one if nothing was appended.
+        """
+        with instrumentation.timed_stage('parse'):
+            with open(self.file_path, 'rb') as file:
+                columns = self._decoder.update(file)
+            appended = Track.from_message_columns(
+                Track._from_record_columns(columns))
+            if len(self.track) and len(appended):
+                # Positions that aren't later than the previous track, e.g.
+                # of records written twice, can't be inserted into the
+                # extended rolling averages and slices and are dropped.
+                later = appended.tss_ns > self.track.tss_ns[-1]
+                if not later.all():
+                    appended = Track(
+                        appended.tss_ns[later], appended.lons[later],
+                        appended.lats[later], appended.speeds[later],
+                        appended.accels[later])
+        if not len(appended):
+            return self.track
+        previous = self.track
+        with instrumentation.timed_stage('analysis'):
+            # The appended positions are ordered and later than the previous
+            # ones, so the columns needn't be checked again.
+            self.track = Track._from_ordered_columns(*(
+                column.append(values) for column, values in zip(
+                    self._columns,
+                    (appended.tss_ns, appended.lons, appended.lats,
+                     appended.speeds, appended.accels))))
+            self._extend_rolling_averages(previous, appended)
+            self._extend_slice_bounds(previous)
+        logger.info(
+            f'Read {len(appended)} new positions from {self.file_path}, '
+            f'{len(self.track)} in total.')
+        return self.track
+
+    def _extend_rolling_averages(self, previous, appended):
+        sums, num_infinite = Track._cumulative_sums(
+            np.abs(appended.accels.astype(np.float64)),
+            self._abs_accel_sums.values[-1],
+            self._num_infinite_abs_accels.values[-1])
+        sums = self._abs_accel_sums.append(sums[1:])
+        num_infinite = self._num_infinite_abs_accels.append(num_infinite[1:])
+        tss = self.track.tss_ns
+        stops = np.arange(len(previous), len(tss)) + 1
+        unattenuated = {}
+        # Unattenuated averages sort first, since attenuated ones need them.
+        keys = sorted(
+            previous._analysis_data, key=lambda key: key[2] is not None)
+        for key in keys:
+            _, window_duration_seconds, attenuator = key
+            if key not in self._analysis_data:
+                self._analysis_data[key] = _AppendableArray(
+                    previous._analysis_data[key], np.float64)
+            if attenuator is None:
+                window_duration = int(
+                    window_duration_seconds * NANOSECONDS_PER_SECOND)
+                starts = np.searchsorted(
+                    tss, appended.tss_ns - window_duration, side='left')
+                averages = Track._window_means(
+                    sums, num_infinite, starts, stops)
+                unattenuated[window_duration_seconds] = averages
+            else:
+                averages = unattenuated[window_duration_seconds] * (
+                    attenuator.factors(appended.speeds_kph))
+            self.track._analysis_data[key] = (
+                self._analysis_data[key].append(averages))
+
+    def _extend_slice_bounds(self, previous):
+        tss = self.track.tss_ns
+        for duration_seconds, (starts, _) in previous._slice_bounds.items():
+            if duration_seconds not in self._slice_starts:
+                self._slice_starts[duration_seconds] = _AppendableArray(
+                    starts, np.int64)
+            slice_starts = self._slice_starts[duration_seconds]
+            slice_duration = int(duration_seconds * NANOSECONDS_PER_SECOND)
+            # Only the last slice may have been cut short by the end of the
+            # previous track, so slicing continues from its start.
+            new_starts = [] if len(starts) else [0]
+            start = starts[-1] if len(starts) else 0
+            while True:
+                start = np.searchsorted(
+                    tss, tss[start] + slice_duration, side='left') + 1
+                if start >= len(tss):
+                    break
+                new_starts.append(start)
+            starts = slice_starts.append(new_starts)
+            self.track._slice_bounds[duration_seconds] = (
+                starts, Track._read_only_array(
+                    np.append(starts[1:], len(tss)), np.int64))
+
+
+@dc.dataclass
+class AnalysisConfig:
+    track_time_slice_seconds: float
+    spike_time_slice_seconds: float
+    rolling_average_window_duration_seconds: float
+    track_lower_limit_millig: float
+    track_upper_limit_millig: float
+    plot_spikes: bool
+    spike_lower_limit_millig: float
+    spike_upper_limit_millig: float
+    attenuator: Attenuator
+    extra_zoom: int
+    max_tiles: int = DEFAULT_MAX_TILES
+    split_map: bool = False
+    decimation: str = decimation.DEFAULT_METHOD
+
+    def __post_init__(self):
+        try:
+            assert self.track_time_slice_seconds > 0
+            assert self.spike_time_slice_seconds > 0
+            assert self.rolling_average_window_duration_seconds > 0
+            assert (
+                self.track_lower_limit_millig < self.track_upper_limit_millig)
+            assert (
+                self.spike_lower_limit_millig < self.spike_upper_limit_millig)
+            assert self.max_tiles > 0
+            assert self.decimation in decimation.METHODS
+        except AssertionError as e:
+            raise ValueError('Invalid configuration.') from e
+
+    def __str__(self):
+        return '; '.join([
+            f'time slice: {self.track_time_slice_seconds}s (track)/'
+            f'{self.spike_time_slice_seconds}s (spikes)',
+            'roll. avg. lookback: '
+            f'{self.rolling_average_window_duration_seconds}s',
+            f'track range: {self.track_lower_limit_millig}mg-'
+            f'{self.track_upper_limit_millig}mg',
+            f'spike range: {self.spike_lower_limit_millig}mg-'
+            f'{self.spike_upper_limit_millig}mg',
+            f'attenuation: {self.attenuator.spec}'])
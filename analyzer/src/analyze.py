@@ -1,649 +1,915 @@
 import argparse
 import collections
+import concurrent.futures
 import dataclasses as dc
-import datetime
 import functools as ft
 import itertools as it
+import json
 import logging
-import math
+import os
 import pathlib
-import re
-
-import cartopy
-import cartopy.crs
-import cartopy.io.img_tiles
-import cartopy.mpl.geoaxes
-import colour
-import fitparse
-import matplotlib.pyplot as plt
-import shapely.geometry
+import sys
+import time
+
+# Taken before importing anything heavier than the standard library, to
+# measure the startup time of commands that don't plot.
+START_TIME = time.perf_counter()
+
+import aggregation  # noqa: E402
+import analysis  # noqa: E402
+import decimation  # noqa: E402
+import export  # noqa: E402
+import heatmap  # noqa: E402
+import hotspots  # noqa: E402
+import instrumentation  # noqa: E402
+import ride_store  # noqa: E402
+import tile_pyramid  # noqa: E402
+import tiles  # noqa: E402
+import track_cache  # noqa: E402
+import watch  # noqa: E402
 
 logger = None
 
+DEFAULT_TRACK_CACHE_DIR = (
+    pathlib.Path(__file__).parent.parent / 'track_cache')
+DEFAULT_BASEMAP_CACHE_DIR = (
+    pathlib.Path(__file__).parent.parent / 'basemap_cache')
+DEFAULT_ROAD_QUALITY_DATABASE = (
+    pathlib.Path(__file__).parent.parent / 'road_quality.sqlite')
+DEFAULT_RIDE_STORE = pathlib.Path(__file__).parent.parent / 'rides.sqlite'
+DEFAULT_HOTSPOT_DATABASE = (
+    pathlib.Path(__file__).parent.parent / 'hotspots.sqlite')
+DEFAULT_HEATMAP_RASTER = pathlib.Path(__file__).parent.parent / 'heatmap.npz'
+DEFAULT_TILE_PYRAMID_DIR = (
+    pathlib.Path(__file__).parent.parent / 'tile_pyramid')
+COMMANDS = (
+    'plot', 'stats', 'export', 'aggregate', 'hotspots', 'heatmap', 'pyramid',
+    'ingest', 'watch')
+# Startup time in seconds that commands which don't plot should stay within.
+# Importing the plotting stack alone takes several times as long.
+NON_PLOTTING_STARTUP_BUDGET_SECONDS = 0.5
+# Items submitted to worker processes ahead of the results being yielded, per
+# process.
+ITEMS_IN_FLIGHT_PER_JOB = 2
+PLOTTING_MODULES = ('matplotlib', 'cartopy', 'colour', 'shapely')
+
 
 def setup_logging():
     logging.basicConfig(level=logging.INFO)
 
 
-def capped_fraction(value, reference):
-    return min(1, value / reference)
-
+@dc.dataclass
+class FileResult:
+    """
+    The outcome of analyzing one file.
 
-class ParseError(Exception):
-    pass
+    Depending on the command, contains the paths of the saved images or
+    exported files, the analyzed track or a summary of the analysis. error is
+    set if analysis failed.
+    """
+    path: pathlib.Path
+    saved_paths: list = dc.field(default_factory=list)
+    track: analysis.Track = None
+    stats: dict = None
+    error: Exception = None
 
 
-class IncompletePositionData(Exception):
+def analyze_files(
+        paths, save, save_suffix, plot_separately, conf, decoder='native',
+        cache=None, jobs=1, profile=False, tile_source=None,
+        basemap_cache=None):
     """
-    Raised during message parsing if necessary position data is missing.
+    Analyze and plot .fit files, using up to jobs processes.
+
+    With save, each file is parsed, analyzed, plotted and saved on its own, so
+    only one file's figures per process exist at a time. Otherwise, files are
+    parsed and analyzed in parallel, and all figures are shown at the end.
+    With profile, the work done for each file in parallel is profiled (see
+    instrumentation.profiled()). Map tiles are taken from tile_source, a
+    tiles.TileSourceSpec, or downloaded from OpenStreetMap if it's None.
+    Stitched maps are cached in basemap_cache, a track_cache.ArrayCache, if
+    given.
+
+    Returns a FileResult for each path, in input order. Failures are logged
+    and don't stop the remaining files from being analyzed.
+    """
+    if save_suffix:
+        save_suffix = '.' + save_suffix
+    save_suffix += '.png'
+    analyze_file = ft.partial(
+        _instrumented, _analyze_file, profile=profile, save=save,
+        save_suffix=save_suffix,
+        plot_separately=plot_separately, conf=conf, decoder=decoder,
+        cache=cache, tile_source=tile_source, basemap_cache=basemap_cache)
+    results = []
+    for path, (output, error) in zip(
+            paths, _map_in_processes(
+                analyze_file, paths, jobs, headless=save)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to analyze {path}.', exc_info=error)
+        elif save:
+            result.saved_paths = output
+            logger.info(f'Saved {", ".join(map(str, output))}.')
+        else:
+            result.track = output
+        results.append(result)
+    if not save:
+        import matplotlib.pyplot as plt
+        import plotting
+        for result in results:
+            if result.track is not None:
+                with instrumentation.file_context(result.path), \
+                        instrumentation.timed_stage('plot'):
+                    plotting.plot_track(
+                        result.track, result.path.with_suffix(''),
+                        plot_separately, conf,
+                        _tile_source_for_spec(tile_source), basemap_cache)
+        plt.show()
+    return results
+
+
+def _analyze_file(
+        path, save, save_suffix, plot_separately, conf, decoder, cache,
+        tile_source, basemap_cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    if not save:
+        # Do the expensive part of the analysis here, where it may run in
+        # parallel.
+        with instrumentation.timed_stage('analysis'):
+            track.ensure_rolling_average_absolute_accels_for_all(
+                conf.rolling_average_window_duration_seconds,
+                [None, conf.attenuator])
+        return track
+    import matplotlib.pyplot as plt
+    import plotting
+    with instrumentation.timed_stage('plot'):
+        figures = plotting.plot_track(
+            track, path.with_suffix(''), plot_separately, conf,
+            _tile_source_for_spec(tile_source), basemap_cache)
+    saved_paths = []
+    # Saving draws the figures, which includes fetching tiles.
+    with instrumentation.timed_stage('save'):
+        for figure, base_path in figures:
+            saved_path = base_path.parent / (base_path.name + save_suffix)
+            figure.savefig(saved_path)
+            plt.close(figure)
+            saved_paths.append(saved_path)
+    return saved_paths
+
+
+def watch_directory(
+        directory, save_suffix, plot_separately, conf, decoder='native',
+        cache=None, jobs=1, profile=False, tile_source=None,
+        basemap_cache=None, manifest_path=None,
+        settle_seconds=watch.DEFAULT_SETTLE_SECONDS,
+        poll_interval_seconds=watch.DEFAULT_POLL_INTERVAL_SECONDS):
+    """
+    Analyze, plot and save .fit files as they appear in directory, until
+    interrupted.
 
-    This can be the case simply if the message is not a position message, or if
-    some fields are missing (usually if there is no GNSS fix yet, but the
-    acceleration sensor already works).
+    Files are processed in a pool of jobs worker processes, see
+    watch.FolderWatcher. The other arguments are as for analyze_files().
     """
+    if save_suffix:
+        save_suffix = '.' + save_suffix
+    save_suffix += '.png'
+    analyze_file = ft.partial(
+        _instrumented, _analyze_file, profile=profile, save=True,
+        save_suffix=save_suffix, plot_separately=plot_separately, conf=conf,
+        decoder=decoder, cache=cache, tile_source=tile_source,
+        basemap_cache=basemap_cache)
+    make_executor = ft.partial(
+        concurrent.futures.ProcessPoolExecutor, jobs,
+        initializer=_init_worker_process, initargs=(True,))
+    watcher = watch.FolderWatcher(
+        directory, analyze_file, make_executor, jobs, manifest_path,
+        settle_seconds, poll_interval_seconds)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logger.info(f'Stopped watching {directory}.')
+    finally:
+        watcher.close()
+
+
+def _tile_source_for_spec(spec):
+    import plotting
+    return None if spec is None else plotting.tile_source_for_spec(spec)
+
+
+def stats_files(
+        paths, conf, decoder='native', cache=None, jobs=1, profile=False):
+    """
+    Print a JSON summary of each file's analysis, using up to jobs processes.
 
+    Summaries are printed to stdout one per line, in input order. Never
+    imports the plotting stack. Returns a FileResult for each path.
+    """
+    file_stats = ft.partial(
+        _instrumented, _file_stats, profile=profile, conf=conf,
+        decoder=decoder, cache=cache)
+    results = []
+    for path, (stats, error) in zip(
+            paths, _map_in_processes(file_stats, paths, jobs)):
+        result = FileResult(path, stats=stats, error=error)
+        if error:
+            logger.error(f'Failed to analyze {path}.', exc_info=error)
+        else:
+            print(json.dumps({'path': str(path), **stats}), flush=True)
+        results.append(result)
+    return results
+
+
+def _file_stats(path, conf, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    with instrumentation.timed_stage('analysis'):
+        return track.summary(conf)
+
+
+def export_files(
+        paths, conf, fmt, output_dir=None, decoder='native', cache=None,
+        jobs=1, profile=False):
+    """
+    Export the analysis of each file in format fmt, using up to jobs
+    processes.
 
-@dc.dataclass
-class Position:
-    ts: datetime.datetime
-    lon: float
-    lat: float
-    speed: float
-    accel: float
-    analysis_data: dict = dc.field(default_factory=dict)
+    Files are written next to the input file, or into output_dir. Never
+    imports the plotting stack. Returns a FileResult for each path.
+    """
+    file_export = ft.partial(
+        _instrumented, _file_export, profile=profile, conf=conf, fmt=fmt,
+        output_dir=output_dir, decoder=decoder, cache=cache)
+    results = []
+    for path, (exported_paths, error) in zip(
+            paths, _map_in_processes(file_export, paths, jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to export {path}.', exc_info=error)
+        else:
+            result.saved_paths = exported_paths
+            logger.info(f'Exported {", ".join(map(str, exported_paths))}.')
+        results.append(result)
+    return results
+
+
+def _file_export(path, conf, fmt, output_dir, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    base_path = path.with_suffix('')
+    if output_dir is not None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        base_path = output_dir / base_path.name
+    with instrumentation.timed_stage('export'):
+        return export.export_track(track, conf, base_path, fmt)
+
+
+def aggregate_files(
+        paths, conf, database, cell_zoom=None, decoder='native', cache=None,
+        jobs=1, profile=False):
+    """
+    Merge the road quality of each file into an aggregation.RoadQualityStore
+    at database, using up to jobs processes.
 
-    @property
-    def speed_kph(self):
-        return self._mps_to_kph(self.speed)
+    Files that were merged before are skipped without being parsed. Never
+    imports the plotting stack. Returns a FileResult for each path.
+    """
+    store = aggregation.RoadQualityStore(database, cell_zoom)
+    results, pending = _new_files(paths, store.contains, 'merged')
+    file_cells = ft.partial(
+        _instrumented, _file_cells, profile=profile, conf=conf,
+        cell_zoom=store.cell_zoom, decoder=decoder, cache=cache)
+    for (path, ride_key), (cells, error) in zip(pending, _map_in_processes(
+            file_cells, [path for path, _ in pending], jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to aggregate {path}.', exc_info=error)
+        elif store.merge(ride_key, str(path), cells):
+            logger.info(f'Merged {path} into {len(cells)} cells.')
+        results.append(result)
+    logger.info(f'{database} contains {store.num_rides} rides.')
+    store.close()
+    return results
+
+
+def _file_cells(path, conf, cell_zoom, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    with instrumentation.timed_stage('aggregation'):
+        return aggregation.ride_cells(track, conf, cell_zoom)
+
+
+def cluster_files(
+        paths, conf, database, cluster_radius_m=None, decoder='native',
+        cache=None, jobs=1, profile=False):
+    """
+    Cluster the spikes of each file into a hotspots.HotspotStore at database,
+    using up to jobs processes.
 
-    @staticmethod
-    def _mps_to_kph(mps):
-        return mps * 3.6
+    Files that were merged before are skipped without being parsed. Never
+    imports the plotting stack. Returns a FileResult for each path.
+    """
+    store = hotspots.HotspotStore(database, cluster_radius_m)
+    results, pending = _new_files(paths, store.contains, 'merged')
+    file_spikes = ft.partial(
+        _instrumented, _file_spikes, profile=profile, conf=conf,
+        decoder=decoder, cache=cache)
+    for (path, ride_key), (spikes, error) in zip(pending, _map_in_processes(
+            file_spikes, [path for path, _ in pending], jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to cluster {path}.', exc_info=error)
+        elif store.merge(ride_key, str(path), spikes):
+            logger.info(f'Clustered {len(spikes)} spikes of {path}.')
+        results.append(result)
+    logger.info(f'{database} contains {store.num_rides} rides.')
+    store.close()
+    return results
+
+
+def _file_spikes(path, conf, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    with instrumentation.timed_stage('analysis'):
+        return hotspots.ride_spikes(track, conf)
+
+
+def heatmap_files(
+        paths, conf, raster_path, zoom=None, save=False, save_suffix='',
+        decoder='native', cache=None, jobs=1, profile=False,
+        tile_source=None, basemap_cache=None):
+    """
+    Merge each file into the heatmap.HeatmapRaster at raster_path, using up
+    to jobs processes, and plot the raster over the map.
 
+    Files that were merged before are skipped without being parsed. With
+    save, the plot is saved next to the raster instead of being shown.
+    Returns a FileResult for each path, the last one of which holds the path
+    of the saved plot.
+    """
+    raster = heatmap.HeatmapRaster.open(raster_path, conf, zoom)
+    results, pending = _new_files(paths, raster.contains, 'merged')
+    file_pixels = ft.partial(
+        _instrumented, _file_pixels, profile=profile, conf=conf,
+        zoom=raster.zoom, decoder=decoder, cache=cache)
+    for (path, ride_key), (pixels, error) in zip(pending, _map_in_processes(
+            file_pixels, [path for path, _ in pending], jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to rasterize {path}.', exc_info=error)
+        elif raster.merge(ride_key, pixels):
+            logger.info(f'Merged {len(pixels)} pixels of {path}.')
+        results.append(result)
+    if pending:
+        raster.save(raster_path)
+    logger.info(f'{raster_path} contains {len(raster)} rides.')
+    if not len(raster.pixels):
+        return results
+    import matplotlib.pyplot as plt
+    import plotting
+    with instrumentation.timed_stage('plot'):
+        figures = plotting.plot_heatmap(
+            raster, raster_path.with_suffix(''), conf,
+            _tile_source_for_spec(tile_source), basemap_cache)
+    if not save:
+        plt.show()
+        return results
+    with instrumentation.timed_stage('save'):
+        for figure, base_path in figures:
+            saved_path = base_path.parent / (
+                base_path.name + ('.' + save_suffix if save_suffix else '')
+                + '.png')
+            figure.savefig(saved_path)
+            plt.close(figure)
+            results[-1].saved_paths.append(saved_path)
+            logger.info(f'Saved {saved_path}.')
+    return results
+
+
+def _file_pixels(path, conf, zoom, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    with instrumentation.timed_stage('analysis'):
+        return heatmap.ride_pixels(track, conf, zoom)
+
+
+def pyramid_files(
+        paths, conf, output_dir, zoom_levels=None, decoder='native',
+        cache=None, jobs=1, profile=False):
+    """
+    Add each file to the tile_pyramid.TilePyramid in output_dir and render
+    the tiles they cover, using up to jobs processes.
 
-class Attenuator:
+    Files that were added before are skipped without being parsed. Tiles
+    that fail to render are rendered again by the next call. Returns a
+    FileResult for each path.
     """
-    A method of attenuating acceleration by speed.
+    pyramid = tile_pyramid.TilePyramid(output_dir, conf, zoom_levels)
+    results, pending = _new_files(paths, pyramid.contains, 'added')
+    file_overlay = ft.partial(
+        _instrumented, _file_overlay, profile=profile, conf=conf,
+        decoder=decoder, cache=cache)
+    for (path, ride_key), (overlay, error) in zip(
+            pending, _map_in_processes(
+                file_overlay, [path for path, _ in pending], jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to add {path}.', exc_info=error)
+        else:
+            num_tiles = pyramid.add(ride_key, str(path), overlay)
+            logger.info(f'Added {path}, which covers {num_tiles} tiles.')
+        results.append(result)
+    # Saved before rendering, so worker processes see the added rides.
+    pyramid.save()
+    dirty_tiles = pyramid.dirty_tiles()
+    logger.info(f'Rendering {len(dirty_tiles)} tiles.')
+    render_tile = ft.partial(tile_pyramid.render_tile, output_dir, conf)
+    num_failed = 0
+    with instrumentation.timed_stage('render'):
+        for tile, (_, error) in zip(dirty_tiles, _map_in_processes(
+                render_tile, dirty_tiles, jobs)):
+            if error:
+                logger.error(f'Failed to render tile {tile}.', exc_info=error)
+                num_failed += 1
+            else:
+                pyramid.mark_rendered(tile)
+    pyramid.save()
+    logger.info(
+        f'{output_dir} contains {len(pyramid)} rides, rendered '
+        f'{len(dirty_tiles) - num_failed} tiles, {num_failed} failed.')
+    return results
 
-    Attenuates a given acceleration a at speed v to a_att as
 
-    a_att = (1 - (min(1, v / v_cap) ** exp) * att) * a
+def _file_overlay(path, conf, decoder, cache):
+    track = analysis.Track.from_path(path, decoder, cache)
+    with instrumentation.timed_stage('analysis'):
+        return tile_pyramid.ride_overlay(track, conf)
 
-    Here, v_cap is the speed at which maximum attenuation is applied (i.e.
-    higher speeds get the same attenuation), exp is an exponent for nonlinear
-    attenuation, and att is the amount of attenuation to apply at the speed
-    cap.
 
-    Specify an attenation as a string with format
-    "(linear|quadratic|cubic),<v_cap>,<att>", where the first argument
-    determines exp.
+def ingest_files(
+        paths, conf, database, decoder='native', cache=None, jobs=1,
+        profile=False):
     """
-    _exponents = (('linear', 1), ('quadratic', 2), ('cubic', 3))
-
-    def __init__(self, spec):
-        try:
-            args = spec.split(',')
-            self.exponent = next(e for m, e in self._exponents if m == args[0])
-            self.speed_cap = float(args[1])
-            assert self.speed_cap > 0
-            self.attenuation_at_max_speed = float(args[2])
-            assert 0 <= self.attenuation_at_max_speed <= 1
-        except Exception as e:
-            raise ValueError(
-                'Invalid attenation specification, must be '
-                '"(linear|quadratic|cubic),<v_cap>,<att>" with 0 <= att <= 1 '
-                'and v_cap > 0.') from e
-
-    @property
-    def spec(self):
-        method = next(m for m, e in self._exponents if e == self.exponent)
-        return f'{method},{self.speed_cap},{self.attenuation_at_max_speed}'
-
-    def __eq__(self, other):
-        return self.spec == other.spec
-
-    def __hash__(self):
-        return hash(self.spec)
-
-    def attenuate(self, accel, speed_kph):
-        fraction_of_max_speed = capped_fraction(speed_kph, self.speed_cap)
-        attenuation = ((fraction_of_max_speed**self.exponent)
-                       * self.attenuation_at_max_speed)
-        return (1 - attenuation) * accel
-
-
-class Track:
-    EXPECTED_ACCEL_VALUES_PER_MESSAGE = 25
-
-    def __init__(self, positions):
-        self._positions = positions
-
-    @classmethod
-    def from_path(cls, file_path):
-        with open(file_path, 'rb') as file:
-            fit_file = fitparse.FitFile(file)
-            fit_file.parse()
-        positions = []
-        for message in fit_file.messages:
-            try:
-                ts, lon_semicircles, lat_semicircles, speed, accels = (
-                    cls._extract_position_data(message))
-            except IncompletePositionData:
-                continue
-            seconds_per_accel = datetime.timedelta(seconds=1 / len(accels))
-            for i, accel in enumerate(accels):
-                positions.append(
-                    Position(
-                        ts + i * seconds_per_accel,
-                        cls._semicircles_to_deg(lon_semicircles),
-                        cls._semicircles_to_deg(lat_semicircles), speed,
-                        cls._adjusted_accel(accel)))
-        cls._check_position_continuity(fit_file.messages, positions)
-        return cls(positions)
-
-    @classmethod
-    def _extract_position_data(cls, message):
-        ts = cls._field_value(message, 'timestamp', datetime.datetime)
-        lon_semicircles = cls._field_value(message, 'position_long')
-        lat_semicircles = cls._field_value(message, 'position_lat')
-        speed = cls._field_value(message, 'enhanced_speed')
-        accel_fields = sorted((
-            field for field in message.fields
-            if field.name.startswith('accel')), key=cls._accel_field_bounds)
-        accel_fields = accel_fields or None
-        data_fields = [lon_semicircles, lat_semicircles, speed, accel_fields]
-        if not all(v is not None for v in [ts] + data_fields):
-            if any(v is not None for v in data_fields):
-                raise IncompletePositionData(
-                    'Not all expected values were present, but some were.')
-            else:
-                raise IncompletePositionData('Not a position message.')
-        cls._assert_valid_accel_fields(accel_fields)
-        accels = cls._extract_accels(accel_fields)
-        return ts, lon_semicircles, lat_semicircles, speed, accels
+    Store the decoded columns and slices of each file in a
+    ride_store.RideStore at database, using up to jobs processes.
 
-    @classmethod
-    def _field_value(cls, message, name, field_type=None):
-        try:
-            return next(
-                field.value
-                for field in message.fields
-                if field.name == name and (
-                    field_type is None or isinstance(field.value, field_type)))
-        except StopIteration:
-            return None
-
-    @classmethod
-    def _assert_valid_accel_fields(cls, accel_fields):
-        if cls._accel_field_bounds(accel_fields[0])[0] != 0:
-            raise ParseError('Acceleration fields don\'t start at 0.')
-        for f1, f2 in it.pairwise(accel_fields):
-            _, end1 = cls._accel_field_bounds(f1)
-            start2, _ = cls._accel_field_bounds(f2)
-            if start2 != end1:
-                raise ParseError('Acceleration fields aren\'t consecutive.')
-
-    @classmethod
-    def _accel_field_bounds(cls, field):
-        match = re.match(r'accel_z_(\d+)-(\d+)', field.name)
-        if not match or len(match.groups()) != 2:
-            raise ParseError(f'Invalid acceleration field name {field.name}.')
-        return int(match.group(1)), int(match.group(2))
-
-    @classmethod
-    def _extract_accels(cls, accel_fields):
-        accels = []
-        num_out_of_bounds = 0
-        reached_end = False
-        for f in accel_fields:
-            start, end = cls._accel_field_bounds(f)
-            if len(f.value) != end - start:
-                raise ParseError('Mismatched acceleration value counts.')
-            for raw_accel in f.value:
-                accel = cls._parse_raw_accel(raw_accel)
-                if accel is None:
-                    reached_end = True
-                    continue
-                elif reached_end:
-                    raise ParseError(
-                        'Encountered acceleration value after first null.')
-                if math.isinf(accel):
-                    num_out_of_bounds += 1
-                accels.append(accel)
-        if len(accels) != cls.EXPECTED_ACCEL_VALUES_PER_MESSAGE:
-            raise IncompletePositionData(
-                f'Unexpected number of acceleration values ({len(accels)}).')
-        return accels
-
-    @classmethod
-    def _parse_raw_accel(cls, raw_accel):
-        if raw_accel == -32768:
-            return None
-        if raw_accel == -32767:
-            return float('-inf')
-        if raw_accel == 32767:
-            return float('inf')
-        return raw_accel
-
-    @classmethod
-    def _adjusted_accel(cls, accel):
-        # The sensor will show -1g in idle. Add 1g to make 0 the baseline.
-        return accel + 1000
-
-    @classmethod
-    def _semicircles_to_deg(cls, semicircles):
-        return math.degrees((semicircles * math.pi) / 0x80000000)
-
-    @classmethod
-    def _check_position_continuity(cls, messages, positions):
-        start_ts, end_ts = cls._check_start_end_offsets(messages, positions)
-        intervals = []
-        interval_start_ts = None
-        for p1, p2 in it.pairwise(positions):
-            interval_start_ts = interval_start_ts or p1.ts
-            at_most_one_second_apart = (
-                p1.ts + datetime.timedelta(seconds=1) >= p2.ts)
-            if not at_most_one_second_apart:
-                intervals.append((interval_start_ts, p1.ts))
-                interval_start_ts = p2.ts
-        if interval_start_ts:
-            intervals.append((interval_start_ts, p2.ts))
-        discontinuous_durations = (
-            right_start - left_end
-            for ((_, left_end), (right_start, _)) in it.pairwise(intervals))
-        discontinuous_duration = sum(
-            discontinuous_durations, start=datetime.timedelta())
-        if discontinuous_duration:
-            discontinuous_fraction = (
-                discontinuous_duration / (end_ts - start_ts))
+    Files that were ingested before are skipped without being parsed. Never
+    imports the plotting stack. Returns a FileResult for each path.
+    """
+    store = ride_store.RideStore(database, conf)
+    results, pending = _new_files(paths, store.contains, 'ingested')
+    file_ingest = ft.partial(
+        _instrumented, _file_ingest, profile=profile, conf=conf,
+        decoder=decoder, cache=cache)
+    for (path, content_hash), (ride, error) in zip(pending, _map_in_processes(
+            file_ingest, [path for path, _ in pending], jobs)):
+        result = FileResult(path, error=error)
+        if error:
+            logger.error(f'Failed to ingest {path}.', exc_info=error)
+        elif store.add(content_hash, str(path), *ride):
             logger.info(
-                f'There are {len(intervals)-1} discontinuities totalling a '
-                f'duration of {discontinuous_duration}. This is '
-                f'{discontinuous_fraction*100:.2f}% of the total.')
+                f'Ingested {path} with {len(ride[1]["start_ns"])} slices.')
+        results.append(result)
+    store.close()
+    return results
+
+
+def _file_ingest(path, conf, decoder, cache):
+    with instrumentation.timed_stage('parse'):
+        columns = analysis.Track.read_message_columns(path, decoder, cache)
+        track = analysis.Track.from_message_columns(columns)
+    with instrumentation.timed_stage('analysis'):
+        return columns.to_arrays(), ride_store.slice_table(track, conf)
+
 
-    @classmethod
-    def _check_start_end_offsets(cls, messages, positions):
+def _new_files(paths, contains, done):
+    """
+    Return FileResults for the paths whose content hash is already
+    contained, which are skipped, and the other paths with their hashes.
+    """
+    results = []
+    pending = []
+    for path in paths:
         try:
-            start_ts, end_ts = positions[0].ts, positions[-1].ts
-            duration = end_ts - start_ts
-            messages_start_ts = next(
-                ts for ts in (
-                    cls._field_value(m, 'timestamp', datetime.datetime)
-                    for m in messages) if ts is not None)
-            messages_end_ts = next(
-                ts for ts in (
-                    cls._field_value(m, 'timestamp', datetime.datetime)
-                    for m in reversed(messages)) if ts is not None)
-        except IndexError:
-            logger.warning('No complete positions in track.')
-            return None, None
-        logger.info(
-            f'Parsed track spanning {start_ts} - {end_ts} ({duration}).')
-        start_offset = start_ts - messages_start_ts
-        end_offset = messages_end_ts - end_ts
-        if start_offset or end_offset:
-            logger.info(
-                f'Messages start {start_offset} earlier and end {end_offset} '
-                'later than positions.')
-        return start_ts, end_ts
-
-    @property
-    def positions(self):
-        return self._positions
-
-    @property
-    @ft.cache
-    def bounds(self):
-        min_lon = min_lat = float('inf')
-        max_lon = max_lat = float('-inf')
-        for p in self.positions:
-            min_lon, max_lon = min(min_lon, p.lon), max(max_lon, p.lon)
-            min_lat, max_lat = min(min_lat, p.lat), max(max_lat, p.lat)
-        return min_lon, min_lat, max_lon, max_lat
-
-    @property
-    def tss(self):
-        return [p.ts for p in self.positions]
-
-    @property
-    def accels(self):
-        return [p.accel for p in self.positions]
-
-    @property
-    def speeds_kph(self):
-        return [p.speed_kph for p in self.positions]
-
-    def rolling_average_absolute_accels(
-            self, window_duration_seconds, attenuator):
-        self.ensure_rolling_average_absolute_accels(
-            window_duration_seconds, attenuator)
-        key = (
-            'rolling_average_absolute_accels', window_duration_seconds,
-            attenuator)
-        return [p.analysis_data[key] for p in self.positions]
-
-    def ensure_rolling_average_absolute_accels(
-            self, window_duration_seconds, attenuator):
-        key = (
-            'rolling_average_absolute_accels', window_duration_seconds,
-            attenuator)
-        if not self.positions or key in self.positions[0].analysis_data:
-            return
-        window_duration = datetime.timedelta(seconds=window_duration_seconds)
-        window = collections.deque()
-        for position in self.positions:
-            window.append(position)
-            min_ts = position.ts - window_duration
-            while window[0].ts < min_ts:
-                window.popleft()
-            absolute_accel = sum(abs(p.accel) for p in window) / len(window)
-            if attenuator:
-                absolute_accel = attenuator.attenuate(
-                    absolute_accel, position.speed_kph)
-            position.analysis_data[key] = absolute_accel
-
-    def time_slices(self, duration_seconds):
-        slice_duration = datetime.timedelta(seconds=duration_seconds)
-        positions = iter(self.positions)
-        current_slice = []
-        while True:
+            content_hash = track_cache.file_hash(path)
+        except OSError as e:
+            logger.error(f'Failed to read {path}.', exc_info=e)
+            results.append(FileResult(path, error=e))
+            continue
+        if contains(content_hash):
+            logger.info(f'Skipping {path}, which was {done} before.')
+            results.append(FileResult(path))
+        else:
+            pending.append((path, content_hash))
+    return results, pending
+
+
+def _instrumented(function, path, profile, **kwargs):
+    """
+    Call function for a file, attributing its stages to the file.
+
+    With profile, writes a profile and memory summary next to the file.
+    """
+    with instrumentation.file_context(path):
+        if not profile:
+            return function(path, **kwargs)
+        with instrumentation.profiled(path.with_suffix('')):
+            return function(path, **kwargs)
+
+
+def _map_in_processes(function, items, jobs, headless=False):
+    """
+    Yield (result, error) of calling function on each item, in order.
+
+    Uses a pool of jobs processes, or the current process if jobs is 1.
+    Items are submitted ITEMS_IN_FLIGHT_PER_JOB times jobs at a time, as
+    earlier results are yielded, so neither all items' arguments nor their
+    results are held at once. If headless, worker processes render with the
+    Agg backend.
+    """
+    if jobs == 1:
+        for item in items:
             try:
-                current_duration = current_slice[-1].ts - current_slice[0].ts
-                if current_duration >= slice_duration:
-                    yield current_slice
-                    current_slice = []
-            except IndexError:
-                pass
+                yield function(item), None
+            except Exception as e:
+                yield None, e
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=_init_worker_process,
+            initargs=(headless,)) as executor:
+        items = iter(items)
+        futures = collections.deque(
+            executor.submit(function, item)
+            for item in it.islice(items, ITEMS_IN_FLIGHT_PER_JOB * jobs))
+        while futures:
+            future = futures.popleft()
+            for item in it.islice(items, 1):
+                futures.append(executor.submit(function, item))
             try:
-                current_slice.append(next(positions))
-            except StopIteration:
-                if current_slice:
-                    yield current_slice
-                return
-
-
-class MapSubplot:
-    def __init__(self, figure, gridspec, conf):
-        self.figure = figure
-        self.gridspec = gridspec
-        self.conf = conf
-        self._axes = None
-        self.projection = cartopy.crs.Mercator.GOOGLE
-        self.color_gradient = list(
-            colour.Color('green').range_to(colour.Color('red'), 101))
-        cartopy.config['cache_dir'] = (
-            pathlib.Path(__file__).parent.parent / 'cartopy_cache')
-
-    def plot(self, track):
-        self._axes = self.figure.add_subplot(
-            self.gridspec, axes_class=self._geo_axes_class_with_projection())
-        extent = self._buffered_bounds(track.bounds, 0.1)
-        self._axes.set_extent(extent, crs=self.projection.as_geodetic())
-        self._axes.add_image(
-            cartopy.io.img_tiles.OSM(desired_tile_form='L', cache=True),
-            self._zoom_level_for_extent(*extent), cmap='gray')
-        self._plot_track(track)
-        if self.conf.plot_spikes:
-            self._plot_spikes(track)
-
-    def _plot_track(self, track):
-        track.ensure_rolling_average_absolute_accels(
-            self.conf.rolling_average_window_duration_seconds,
-            self.conf.attenuator)
-        for slice in track.time_slices(self.conf.track_time_slice_seconds):
-            line = shapely.geometry.LineString((p.lon, p.lat) for p in slice)
-            att_abs_accels = [
-                p.analysis_data[(
-                    'rolling_average_absolute_accels',
-                    self.conf.rolling_average_window_duration_seconds,
-                    self.conf.attenuator)] for p in slice]
-            avg_att_abs_accel = sum(att_abs_accels) / len(att_abs_accels)
-            self._axes.add_geometries(
-                [line], self.projection.as_geodetic(), linewidth=3,
-                edgecolor=self._color_for_accel(avg_att_abs_accel),
-                facecolor='none')
-
-    def _plot_spikes(self, track):
-        spikes = []
-        for slice in track.time_slices(self.conf.spike_time_slice_seconds):
-            max_accel = max(abs(p.accel) for p in slice)
-            if max_accel >= self.conf.spike_lower_limit_millig:
-                mid = slice[len(slice) // 2]
-                spikes.append((mid.lon, mid.lat, max_accel))
-        for x, y, accel in spikes:
-            accel_over_min = accel - self.conf.spike_lower_limit_millig
-            spike_range = (
-                self.conf.spike_upper_limit_millig
-                - self.conf.spike_lower_limit_millig)
-            markersize = 5 + 10 * capped_fraction(accel_over_min, spike_range)
-            self._axes.plot(
-                x, y, 'o', markersize=markersize, color='purple', alpha=0.5,
-                transform=self.projection.as_geodetic())
-
-    def _geo_axes_class_with_projection(self):
-        # We have to create a GeoAxes class that hardcodes our desired
-        # projection because matplotlib won't let us pass a kwarg named
-        # projection through to the axes class.
-        projection = self.projection
-
-        class GeoAxes(cartopy.mpl.geoaxes.GeoAxes):
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs, projection=projection)
-
-        return GeoAxes
-
-    def _zoom_level_for_extent(self, min_lon, max_lon, min_lat, max_lat):
-        lon_fraction = (max_lon - min_lon) / 90
-        lat_fraction = (max_lat - min_lat) / 180
-        doublings = math.log2(1 / max(lon_fraction, lat_fraction))
-        # Zoom level 2 as base for the entire world.
-        base_zoom_level = 2 + self.conf.extra_zoom
-        return base_zoom_level + math.ceil(doublings)
-
-    @staticmethod
-    def _buffered_bounds(bounds, buffer_fraction):
-        min_x, min_y, max_x, max_y = bounds
-        width = max_x - min_x
-        height = max_y - min_y
-        buffer_x = width * buffer_fraction
-        buffer_y = height * buffer_fraction
-        return (
-            min_x - buffer_x, max_x + buffer_x, min_y - buffer_y,
-            max_y + buffer_y)
-
-    def _color_for_accel(self, abs_accel_millig):
-        adjusted_accel = max(
-            0, abs_accel_millig - self.conf.track_lower_limit_millig)
-        adjusted_upper_limit = (
-            self.conf.track_upper_limit_millig
-            - self.conf.track_lower_limit_millig)
-        percent_to_max = int(
-            capped_fraction(adjusted_accel, adjusted_upper_limit) * 100)
-        return self.color_gradient[percent_to_max].hex
-
-
-def analyze_files(paths, save, save_suffix, plot_separately, conf):
-    figures_with_base_paths = []
-    for path in paths:
-        track = Track.from_path(path)
-        figures_with_base_paths.extend(
-            plot_track(track, path.with_suffix(''), plot_separately, conf))
-    if save:
-        if save_suffix:
-            save_suffix = '.' + save_suffix
-        save_suffix += '.png'
-        for figure, base_path in figures_with_base_paths:
-            file_name = base_path.name + save_suffix
-            figure.savefig(base_path.parent / file_name)
-    else:
-        plt.show()
+                yield future.result(), None
+            except Exception as e:
+                yield None, e
 
 
-def plot_track(track, path, plot_separately, conf):
-    def make_figure():
-        figure = plt.figure(
-            layout='constrained', figsize=(19.2, 10.8), dpi=100)
-        figure.suptitle(f'{path}\n{conf}')
-        return figure
-
-    if plot_separately:
-        dynamics_figure, map_figure = make_figure(), make_figure()
-        figures = [(dynamics_figure, path.with_name(path.name + '.graphs')),
-                   (map_figure, path.with_name(path.name + '.map'))]
-        dynamics_specs = list(
-            dynamics_figure.add_gridspec(3, 1, height_ratios=[2, 1, 2]))
-        map_spec = map_figure.add_gridspec(1, 1)[0]
-    else:
-        figure = make_figure()
-        dynamics_figure = map_figure = figure
-        figures = [(figure, path)]
-        gridspec = figure.add_gridspec(
-            3, 2, figure=figure, height_ratios=[2, 1, 2])
-        dynamics_specs = [gridspec[0, 0:1], gridspec[1, 0:1], gridspec[2, 0:1]]
-        map_spec = gridspec[0:, 1]
-    add_dynamics_subplots(track, dynamics_figure, dynamics_specs, conf)
-    map_subplot = MapSubplot(map_figure, map_spec, conf)
-    map_subplot.plot(track)
-    return figures
-
-
-def add_dynamics_subplots(track, figure, gridspecs, conf):
-    assert len(gridspecs) == 3
-    accel_axes = figure.add_subplot(gridspecs[0])
-    speed_axes = figure.add_subplot(gridspecs[1], sharex=accel_axes)
-    accel_analysis_axes = figure.add_subplot(gridspecs[2], sharex=accel_axes)
-    accel_axes.plot(
-        track.tss, track.accels, color='black', label='Raw acceleration')
-    accel_axes.yaxis.set_label_text('mg')
-    accel_axes.hlines([
-        conf.spike_lower_limit_millig, conf.spike_upper_limit_millig,
-        -conf.spike_lower_limit_millig, -conf.spike_upper_limit_millig],
-                      track.tss[0], track.tss[-1], linestyles='dashed')
-    accel_axes.legend()
-    speed_axes.plot(track.tss, track.speeds_kph, color='black', label='Speed')
-    speed_axes.yaxis.set_label_text('km/h')
-    speed_axes.hlines([conf.attenuator.speed_cap], track.tss[0], track.tss[-1],
-                      linestyles='dashed')
-    speed_axes.legend()
-    accel_analysis_axes.plot(
-        track.tss,
-        track.rolling_average_absolute_accels(
-            conf.rolling_average_window_duration_seconds, attenuator=None),
-        color='black', label='Absolute acceleration')
-    accel_analysis_axes.plot(
-        track.tss,
-        track.rolling_average_absolute_accels(
-            conf.rolling_average_window_duration_seconds, conf.attenuator),
-        color='blue', label='Attenuated absolute acceleration')
-    accel_analysis_axes.yaxis.set_label_text('mg')
-    accel_analysis_axes.hlines([conf.track_lower_limit_millig], track.tss[0],
-                               track.tss[-1], linestyles='dashed')
-    accel_analysis_axes.hlines([conf.track_upper_limit_millig], track.tss[0],
-                               track.tss[-1], linestyles='dashed')
-    accel_analysis_axes.legend()
+def _init_worker_process(headless):
+    global logger
+    setup_logging()
+    logger = logging.getLogger(__name__)
+    if headless:
+        import matplotlib.pyplot as plt
+        plt.switch_backend('Agg')
 
 
-@dc.dataclass
-class AnalysisConfig:
-    track_time_slice_seconds: float
-    spike_time_slice_seconds: float
-    rolling_average_window_duration_seconds: float
-    track_lower_limit_millig: float
-    track_upper_limit_millig: float
-    plot_spikes: bool
-    spike_lower_limit_millig: float
-    spike_upper_limit_millig: float
-    attenuator: Attenuator
-    extra_zoom: int
-
-    def __post_init__(self):
-        try:
-            assert self.track_time_slice_seconds > 0
-            assert self.spike_time_slice_seconds > 0
-            assert self.rolling_average_window_duration_seconds > 0
-            assert (
-                self.track_lower_limit_millig < self.track_upper_limit_millig)
-            assert (
-                self.spike_lower_limit_millig < self.spike_upper_limit_millig)
-        except AssertionError as e:
-            raise ValueError('Invalid configuration.') from e
-
-    def __str__(self):
-        return '; '.join([
-            f'time slice: {self.track_time_slice_seconds}s (track)/'
-            f'{self.spike_time_slice_seconds}s (spikes)',
-            'roll. avg. lookback: '
-            f'{self.rolling_average_window_duration_seconds}s',
-            f'track range: {self.track_lower_limit_millig}mg-'
-            f'{self.track_upper_limit_millig}mg',
-            f'spike range: {self.spike_lower_limit_millig}mg-'
-            f'{self.spike_upper_limit_millig}mg',
-            f'attenuation: {self.attenuator.spec}'])
-
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('paths', nargs='+', type=pathlib.Path)
-    parser.add_argument(
-        '--save', action='store_true',
-        help='Save plots instead of showing them.')
-    parser.add_argument(
-        '--save-suffix', default='',
-        help='Suffix to add to the file when saving.')
-    parser.add_argument(
-        '--plot-separately', action='store_true',
-        help='Plot graphs and map separately.')
-    parser.add_argument(
+def parse_args(argv):
+    """
+    Parse command line arguments.
+
+    The command is optional and defaults to plot, so that
+    "analyze.py [options] <fit_file> ..." keeps working.
+    """
+    if argv and argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['plot'] + argv
+    paths_parser = argparse.ArgumentParser(add_help=False)
+    paths_parser.add_argument('paths', nargs='+', type=pathlib.Path)
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
         '--track-time-slice', type=float, default=20,
         help='Duration of chunks in seconds into which the track is sliced '
         'for continuous analysis. Metrics of these chunks are averaged and '
         'drawn as one segment on the map.')
-    parser.add_argument(
+    common_parser.add_argument(
         '--spike-time-slice', type=float, default=5,
         help='Duration of chunks in seconds into which the track is sliced '
         'for spike analysis. Only the maximum acceleration value of each '
         'chunk decides whether a spike exists for the chunk.')
-    parser.add_argument(
+    common_parser.add_argument(
         '--rolling-average-window-duration', type=float, default=10,
         help='Lookback into the past in seconds when calculating a rolling '
         'average absolute acceleration for each individual position.')
-    parser.add_argument(
+    common_parser.add_argument(
         '--track-lower-limit', type=float, default=0,
         help='Threshold for average attenuated acceleration in millig at or '
         'below which the road quality at a position is considered excellent '
         '(i.e. will be drawn green).')
-    parser.add_argument(
+    common_parser.add_argument(
         '--track-upper-limit', type=float, default=400,
         help='Lowest average attenuated acceleration in millig at which a '
         'position is considered maximally bad (i.e. will be drawn red).')
-    parser.add_argument(
-        '--no-spikes', action='store_true', help='Disable plotting of spikes.')
-    parser.add_argument(
+    common_parser.add_argument(
         '--spike-lower-limit', type=float, default=2500,
         help='Lowest acceleration in millig needed for a position to be '
         'considered a spike.')
-    parser.add_argument(
+    common_parser.add_argument(
         '--spike-upper-limit', type=float, default=3000,
         help='Lowest acceleration in millig for a spike to be considered '
         'maximally bad (i.e. largest possible circle).')
-    parser.add_argument(
-        '--attenuation', type=Attenuator, default=Attenuator('cubic,40,0.75'),
+    common_parser.add_argument(
+        '--attenuation', type=analysis.Attenuator,
+        default=analysis.Attenuator('cubic,40,0.75'),
         help='Method of speed attenuation.')
-    parser.add_argument(
+    common_parser.add_argument(
+        '--decoder', choices=analysis.DECODERS, default='native',
+        help='How to parse .fit files. The native decoder is much faster, '
+        'but only understands files written by the BumpVisualizer. It falls '
+        'back to fitparse if it encounters anything else.')
+    common_parser.add_argument(
+        '--cache-dir', type=pathlib.Path, default=DEFAULT_TRACK_CACHE_DIR,
+        help='Directory in which decoded .fit files are cached.')
+    common_parser.add_argument(
+        '--cache-max-size', type=float, default=1024,
+        help='Maximum size of the cache in MiB. The least recently used '
+        'entries are deleted when it grows larger.')
+    common_parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Always decode .fit files and stitch map tiles instead of '
+        'using the caches.')
+    common_parser.add_argument(
+        '--ride-store', type=pathlib.Path,
+        help='SQLite database written by the ingest command. Rides stored in '
+        'it are read from it instead of being decoded. Defaults to '
+        f'{DEFAULT_RIDE_STORE} for ingest.')
+    common_parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of files to analyze in parallel. 0 uses all CPUs.')
+    common_parser.add_argument(
+        '--profile', action='store_true',
+        help='Profile the analysis of each file. Writes a cProfile dump '
+        '(<name>.prof) and a summary of time and memory per stage '
+        '(<name>.memory.txt) next to each file. Figures that are shown '
+        'rather than saved are not included.')
+
+    plotting_parser = argparse.ArgumentParser(add_help=False)
+    plotting_parser.add_argument(
+        '--save-suffix', default='',
+        help='Suffix to add to the file when saving.')
+    plotting_parser.add_argument(
+        '--plot-separately', action='store_true',
+        help='Plot graphs and map separately.')
+    plotting_parser.add_argument(
+        '--no-spikes', action='store_true', help='Disable plotting of spikes.')
+    plotting_parser.add_argument(
         '--extra-zoom', type=int, default=0,
         help='Extra zoom level for map tiles with higher resolution.')
-    args = parser.parse_args()
+    plotting_parser.add_argument(
+        '--max-tiles', type=int, default=analysis.DEFAULT_MAX_TILES,
+        help='Maximum number of map tiles to draw for one map. The zoom level '
+        'is reduced until the map fits.')
+    plotting_parser.add_argument(
+        '--decimation', choices=decimation.METHODS,
+        default=decimation.DEFAULT_METHOD,
+        help='How the graphs pick the samples to draw, about two per pixel. '
+        'minmax keeps every spike, lttb keeps the shape with fewer points, '
+        'none draws all samples.')
+    plotting_parser.add_argument(
+        '--split-map', action='store_true',
+        help='If the zoom level had to be reduced to fit --max-tiles, '
+        'additionally plot the map split into pages at full zoom.')
+    plotting_parser.add_argument(
+        '--tiles', type=tiles.TileSourceSpec.parse,
+        default=tiles.TileSourceSpec('osm'),
+        help='Where to get map tiles from: osm (download from '
+        'OpenStreetMap), mbtiles:<path> (an MBTiles file) or dir:<template> '
+        '(files named by a template like tiles/{z}/{x}/{y}.png). Local '
+        'sources can be filled with src/tiles.py.')
+    plotting_parser.add_argument(
+        '--basemap-cache-dir', type=pathlib.Path,
+        default=DEFAULT_BASEMAP_CACHE_DIR,
+        help='Directory in which maps stitched from tiles are cached.')
+    plotting_parser.add_argument(
+        '--basemap-cache-max-size', type=float, default=256,
+        help='Maximum size of the map cache in MiB.')
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    plot_parser = subparsers.add_parser(
+        'plot', parents=[paths_parser, common_parser, plotting_parser],
+        help='Plot graphs and a map of each file (the default).')
+    plot_parser.add_argument(
+        '--save', action='store_true',
+        help='Save plots instead of showing them.')
+    non_plotting_defaults = {
+        'no_spikes': False, 'extra_zoom': 0,
+        'max_tiles': analysis.DEFAULT_MAX_TILES, 'split_map': False,
+        'decimation': decimation.DEFAULT_METHOD}
+    stats_parser = subparsers.add_parser(
+        'stats', parents=[paths_parser, common_parser],
+        help='Print a summary of each file\'s analysis as a line of JSON, '
+        'without plotting.')
+    stats_parser.set_defaults(**non_plotting_defaults)
+    export_parser = subparsers.add_parser(
+        'export', parents=[paths_parser, common_parser],
+        help='Export per-sample and per-slice analysis to files, without '
+        'plotting.')
+    export_parser.add_argument(
+        '--format', choices=export.FORMATS, default='csv',
+        help='File format to export to. Parquet requires pyarrow.')
+    export_parser.add_argument(
+        '--output-dir', type=pathlib.Path,
+        help='Directory to write files to, instead of next to the input '
+        'files.')
+    export_parser.set_defaults(**non_plotting_defaults)
+    aggregate_parser = subparsers.add_parser(
+        'aggregate', parents=[paths_parser, common_parser],
+        help='Merge the road quality of each file into a database of '
+        'statistics per map cell, without plotting.')
+    aggregate_parser.add_argument(
+        '--database', type=pathlib.Path,
+        default=DEFAULT_ROAD_QUALITY_DATABASE,
+        help='SQLite database to merge into. Query it with '
+        'src/aggregation.py.')
+    aggregate_parser.add_argument(
+        '--cell-zoom', type=int,
+        help='Zoom level of the Web Mercator tiles used as cells, fixed when '
+        f'the database is created. Defaults to '
+        f'{aggregation.DEFAULT_CELL_ZOOM} for new databases.')
+    aggregate_parser.set_defaults(**non_plotting_defaults)
+    hotspots_parser = subparsers.add_parser(
+        'hotspots', parents=[paths_parser, common_parser],
+        help='Cluster the spikes of each file with those of other rides in '
+        'a database of hotspots, without plotting.')
+    hotspots_parser.add_argument(
+        '--database', type=pathlib.Path, default=DEFAULT_HOTSPOT_DATABASE,
+        help='SQLite database to merge into. Query it with src/hotspots.py.')
+    hotspots_parser.add_argument(
+        '--cluster-radius', type=float,
+        help='Distance in metres within which spikes belong to the same '
+        'hotspot, fixed when the database is created. Defaults to '
+        f'{hotspots.DEFAULT_CLUSTER_RADIUS_M} for new databases.')
+    hotspots_parser.set_defaults(**non_plotting_defaults)
+    heatmap_parser = subparsers.add_parser(
+        'heatmap', parents=[paths_parser, common_parser, plotting_parser],
+        help='Merge the road quality of each file into a raster of pixels '
+        'across all rides and plot it over the map.')
+    heatmap_parser.add_argument(
+        '--raster', type=pathlib.Path, default=DEFAULT_HEATMAP_RASTER,
+        help='.npz file holding the raster to merge into.')
+    heatmap_parser.add_argument(
+        '--heatmap-zoom', type=int,
+        help='Zoom level of the Web Mercator tiles whose pixels the raster '
+        f'consists of, at most {heatmap.MAX_ZOOM} and fixed when the raster '
+        f'is created. Defaults to {heatmap.DEFAULT_ZOOM} for new rasters.')
+    heatmap_parser.add_argument(
+        '--save', action='store_true',
+        help='Save the plot next to the raster instead of showing it.')
+    pyramid_parser = subparsers.add_parser(
+        'pyramid', parents=[paths_parser, common_parser],
+        help='Add each file to a pyramid of map tiles showing road quality, '
+        'for maps in a browser, and render the tiles they cover.')
+    pyramid_parser.add_argument(
+        '--output-dir', type=pathlib.Path, default=DEFAULT_TILE_PYRAMID_DIR,
+        help='Directory of the pyramid, to which tiles are written as '
+        '{z}/{x}/{y}.png.')
+    pyramid_parser.add_argument(
+        '--zoom', type=tiles.parse_zoom_levels,
+        help='Zoom level or range of zoom levels to render, fixed when the '
+        'pyramid is created. Defaults to '
+        f'{tile_pyramid.DEFAULT_ZOOM_LEVELS.start}-'
+        f'{tile_pyramid.DEFAULT_ZOOM_LEVELS.stop - 1} for new pyramids.')
+    pyramid_parser.set_defaults(**non_plotting_defaults)
+    ingest_parser = subparsers.add_parser(
+        'ingest', parents=[paths_parser, common_parser],
+        help='Store the decoded samples and the slices of each file in a '
+        'database of rides, without plotting. Query it with '
+        'src/ride_store.py.')
+    ingest_parser.set_defaults(**non_plotting_defaults)
+    watch_parser = subparsers.add_parser(
+        'watch', parents=[common_parser, plotting_parser],
+        help='Analyze, plot and save .fit files as they appear in a '
+        'directory, until interrupted.')
+    watch_parser.add_argument('directory', type=pathlib.Path)
+    watch_parser.add_argument(
+        '--manifest', type=pathlib.Path,
+        help='JSON file recording which files were processed, so they are '
+        f'skipped after a restart. Defaults to {watch.MANIFEST_NAME} in the '
+        'watched directory.')
+    watch_parser.add_argument(
+        '--settle-time', type=float, default=watch.DEFAULT_SETTLE_SECONDS,
+        help='Seconds a file\'s size and modification time must stay the '
+        'same before it is analyzed, so files that are still being written '
+        'are left alone.')
+    watch_parser.add_argument(
+        '--poll-interval', type=float,
+        default=watch.DEFAULT_POLL_INTERVAL_SECONDS,
+        help='Seconds between scans of the directory.')
+    args = parser.parse_args(argv)
+    if (args.command != 'ingest' and args.ride_store
+            and not args.ride_store.exists()):
+        parser.error(f'No ride store at {args.ride_store}.')
+    if (args.command == 'heatmap' and args.heatmap_zoom is not None
+            and not 0 <= args.heatmap_zoom <= heatmap.MAX_ZOOM):
+        parser.error(
+            f'--heatmap-zoom must be between 0 and {heatmap.MAX_ZOOM}.')
+    if args.command == 'watch':
+        return args
     if {p.suffix for p in args.paths} != {'.fit'}:
         raise ValueError(
             f'One of {args.paths} doesn\'t look like a .fit file.')
-    analysis_config = AnalysisConfig(
+    return args
+
+
+def check_startup_time():
+    """
+    Warn if startup of a command that doesn't plot was too slow.
+
+    Checks the time since START_TIME against
+    NON_PLOTTING_STARTUP_BUDGET_SECONDS and that no plotting module has been
+    imported.
+    """
+    startup_seconds = time.perf_counter() - START_TIME
+    plotting_modules = [m for m in PLOTTING_MODULES if m in sys.modules]
+    if plotting_modules:
+        logger.warning(
+            f'Plotting modules {plotting_modules} were imported although '
+            'nothing is plotted.')
+    if startup_seconds > NON_PLOTTING_STARTUP_BUDGET_SECONDS:
+        logger.warning(
+            f'Startup took {startup_seconds:.3f}s, which is more than the '
+            f'budget of {NON_PLOTTING_STARTUP_BUDGET_SECONDS}s.')
+    else:
+        logger.debug(f'Startup took {startup_seconds:.3f}s.')
+
+
+def _basemap_cache(args):
+    if args.no_cache:
+        return None
+    import plotting
+    return track_cache.ArrayCache(
+        args.basemap_cache_dir, plotting.BASEMAP_CACHE_VERSION,
+        int(args.basemap_cache_max_size * 2**20))
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command not in ('plot', 'heatmap', 'watch'):
+        check_startup_time()
+    analysis_config = analysis.AnalysisConfig(
         args.track_time_slice, args.spike_time_slice,
         args.rolling_average_window_duration, args.track_lower_limit,
         args.track_upper_limit, not args.no_spikes, args.spike_lower_limit,
-        args.spike_upper_limit, args.attenuation, args.extra_zoom)
-    analyze_files(
-        args.paths, save=args.save, save_suffix=args.save_suffix,
-        plot_separately=args.plot_separately, conf=analysis_config)
+        args.spike_upper_limit, args.attenuation, args.extra_zoom,
+        args.max_tiles, args.split_map, args.decimation)
+    cache = None
+    if not args.no_cache:
+        cache = track_cache.TrackCache(
+            args.cache_dir, analysis.Track.CACHE_VERSION,
+            int(args.cache_max_size * 2**20))
+    if args.command == 'ingest':
+        ride_store_path = args.ride_store or DEFAULT_RIDE_STORE
+    elif args.ride_store:
+        cache = ride_store.RideStoreCache(args.ride_store, cache)
+    jobs = args.jobs or os.cpu_count()
+    if args.command == 'watch':
+        watch_directory(
+            args.directory, save_suffix=args.save_suffix,
+            plot_separately=args.plot_separately, conf=analysis_config,
+            decoder=args.decoder, cache=cache, jobs=jobs,
+            profile=args.profile, tile_source=args.tiles,
+            basemap_cache=_basemap_cache(args), manifest_path=args.manifest,
+            settle_seconds=args.settle_time,
+            poll_interval_seconds=args.poll_interval)
+        return
+    if args.command == 'aggregate':
+        results = aggregate_files(
+            args.paths, analysis_config, args.database,
+            cell_zoom=args.cell_zoom, decoder=args.decoder, cache=cache,
+            jobs=jobs, profile=args.profile)
+    elif args.command == 'hotspots':
+        results = cluster_files(
+            args.paths, analysis_config, args.database,
+            cluster_radius_m=args.cluster_radius, decoder=args.decoder,
+            cache=cache, jobs=jobs, profile=args.profile)
+    elif args.command == 'heatmap':
+        results = heatmap_files(
+            args.paths, analysis_config, args.raster,
+            zoom=args.heatmap_zoom, save=args.save,
+            save_suffix=args.save_suffix, decoder=args.decoder, cache=cache,
+            jobs=jobs, profile=args.profile, tile_source=args.tiles,
+            basemap_cache=_basemap_cache(args))
+    elif args.command == 'pyramid':
+        results = pyramid_files(
+            args.paths, analysis_config, args.output_dir,
+            zoom_levels=args.zoom, decoder=args.decoder, cache=cache,
+            jobs=jobs, profile=args.profile)
+    elif args.command == 'ingest':
+        results = ingest_files(
+            args.paths, analysis_config, ride_store_path,
+            decoder=args.decoder, cache=cache, jobs=jobs,
+            profile=args.profile)
+    elif args.command == 'stats':
+        results = stats_files(
+            args.paths, analysis_config, decoder=args.decoder, cache=cache,
+            jobs=jobs, profile=args.profile)
+    elif args.command == 'export':
+        results = export_files(
+            args.paths, analysis_config, args.format,
+            output_dir=args.output_dir, decoder=args.decoder, cache=cache,
+            jobs=jobs, profile=args.profile)
+    else:
+        results = analyze_files(
+            args.paths, save=args.save, save_suffix=args.save_suffix,
+            plot_separately=args.plot_separately, conf=analysis_config,
+            decoder=args.decoder, cache=cache, jobs=jobs,
+            profile=args.profile, tile_source=args.tiles,
+            basemap_cache=_basemap_cache(args))
+    num_failed = sum(1 for result in results if result.error)
+    if num_failed:
+        raise SystemExit(
+            f'Failed to analyze {num_failed} of {len(results)} files.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,344 @@
+"""
+Benchmarks of the stages of analyzing and plotting rides.
+
+Rides are synthetic (see fit_generator) and map tiles are blank images
+generated locally, so benchmarks run offline. For single rides of several
+lengths, the wall time and peak memory of parsing, computing rolling
+averages, slicing, plotting and saving figures are measured. For a batch of
+rides, parsing and analysis are measured over all files.
+
+Results are stored as JSON and two runs can be compared to flag regressions:
+    python src/benchmark.py run [options] <results.json>
+    python src/benchmark.py compare <baseline.json> <results.json>
+"""
+import argparse
+import dataclasses as dc
+import datetime
+import io
+import json
+import logging
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import analysis
+import fit_generator
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RIDE_HOURS = (1, 6, 24)
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_RIDE_MINUTES = 60
+DEFAULT_REPEAT = 3
+# Relative slowdown or memory growth that counts as a regression.
+DEFAULT_THRESHOLD = 0.2
+# Differences below these are considered noise.
+MIN_SECONDS_DIFFERENCE = 0.01
+MIN_MEMORY_DIFFERENCE_BYTES = 1 << 20
+
+
+@dc.dataclass
+class StageResult:
+    """Wall times of all repetitions of a stage and its peak memory."""
+    seconds: list
+    peak_memory_bytes: int
+
+    @property
+    def best_seconds(self):
+        return min(self.seconds)
+
+
+def default_config():
+    return analysis.AnalysisConfig(
+        20, 5, 10, 0, 400, True, 2500, 3000,
+        analysis.Attenuator('cubic,40,0.75'), 0)
+
+
+def run_benchmarks(
+        data_dir, ride_hours=DEFAULT_RIDE_HOURS, batch_size=DEFAULT_BATCH_SIZE,
+        batch_ride_minutes=DEFAULT_BATCH_RIDE_MINUTES, repeat=DEFAULT_REPEAT,
+        render=True):
+    """
+    Run all benchmarks and return the results as a JSON-serializable dict.
+
+    Rides are generated into data_dir unless they already exist there.
+    """
+    conf = default_config()
+    cases = {}
+    for hours in ride_hours:
+        path = _generated_ride(data_dir, hours * 3600, seed=0)
+        cases[f'ride_{hours}h'] = _run_case(
+            _ride_stages(path, conf, render), repeat)
+    if batch_size:
+        paths = [
+            _generated_ride(data_dir, batch_ride_minutes * 60, seed=seed)
+            for seed in range(batch_size)]
+        cases[f'batch_{batch_size}x{batch_ride_minutes}min'] = _run_case(
+            _batch_stages(paths, conf), repeat)
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'cases': {
+            case: {
+                stage: dc.asdict(result) for stage, result in stages.items()}
+            for case, stages in cases.items()},
+    }
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two results of run_benchmarks().
+
+    Returns a list of (case, stage, metric, baseline value, current value)
+    for each stage in both that got slower or used more memory by more than
+    threshold (relative) and more than the noise floor (absolute), as well as
+    lines describing all stages for display.
+    """
+    regressions = []
+    lines = []
+    for case, stages in current['cases'].items():
+        for stage, result in stages.items():
+            try:
+                baseline_result = baseline['cases'][case][stage]
+            except KeyError:
+                lines.append(f'{case}/{stage}: not in baseline')
+                continue
+            metrics = [
+                ('seconds', min(baseline_result['seconds']),
+                 min(result['seconds']), MIN_SECONDS_DIFFERENCE),
+                ('peak_memory_bytes', baseline_result['peak_memory_bytes'],
+                 result['peak_memory_bytes'], MIN_MEMORY_DIFFERENCE_BYTES),
+            ]
+            descriptions = []
+            for metric, old, new, min_difference in metrics:
+                ratio = new / old if old else float('inf')
+                regressed = (
+                    new - old > min_difference and ratio > 1 + threshold)
+                if regressed:
+                    regressions.append((case, stage, metric, old, new))
+                descriptions.append(
+                    f'{metric} {_format_metric(metric, old)} -> '
+                    f'{_format_metric(metric, new)} ({ratio:.2f}x)'
+                    + (' REGRESSION' if regressed else ''))
+            lines.append(f'{case}/{stage}: {"; ".join(descriptions)}')
+    return regressions, lines
+
+
+def _format_metric(metric, value):
+    if metric == 'seconds':
+        return f'{value:.3f}s'
+    return f'{value / 2**20:.1f}MiB'
+
+
+def _generated_ride(data_dir, duration_seconds, seed):
+    path = data_dir / f'ride-{duration_seconds}s-{seed}.fit'
+    if not path.exists():
+        fit_generator.write(path, fit_generator.RideSpec(
+            duration_seconds=duration_seconds, seed=seed,
+            gaps=((duration_seconds // 2, duration_seconds // 2 + 30),)))
+        logger.info(f'Generated {path}.')
+    return path
+
+
+def _ride_stages(path, conf, render):
+    """
+    Return (name, function) of each stage of analyzing and plotting a ride.
+
+    Each function takes a dict of state, in which it finds the results of
+    previous stages and stores its own.
+    """
+    def parse(state):
+        state['track'] = analysis.Track.from_path(path, 'native', cache=None)
+
+    def rolling_averages(state):
+        state['track'].ensure_rolling_average_absolute_accels_for_all(
+            conf.rolling_average_window_duration_seconds,
+            [None, conf.attenuator])
+
+    def time_slices(state):
+        for duration in [
+                conf.track_time_slice_seconds, conf.spike_time_slice_seconds]:
+            for _ in state['track'].time_slices(duration):
+                pass
+
+    def dynamics_plot(state):
+        import matplotlib.pyplot as plt
+        import plotting
+        figure = plt.figure(
+            layout='constrained', figsize=(19.2, 10.8), dpi=100)
+        gridspec = figure.add_gridspec(3, 2, height_ratios=[2, 1, 2])
+        plotting.add_dynamics_subplots(
+            state['track'], figure,
+            [gridspec[0, 0:1], gridspec[1, 0:1], gridspec[2, 0:1]], conf)
+        state['figure'] = figure
+        state['map_spec'] = gridspec[0:, 1]
+
+    def map_plot(state):
+        import plotting
+        plotting.MapSubplot(
+            state['figure'], state['map_spec'], conf,
+            _blank_tile_source()).plot(state['track'])
+
+    def savefig(state):
+        import matplotlib.pyplot as plt
+        state['figure'].savefig(io.BytesIO(), format='png')
+        plt.close(state['figure'])
+
+    stages = [
+        ('parse', parse), ('rolling_averages', rolling_averages),
+        ('time_slices', time_slices)]
+    if render:
+        _use_headless_backend()
+        stages += [
+            ('dynamics_plot', dynamics_plot), ('map_plot', map_plot),
+            ('savefig', savefig)]
+    return stages
+
+
+def _batch_stages(paths, conf):
+    def parse(state):
+        state['tracks'] = [
+            analysis.Track.from_path(path, 'native', cache=None)
+            for path in paths]
+
+    def analyze(state):
+        for track in state['tracks']:
+            track.summary(conf)
+
+    return [('parse', parse), ('analyze', analyze)]
+
+
+def _run_case(stages, repeat):
+    """
+    Run stages repeat times for wall times, then once more for memory.
+
+    Memory is traced in a separate run, since tracing slows down allocations
+    considerably.
+    """
+    seconds = {name: [] for name, _ in stages}
+    for _ in range(repeat):
+        state = {}
+        for name, stage in stages:
+            start = time.perf_counter()
+            stage(state)
+            seconds[name].append(time.perf_counter() - start)
+    peak_memory = {}
+    state = {}
+    tracemalloc.start()
+    try:
+        for name, stage in stages:
+            tracemalloc.reset_peak()
+            start_memory, _ = tracemalloc.get_traced_memory()
+            stage(state)
+            _, peak = tracemalloc.get_traced_memory()
+            peak_memory[name] = peak - start_memory
+    finally:
+        tracemalloc.stop()
+    results = {
+        name: StageResult(seconds[name], peak_memory[name])
+        for name, _ in stages}
+    for name, result in results.items():
+        logger.info(
+            f'{name}: {result.best_seconds:.3f}s, '
+            f'{_format_metric("peak_memory_bytes", result.peak_memory_bytes)}')
+    return results
+
+
+def _use_headless_backend():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _blank_tile_source():
+    import cartopy.io.img_tiles
+    import PIL.Image
+
+    class BlankTiles(cartopy.io.img_tiles.GoogleWTS):
+        """Serves uniformly gray tiles without any network access."""
+
+        def get_image(self, tile):
+            image = PIL.Image.new('L', (256, 256), 200)
+            return image, self.tileextent(tile), 'lower'
+
+        def _image_url(self, tile):
+            x, y, z = tile
+            return f'blank:{z}/{x}/{y}'
+
+    return BlankTiles(desired_tile_form='L')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark parsing, analysis and plotting of rides.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser(
+        'run', help='Run benchmarks and store the results as JSON.')
+    run_parser.add_argument('output', type=pathlib.Path)
+    run_parser.add_argument(
+        '--ride-hours', type=int, nargs='*', default=DEFAULT_RIDE_HOURS,
+        help='Durations of single rides to benchmark, in hours.')
+    run_parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help='Number of rides in the batch benchmark. 0 disables it.')
+    run_parser.add_argument(
+        '--batch-ride-minutes', type=int, default=DEFAULT_BATCH_RIDE_MINUTES,
+        help='Duration of each ride in the batch benchmark, in minutes.')
+    run_parser.add_argument(
+        '--repeat', type=int, default=DEFAULT_REPEAT,
+        help='Number of timed runs of each stage. The fastest one counts.')
+    run_parser.add_argument(
+        '--no-render', action='store_true',
+        help='Skip plotting and saving figures.')
+    run_parser.add_argument(
+        '--data-dir', type=pathlib.Path,
+        help='Directory in which generated rides are kept between runs. By '
+        'default, they are generated into a temporary directory.')
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two results and flag regressions.')
+    compare_parser.add_argument('baseline', type=pathlib.Path)
+    compare_parser.add_argument('current', type=pathlib.Path)
+    compare_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='Relative increase in time or memory that is flagged as a '
+        'regression.')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions, lines = compare_results(
+            baseline, current, args.threshold)
+        print('\n'.join(lines))
+        if regressions:
+            sys.exit(f'{len(regressions)} regressions.')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or pathlib.Path(temp_dir)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(
+            data_dir, args.ride_hours, args.batch_size,
+            args.batch_ride_minutes, args.repeat, not args.no_render)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    logger.info(f'Saved results to {args.output}.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # Parsing logs a summary and stage times of every track, which would
+    # drown the results.
+    logging.getLogger(analysis.__name__).setLevel(logging.WARNING)
+    logging.getLogger(instrumentation.__name__).setLevel(logging.WARNING)
+    main()
@@ -0,0 +1,48 @@
+"""
+Colors of road quality, shared by plots and map tiles.
+
+Average attenuated accelerations are mapped onto a gradient of 101 colors,
+from green at or below the track lower limit to red at or above the track
+upper limit.
+"""
+import functools as ft
+
+import numpy as np
+
+import analysis
+
+
+@ft.cache
+def color_gradient():
+    """Return the gradient as colour.Color objects."""
+    # Imported here, as commands that don't draw anything shouldn't import
+    # plotting modules.
+    import colour
+    return list(colour.Color('green').range_to(colour.Color('red'), 101))
+
+
+@ft.cache
+def color_lut():
+    """Return the gradient as RGBA rows of floats from 0 to 1."""
+    return np.array([
+        [*bytes.fromhex(color.hex_l[1:]), 255]
+        for color in color_gradient()]) / 255
+
+
+def gradient_indices(abs_accels_millig, conf):
+    """
+    Return the indices into the gradient of accelerations, given the track
+    limits of an AnalysisConfig.
+    """
+    adjusted_accels = np.maximum(
+        0, abs_accels_millig - conf.track_lower_limit_millig)
+    adjusted_upper_limit = (
+        conf.track_upper_limit_millig - conf.track_lower_limit_millig)
+    percents_to_max = analysis.capped_fraction(
+        adjusted_accels, adjusted_upper_limit) * 100
+    return percents_to_max.astype(int)
+
+
+def colors_for_accels(abs_accels_millig, conf):
+    """Return RGBA colors for an array of accelerations."""
+    return color_lut()[gradient_indices(abs_accels_millig, conf)]
@@ -0,0 +1,92 @@
+"""
+Decimation of long series for plotting.
+
+A ride recorded at 25 Hz has far more samples than a graph has pixels. The
+methods here choose a subset of at most about num_points samples to draw:
+    minmax  The minimum and maximum of each of num_points / 2 buckets of
+            consecutive samples. Keeps every spike, which is what the
+            acceleration graphs are about.
+    lttb    Largest-Triangle-Three-Buckets, which picks the sample of each
+            bucket forming the largest triangle with its neighbours. Keeps the
+            visual shape with fewer points, but may drop spikes next to
+            larger ones.
+    none    All samples.
+"""
+import numpy as np
+
+METHODS = ('minmax', 'lttb', 'none')
+DEFAULT_METHOD = 'minmax'
+
+
+def decimate(xs, ys, num_points, method=DEFAULT_METHOD):
+    """
+    Return the sorted indices of the samples to draw of the series xs, ys.
+
+    xs must be increasing. The first and last sample are always included.
+    """
+    if method == 'minmax':
+        return min_max(ys, num_points)
+    if method == 'lttb':
+        return lttb(xs, ys, num_points)
+    if method == 'none':
+        return np.arange(len(ys))
+    raise ValueError(f'Unknown decimation method "{method}".')
+
+
+def min_max(ys, num_points):
+    """
+    Return the indices of the minimum and maximum of each of num_points / 2
+    buckets of equally many consecutive samples, plus the first and last one.
+    """
+    num_samples = len(ys)
+    if num_samples <= max(num_points, 2):
+        return np.arange(num_samples)
+    bucket_size = -(-num_samples // max(num_points // 2, 1))
+    num_buckets = -(-num_samples // bucket_size)
+    # Padding with the last value lets all buckets be rows of one view. Indices
+    # into the padding are clipped to the last sample, which is its value.
+    buckets = np.pad(
+        ys, (0, num_buckets * bucket_size - num_samples), mode='edge'
+    ).reshape(num_buckets, bucket_size)
+    offsets = np.arange(0, num_buckets * bucket_size, bucket_size)
+    indices = np.concatenate((
+        [0, num_samples - 1],
+        np.minimum(offsets + buckets.argmin(axis=1), num_samples - 1),
+        np.minimum(offsets + buckets.argmax(axis=1), num_samples - 1)))
+    return np.unique(indices)
+
+
+def lttb(xs, ys, num_points):
+    """
+    Return the indices of num_points samples chosen by
+    Largest-Triangle-Three-Buckets.
+    """
+    num_samples = len(ys)
+    if num_samples <= max(num_points, 3) or num_points < 3:
+        return np.arange(num_samples)
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    # The first and last sample form buckets of their own, the others are
+    # split into num_points - 2 buckets.
+    edges = np.linspace(1, num_samples - 1, num_points - 1).astype(np.intp)
+    counts = np.diff(edges)
+    mean_xs = np.add.reduceat(xs[:-1], edges[:-1]) / counts
+    mean_ys = np.add.reduceat(ys[:-1], edges[:-1]) / counts
+    mean_xs = np.append(mean_xs[1:], xs[-1])
+    mean_ys = np.append(mean_ys[1:], ys[-1])
+    indices = np.empty(num_points, dtype=np.intp)
+    indices[0], indices[-1] = 0, num_samples - 1
+    previous = 0
+    # Saturated samples are infinite, which makes areas NaN. argmax() picks
+    # those, so saturated samples are kept.
+    with np.errstate(invalid='ignore'):
+        for i, (start, stop) in enumerate(zip(edges[:-1], edges[1:])):
+            # Twice the area of the triangles between the previously chosen
+            # sample, each candidate and the mean of the next bucket.
+            areas = np.abs(
+                (xs[previous] - mean_xs[i]) * (ys[start:stop] - ys[previous])
+                - (xs[previous] - xs[start:stop])
+                * (mean_ys[i] - ys[previous]))
+            previous = start + np.argmax(areas)
+            indices[i + 1] = previous
+    return indices
@@ -0,0 +1,213 @@
+"""
+Export of analysis results to CSV, Parquet or GeoJSON.
+
+Two tables are written per track: one row per sample (timestamp, position,
+speed, acceleration and rolling averages) and one row per track slice (its
+geometry and aggregated accelerations). Rows are written in chunks that are
+views into the track's columns, so exporting a long ride never holds a second
+full copy of them in memory.
+
+Parquet export requires pyarrow, which is imported only when needed.
+"""
+import csv
+import json
+import math
+
+import numpy as np
+
+FORMATS = ('csv', 'parquet', 'geojson')
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'geojson': '.geojson'}
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+SAMPLE_COLUMNS = (
+    'ts', 'lon', 'lat', 'speed_kph', 'accel_millig',
+    'rolling_average_abs_accel_millig',
+    'attenuated_rolling_average_abs_accel_millig')
+SLICE_COLUMNS = (
+    'start', 'end', 'num_positions', 'mean_attenuated_accel_millig',
+    'max_abs_accel_millig', 'geometry')
+
+
+def export_track(track, conf, base_path, fmt, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write the samples and slices of an analyzed track in format fmt.
+
+    Files are named after base_path with suffixes .samples and .slices plus
+    the format's extension. Returns the paths of the written files.
+    """
+    try:
+        write_table = _WRITERS[fmt]
+    except KeyError:
+        raise ValueError(f'Unknown export format "{fmt}".') from None
+    tables = [
+        ('samples', SAMPLE_COLUMNS, sample_chunks),
+        ('slices', SLICE_COLUMNS, slice_chunks)]
+    paths = []
+    for name, columns, chunks in tables:
+        path = base_path.parent / (
+            f'{base_path.name}.{name}{EXTENSIONS[fmt]}')
+        write_table(path, columns, chunks(track, conf, chunk_size))
+        paths.append(path)
+    return paths
+
+
+def sample_chunks(track, conf, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the per-sample table in chunks of at most chunk_size rows.
+
+    Each chunk is a dict mapping SAMPLE_COLUMNS to arrays. Timestamps are
+    datetime64[ns], geometry is given by lon and lat.
+    """
+    abs_accels, att_abs_accels = (
+        track.rolling_average_absolute_accels_for_all(
+            conf.rolling_average_window_duration_seconds,
+            [None, conf.attenuator]))
+    columns = (
+        track.tss, track.lons, track.lats, track.speeds_kph, track.accels,
+        abs_accels, att_abs_accels)
+    for start in range(0, len(track), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        yield {
+            name: column[chunk]
+            for name, column in zip(SAMPLE_COLUMNS, columns)}
+
+
+def slice_chunks(track, conf, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the per-slice table in chunks of at most chunk_size rows.
+
+    Slices are those drawn on the map, i.e. track.slice_bounds() for the
+    configured track time slice. Each chunk is a dict mapping SLICE_COLUMNS to
+    arrays, except geometry, which is a list of (n, 2) arrays of the
+    longitudes and latitudes of each slice's positions.
+    """
+    if not len(track):
+        return
+    att_abs_accels = track.rolling_average_absolute_accels(
+        conf.rolling_average_window_duration_seconds, conf.attenuator)
+    starts, stops = track.slice_bounds(conf.track_time_slice_seconds)
+    mean_att_abs_accels = track.slice_means(
+        conf.track_time_slice_seconds, att_abs_accels)
+    max_abs_accels = np.maximum.reduceat(np.abs(track.accels), starts)
+    for first in range(0, len(starts), chunk_size):
+        chunk = slice(first, first + chunk_size)
+        chunk_starts, chunk_stops = starts[chunk], stops[chunk]
+        yield {
+            'start': track.tss[chunk_starts],
+            'end': track.tss[chunk_stops - 1],
+            'num_positions': chunk_stops - chunk_starts,
+            'mean_attenuated_accel_millig': mean_att_abs_accels[chunk],
+            'max_abs_accel_millig': max_abs_accels[chunk],
+            'geometry': [
+                np.column_stack((track.lons[start:stop],
+                                 track.lats[start:stop]))
+                for start, stop in zip(chunk_starts, chunk_stops)],
+        }
+
+
+def _wkt(coords):
+    points = ', '.join(f'{lon!r} {lat!r}' for lon, lat in coords.tolist())
+    if len(coords) == 1:
+        return f'POINT ({points})'
+    return f'LINESTRING ({points})'
+
+
+def _geojson_geometry(coords):
+    if len(coords) == 1:
+        return {'type': 'Point', 'coordinates': coords[0].tolist()}
+    return {'type': 'LineString', 'coordinates': coords.tolist()}
+
+
+def _json_value(value):
+    # JSON has no infinity, which saturated accelerations may produce.
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _plain_columns(chunk):
+    """
+    Convert a chunk to lists of Python values, with timestamps as strings.
+    """
+    columns = {}
+    for name, values in chunk.items():
+        if name == 'geometry':
+            columns[name] = values
+        elif np.issubdtype(values.dtype, np.datetime64):
+            columns[name] = np.datetime_as_string(values, unit='ms').tolist()
+        else:
+            columns[name] = values.tolist()
+    return columns
+
+
+def _write_csv(path, column_names, chunks):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(column_names)
+        for chunk in chunks:
+            columns = _plain_columns(chunk)
+            if 'geometry' in columns:
+                columns['geometry'] = list(map(_wkt, columns['geometry']))
+            writer.writerows(zip(*(columns[name] for name in column_names)))
+
+
+def _write_geojson(path, column_names, chunks):
+    # Written piecewise rather than with a single json.dump, so only one
+    # chunk of features exists at a time.
+    property_names = [
+        name for name in column_names
+        if name not in ('lon', 'lat', 'geometry')]
+    with open(path, 'w') as file:
+        file.write('{"type": "FeatureCollection", "features": [')
+        separator = '\n'
+        for chunk in chunks:
+            columns = _plain_columns(chunk)
+            if 'geometry' in columns:
+                geometries = map(_geojson_geometry, columns['geometry'])
+            else:
+                geometries = (
+                    {'type': 'Point', 'coordinates': [lon, lat]}
+                    for lon, lat in zip(columns['lon'], columns['lat']))
+            properties = zip(*(columns[name] for name in property_names))
+            for geometry, values in zip(geometries, properties):
+                file.write(separator)
+                file.write(json.dumps({
+                    'type': 'Feature', 'geometry': geometry,
+                    'properties': {
+                        name: _json_value(value)
+                        for name, value in zip(property_names, values)},
+                }))
+                separator = ',\n'
+        file.write('\n]}\n')
+
+
+def _write_parquet(path, column_names, chunks):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError('Exporting to Parquet requires pyarrow.') from e
+    writer = None
+    try:
+        for chunk in chunks:
+            arrays = [
+                pa.array(list(map(_wkt, chunk[name])))
+                if name == 'geometry' else pa.array(chunk[name])
+                for name in column_names]
+            batch = pa.RecordBatch.from_arrays(arrays, names=column_names)
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema)
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # No chunks, so there's no schema either. Still leave a valid file.
+        pq.write_table(pa.table({name: [] for name in column_names}), path)
+
+
+_WRITERS = {
+    'csv': _write_csv,
+    'parquet': _write_parquet,
+    'geojson': _write_geojson,
+}
@@ -0,0 +1,566 @@
+"""
+A fast decoder for the record messages written by the BumpVisualizer.
+
+Only the fields needed by the analyzer are decoded: timestamp, position,
+speed and the accel_z_* developer fields. A first pass walks the message
+headers and definitions in Python to find the offsets of all record messages,
+then the values are gathered from the raw bytes with NumPy for all records of
+a definition at once.
+
+Anything unexpected raises UnsupportedFitData, in which case the caller should
+fall back to a complete parser like fitparse. This includes malformed
+acceleration data, so that the complete parser gets to report the actual
+error. CRCs are not checked.
+
+IncrementalDecoder decodes files that are still being written, only reading
+what was appended since its previous call.
+"""
+import dataclasses as dc
+import re
+import struct
+
+import numpy as np
+
+# Seconds between the Unix epoch and the FIT epoch (1989-12-31 00:00 UTC).
+FIT_EPOCH_OFFSET_SECONDS = 631065600
+# Timestamps below this are relative (system time) rather than absolute.
+MIN_ABSOLUTE_TIMESTAMP = 0x10000000
+EXPECTED_ACCEL_VALUES_PER_MESSAGE = 25
+NULL_ACCEL = -32768
+
+RECORD_MESSAGE = 20
+FIELD_DESCRIPTION_MESSAGE = 206
+DEVELOPER_DATA_ID_MESSAGE = 207
+TIMESTAMP_FIELD = 253
+RECORD_LAT_FIELD = 0
+RECORD_LONG_FIELD = 1
+RECORD_SPEED_FIELD = 6
+RECORD_COMPRESSED_SPEED_DISTANCE_FIELD = 8
+RECORD_ENHANCED_SPEED_FIELD = 73
+SPEED_SCALE = 1000
+FILE_HEADER_MIN_SIZE = 12
+CRC_SIZE = 2
+
+# Base type number -> (NumPy type code, invalid value).
+_BASE_TYPES = {
+    0x02: ('u1', 0xFF),
+    0x83: ('i2', 0x7FFF),
+    0x84: ('u2', 0xFFFF),
+    0x85: ('i4', 0x7FFFFFFF),
+    0x86: ('u4', 0xFFFFFFFF),
+    0x07: ('S', None),
+}
+_UINT8, _SINT16, _UINT16, _SINT32, _UINT32, _STRING = (
+    0x02, 0x83, 0x84, 0x85, 0x86, 0x07)
+
+
+class UnsupportedFitData(Exception):
+    """
+    Raised if a file contains something the decoder doesn't handle.
+
+    Callers should fall back to a complete parser.
+    """
+
+
+class TruncatedFitData(UnsupportedFitData):
+    """Raised if a message extends beyond the end of the data."""
+
+
+@dc.dataclass
+class RecordColumns:
+    """
+    Per-message columns of all complete position records.
+
+    Timestamps are Unix seconds, positions semicircles, speeds m/s. accels
+    holds the EXPECTED_ACCEL_VALUES_PER_MESSAGE raw int16 acceleration values
+    of each message in rows. first_timestamp and last_timestamp are the
+    earliest and latest timestamps of any message in the file (in Unix
+    seconds), or None if there are none.
+    """
+    timestamps: np.ndarray
+    lons_semicircles: np.ndarray
+    lats_semicircles: np.ndarray
+    speeds: np.ndarray
+    accels: np.ndarray
+    first_timestamp: int = None
+    last_timestamp: int = None
+
+
+@dc.dataclass
+class _FieldPlan:
+    offset: int
+    size: int
+    base_type: int
+
+
+class _DecodePlan:
+    """
+    How to decode data messages of one definition message.
+
+    Keeps track of the offsets (and timestamps) of all data messages using
+    it, so their fields can be gathered in one go at the end.
+    """
+
+    def __init__(self, global_message_number, endian, fields, dev_fields):
+        self.global_message_number = global_message_number
+        self.endian = endian
+        self.fields = {}
+        self.size = 0
+        for number, size, base_type in fields:
+            # Fields may in theory appear twice, the first one wins.
+            self.fields.setdefault(
+                number, _FieldPlan(self.size, size, base_type))
+            self.size += size
+        self.dev_fields = {}
+        for name, size, base_type in dev_fields:
+            self.dev_fields.setdefault(
+                name, _FieldPlan(self.size, size, base_type))
+            self.size += size
+        self.timestamp_struct = self._timestamp_struct()
+        self.record_numbers = []
+        self.offsets = []
+        self.timestamps = []
+
+    def _timestamp_struct(self):
+        field = self.fields.get(TIMESTAMP_FIELD)
+        if field is None:
+            return None
+        if field.base_type != _UINT32 or field.size != 4:
+            raise UnsupportedFitData('Unexpected timestamp field type.')
+        return struct.Struct(self.endian + 'I')
+
+    def timestamp(self, data, offset):
+        if self.timestamp_struct is None:
+            return None
+        timestamp, = self.timestamp_struct.unpack_from(
+            data, offset + self.fields[TIMESTAMP_FIELD].offset)
+        if timestamp == _BASE_TYPES[_UINT32][1]:
+            return None
+        return timestamp
+
+    def gather(self, raw, field, base_type):
+        """
+        Gather a field of all collected messages as a 2D array.
+
+        raw is the whole file as a uint8 array. Each row contains the values
+        of one message.
+        """
+        if field.base_type != base_type:
+            raise UnsupportedFitData(
+                f'Unexpected base type {field.base_type:#x}.')
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        byte_idxs = offsets[:, np.newaxis] + (
+            field.offset + np.arange(field.size))
+        type_code, _ = _BASE_TYPES[base_type]
+        dtype = np.dtype(self.endian + type_code)
+        if field.size % dtype.itemsize:
+            raise UnsupportedFitData(f'Invalid field size {field.size}.')
+        return raw[byte_idxs].view(dtype)
+
+
+class _Decoder:
+    def __init__(self, data):
+        self._data = data
+        self._raw = np.frombuffer(data, dtype=np.uint8)
+        self._dev_field_names = {}
+        self._plans = {}
+        self._record_plans = []
+        self._num_records = 0
+        self._compressed_timestamp = 0
+        self._first_timestamp = None
+        self._last_timestamp = None
+
+    def decode(self):
+        pos = 0
+        while pos < len(self._data):
+            pos = self._decode_file(pos)
+        return self._record_columns()
+
+    def _decode_file(self, pos):
+        """Decode one (possibly chained) FIT file starting at pos."""
+        if len(self._data) - pos < FILE_HEADER_MIN_SIZE:
+            raise UnsupportedFitData('Truncated file header.')
+        header_size, data_size = _file_header(self._data, pos)
+        pos += header_size
+        end = pos + data_size
+        # The file ends with a 2 byte CRC.
+        if end + CRC_SIZE > len(self._data):
+            raise UnsupportedFitData('Truncated file.')
+        self._start_file()
+        while pos < end:
+            pos = self._decode_message(pos, end)
+        if pos != end:
+            raise UnsupportedFitData('Message overlaps the end of the file.')
+        return end + CRC_SIZE
+
+    def _start_file(self):
+        # Definitions and timestamps don't carry over to chained files.
+        self._plans = {}
+        self._compressed_timestamp = 0
+
+    def _start_chunk(self, data):
+        """
+        Continue decoding with data, which follows the last decoded message.
+
+        Only records of data are gathered from now on, definitions and
+        timestamps carry over.
+        """
+        self._data = data
+        self._raw = np.frombuffer(data, dtype=np.uint8)
+        self._num_records = 0
+        self._record_plans = [
+            plan for plan in self._plans.values()
+            if plan.global_message_number == RECORD_MESSAGE]
+        for plan in self._record_plans:
+            plan.record_numbers = []
+            plan.offsets = []
+            plan.timestamps = []
+
+    def _decode_message(self, pos, end):
+        header = self._data[pos]
+        pos += 1
+        if header & 0x80:
+            local_number = (header >> 5) & 0x3
+            time_offset = header & 0x1F
+        elif header & 0x40:
+            return self._decode_definition(
+                pos, end, header & 0xF, bool(header & 0x20))
+        else:
+            local_number = header & 0xF
+            time_offset = None
+        plan = self._plans.get(local_number)
+        if plan is None:
+            raise UnsupportedFitData(
+                f'Data message with undefined local type {local_number}.')
+        if pos + plan.size > end:
+            raise TruncatedFitData('Truncated data message.')
+        timestamp = self._message_timestamp(plan, pos, time_offset)
+        if plan.global_message_number == RECORD_MESSAGE:
+            plan.record_numbers.append(self._num_records)
+            plan.offsets.append(pos)
+            plan.timestamps.append(timestamp or 0)
+            self._num_records += 1
+        elif plan.global_message_number == DEVELOPER_DATA_ID_MESSAGE:
+            self._decode_developer_data_id(plan, pos)
+        elif plan.global_message_number == FIELD_DESCRIPTION_MESSAGE:
+            self._decode_field_description(plan, pos)
+        return pos + plan.size
+
+    def _message_timestamp(self, plan, pos, time_offset):
+        """
+        Return the absolute timestamp of a message, or None.
+
+        Keeps track of the reference for compressed timestamp headers and of
+        the range of timestamps in the file.
+        """
+        field_timestamp = plan.timestamp(self._data, pos)
+        if field_timestamp is not None:
+            self._compressed_timestamp = field_timestamp
+        timestamp = field_timestamp
+        if time_offset is not None:
+            compressed_timestamp = (
+                time_offset + (self._compressed_timestamp & ~0x1F))
+            if time_offset < (self._compressed_timestamp & 0x1F):
+                compressed_timestamp += 0x20
+            self._compressed_timestamp = compressed_timestamp
+            if timestamp is None or timestamp < MIN_ABSOLUTE_TIMESTAMP:
+                timestamp = compressed_timestamp
+        if timestamp is None or timestamp < MIN_ABSOLUTE_TIMESTAMP:
+            return None
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        self._last_timestamp = timestamp
+        return timestamp
+
+    def _decode_definition(self, pos, end, local_number, has_dev_fields):
+        if pos + 5 > end:
+            raise TruncatedFitData('Truncated definition message.')
+        architecture = self._data[pos + 1]
+        endian = '>' if architecture else '<'
+        global_number, num_fields = struct.unpack_from(
+            endian + 'HB', self._data, pos + 2)
+        pos += 5
+        if pos + 3 * num_fields + has_dev_fields > end:
+            raise TruncatedFitData('Truncated definition message.')
+        fields = [
+            struct.unpack_from('3B', self._data, pos + 3 * i)
+            for i in range(num_fields)]
+        pos += 3 * num_fields
+        dev_fields = []
+        if has_dev_fields:
+            num_dev_fields = self._data[pos]
+            pos += 1
+            if pos + 3 * num_dev_fields > end:
+                raise TruncatedFitData('Truncated definition message.')
+            for i in range(num_dev_fields):
+                number, size, dev_data_index = struct.unpack_from(
+                    '3B', self._data, pos + 3 * i)
+                try:
+                    name, base_type = self._dev_field_names[
+                        (dev_data_index, number)]
+                except KeyError:
+                    raise UnsupportedFitData(
+                        f'Undescribed developer field {number}.') from None
+                dev_fields.append((name, size, base_type))
+            pos += 3 * num_dev_fields
+        plan = _DecodePlan(global_number, endian, fields, dev_fields)
+        self._check_plan(plan)
+        self._plans[local_number] = plan
+        if global_number == RECORD_MESSAGE:
+            self._record_plans.append(plan)
+        return pos
+
+    @staticmethod
+    def _check_plan(plan):
+        has_accels = any(name.startswith('accel') for name in plan.dev_fields)
+        if has_accels and plan.global_message_number != RECORD_MESSAGE:
+            raise UnsupportedFitData(
+                'Acceleration fields outside of record messages.')
+        if RECORD_COMPRESSED_SPEED_DISTANCE_FIELD in plan.fields and (
+                plan.global_message_number == RECORD_MESSAGE):
+            raise UnsupportedFitData('Compressed speed is not supported.')
+
+    def _decode_developer_data_id(self, plan, pos):
+        # Redefining a developer data index discards its field descriptions.
+        index = self._single_value(plan, 3, _UINT8, pos)
+        self._dev_field_names = {
+            key: value for key, value in self._dev_field_names.items()
+            if key[0] != index}
+
+    def _decode_field_description(self, plan, pos):
+        dev_data_index = self._single_value(plan, 0, _UINT8, pos)
+        number = self._single_value(plan, 1, _UINT8, pos)
+        base_type = self._single_value(plan, 2, _UINT8, pos)
+        name_field = plan.fields.get(3)
+        name = None
+        if name_field is not None:
+            if name_field.base_type != _STRING:
+                raise UnsupportedFitData('Unexpected field name type.')
+            name_bytes = self._data[
+                pos + name_field.offset:
+                pos + name_field.offset + name_field.size]
+            name = name_bytes.split(b'\0', 1)[0].decode('utf-8', 'replace')
+        if dev_data_index is None or number is None or base_type is None:
+            raise UnsupportedFitData('Incomplete field description.')
+        name = name or f'unnamed_dev_field_{number}'
+        self._dev_field_names[(dev_data_index, number)] = (name, base_type)
+
+    def _single_value(self, plan, number, base_type, pos):
+        field = plan.fields.get(number)
+        if field is None:
+            return None
+        if field.base_type != base_type or field.size != 1:
+            raise UnsupportedFitData(f'Unexpected type of field {number}.')
+        value = self._data[pos + field.offset]
+        return None if value == _BASE_TYPES[base_type][1] else value
+
+    def _record_columns(self):
+        columns = [
+            self._plan_columns(plan) for plan in self._record_plans
+            if plan.offsets]
+        columns = [c for c in columns if c is not None]
+        if columns:
+            record_numbers, *values = (
+                np.concatenate(column) for column in zip(*columns))
+            order = np.argsort(record_numbers, kind='stable')
+            values = [v[order] for v in values]
+        else:
+            values = [
+                np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64),
+                np.empty(
+                    (0, EXPECTED_ACCEL_VALUES_PER_MESSAGE), dtype=np.int16)]
+        timestamps, lons, lats, speeds, accels = values
+
+        def unix(timestamp):
+            if timestamp is None:
+                return None
+            return timestamp + FIT_EPOCH_OFFSET_SECONDS
+
+        return RecordColumns(
+            timestamps + FIT_EPOCH_OFFSET_SECONDS, lons, lats, speeds, accels,
+            unix(self._first_timestamp), unix(self._last_timestamp))
+
+    def _plan_columns(self, plan):
+        """
+        Gather the complete position records of one definition.
+
+        Returns a tuple of record numbers, timestamps, longitudes, latitudes,
+        speeds and accelerations, or None if the definition can't contain
+        complete positions.
+        """
+        accel_fields = self._sorted_accel_fields(plan)
+        speed_field = self._speed_field(plan)
+        if (not accel_fields or speed_field is None
+                or RECORD_LAT_FIELD not in plan.fields
+                or RECORD_LONG_FIELD not in plan.fields):
+            return None
+        timestamps = np.asarray(plan.timestamps, dtype=np.int64)
+        lats = self._gather_single(
+            plan, plan.fields[RECORD_LAT_FIELD], _SINT32)
+        lons = self._gather_single(
+            plan, plan.fields[RECORD_LONG_FIELD], _SINT32)
+        speed_type = (
+            _UINT16 if speed_field is plan.fields.get(RECORD_SPEED_FIELD)
+            else _UINT32)
+        speeds = self._gather_single(plan, speed_field, speed_type)
+        complete = (
+            (timestamps != 0)
+            & (lats != _BASE_TYPES[_SINT32][1])
+            & (lons != _BASE_TYPES[_SINT32][1])
+            & (speeds != _BASE_TYPES[speed_type][1]))
+        accels = np.concatenate([
+            plan.gather(self._raw, field, _SINT16)
+            for _, _, field in accel_fields], axis=1)
+        not_null = accels != NULL_ACCEL
+        counts = not_null.sum(axis=1)
+        leading = np.arange(accels.shape[1]) < counts[:, np.newaxis]
+        if np.any(complete & np.any(not_null != leading, axis=1)):
+            raise UnsupportedFitData(
+                'Acceleration value after the first null.')
+        complete &= counts == EXPECTED_ACCEL_VALUES_PER_MESSAGE
+        record_numbers = np.asarray(plan.record_numbers, dtype=np.int64)
+        return (
+            record_numbers[complete], timestamps[complete], lons[complete],
+            lats[complete], speeds[complete].astype(np.float64) / SPEED_SCALE,
+            accels[complete, :EXPECTED_ACCEL_VALUES_PER_MESSAGE])
+
+    def _gather_single(self, plan, field, base_type):
+        values = plan.gather(self._raw, field, base_type)
+        if values.shape[1] != 1:
+            raise UnsupportedFitData('Unexpected array field.')
+        return values[:, 0]
+
+    @staticmethod
+    def _speed_field(plan):
+        # fitparse expands speed into enhanced_speed, whichever comes first
+        # is used.
+        speed_fields = [
+            plan.fields[n]
+            for n in (RECORD_SPEED_FIELD, RECORD_ENHANCED_SPEED_FIELD)
+            if n in plan.fields]
+        return min(
+            speed_fields, key=lambda f: f.offset, default=None)
+
+    @staticmethod
+    def _sorted_accel_fields(plan):
+        """
+        Return (start, end, field) of the acceleration fields of a plan.
+
+        The fields must be consecutive arrays starting at 0.
+        """
+        accel_fields = []
+        for name, field in plan.dev_fields.items():
+            if not name.startswith('accel'):
+                continue
+            match = re.match(r'accel_z_(\d+)-(\d+)', name)
+            if not match:
+                raise UnsupportedFitData(
+                    f'Invalid acceleration field name {name}.')
+            accel_fields.append(
+                (int(match.group(1)), int(match.group(2)), field))
+        accel_fields.sort(key=lambda f: (f[0], f[1]))
+        expected_start = 0
+        for start, end, field in accel_fields:
+            if start != expected_start or field.size != 2 * (end - start):
+                raise UnsupportedFitData('Unexpected acceleration fields.')
+            expected_start = end
+        return accel_fields
+
+
+class IncrementalDecoder:
+    """
+    Decodes the records of a FIT file that is still being written.
+
+    Each call of update() continues at offset, the end of the last complete
+    message decoded so far, with the definitions seen so far, and decodes the
+    messages completed since. A message that is only partially written is
+    left for the next call. While a file's header gives no data size, as
+    written by encoders that only fill it in when closing the file, all bytes
+    after the header are taken as messages.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._decoder = _Decoder(b'')
+        # Offset of the header of the current (possibly chained) file, None
+        # if the next bytes are a header.
+        self._header_offset = None
+        # Offset of the end of the current file's messages, None if unknown.
+        self._data_end = None
+
+    def update(self, file):
+        """
+        Decode what was appended to a binary file since the last call.
+
+        Returns RecordColumns of the complete position records among the new
+        messages. Their first_timestamp and last_timestamp cover all
+        messages decoded so far.
+        """
+        if self._header_offset is not None and self._data_end is None:
+            file.seek(self._header_offset)
+            self._set_data_end(file.read(FILE_HEADER_MIN_SIZE), 0)
+        file.seek(self.offset)
+        data = file.read()
+        self._decoder._start_chunk(data)
+        pos = 0
+        while pos < len(data):
+            if self._header_offset is None:
+                if len(data) - pos < FILE_HEADER_MIN_SIZE or (
+                        len(data) - pos < data[pos]):
+                    break
+                self._header_offset = self.offset + pos
+                pos += self._set_data_end(data, pos)
+                self._decoder._start_file()
+                continue
+            if self._data_end is None:
+                end = len(data)
+            else:
+                end = min(len(data), self._data_end - self.offset)
+                if pos == end and end == self._data_end - self.offset:
+                    if len(data) - pos < CRC_SIZE:
+                        break
+                    pos += CRC_SIZE
+                    self._header_offset = None
+                    continue
+            try:
+                pos = self._decoder._decode_message(pos, end)
+            except TruncatedFitData:
+                if end < len(data):
+                    raise
+                break
+        self.offset += pos
+        return self._decoder._record_columns()
+
+    def _set_data_end(self, data, pos):
+        """
+        Take the end of the current file's messages from its header at pos.
+
+        Returns the header size.
+        """
+        header_size, data_size = _file_header(data, pos)
+        if data_size:
+            self._data_end = self._header_offset + header_size + data_size
+        else:
+            self._data_end = None
+        return header_size
+
+
+def _file_header(data, pos):
+    """Return the header size and data size of the file header at pos."""
+    header_size, data_size, magic = struct.unpack_from('<B3xI4s', data, pos)
+    if magic != b'.FIT' or header_size < FILE_HEADER_MIN_SIZE:
+        raise UnsupportedFitData('Invalid file header.')
+    return header_size, data_size
+
+
+def decode_records(data):
+    """
+    Decode the position records of FIT file contents.
+
+    Returns RecordColumns of all record messages that contain a timestamp,
+    position, speed and exactly EXPECTED_ACCEL_VALUES_PER_MESSAGE
+    acceleration values. Raises UnsupportedFitData if the data can't be
+    decoded this way.
+    """
+    return _Decoder(data).decode()
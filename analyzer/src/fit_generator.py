@@ -0,0 +1,334 @@
+"""
+A generator of synthetic .fit files as recorded by the BumpVisualizer.
+
+The files contain the messages written by BumpTools.Recorder: record messages
+with native timestamp, position and speed fields, and developer fields for
+timestamp, lat, long, speed and accel_z_0-8 ... accel_z_24-32, where the
+acceleration arrays are padded with -32768 (null). Rides are random but
+reproducible from a seed, and can include GPS gaps, saturated samples and
+duplicate records as written in smart recording mode.
+
+Intended for building test and benchmark datasets, e.g.
+    python src/fit_generator.py --count 1000 --duration 7200 <output_dir>
+"""
+import argparse
+import dataclasses as dc
+import datetime
+import logging
+import math
+import pathlib
+import struct
+
+import numpy as np
+
+import fit_decoder
+
+logger = logging.getLogger(__name__)
+
+SAMPLES_PER_FIELD = 8
+SATURATED_ACCEL = 32767
+DEFAULT_START = datetime.datetime(2024, 5, 1, 10)
+METERS_PER_DEGREE = 111_320
+
+FILE_ID_MESSAGE = 0
+EVENT_MESSAGE = 21
+FILE_TYPE_ACTIVITY = 4
+MANUFACTURER_GARMIN = 1
+EVENT_TIMER = 0
+EVENT_TYPE_START = 0
+
+_CRC_TABLE = (
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+# Local message types of the messages in a generated file.
+_FILE_ID_LOCAL, _DEVELOPER_DATA_ID_LOCAL, _FIELD_DESCRIPTION_LOCAL, \
+    _EVENT_LOCAL, _RECORD_LOCAL = range(5)
+_UINT8, _SINT16, _UINT16, _SINT32, _UINT32, _STRING, _ENUM, _BYTE = (
+    0x02, 0x83, 0x84, 0x85, 0x86, 0x07, 0x00, 0x0D)
+_NUMPY_TYPES = {
+    _UINT8: 'u1', _SINT16: '<i2', _UINT16: '<u2', _SINT32: '<i4',
+    _UINT32: '<u4'}
+
+
+@dc.dataclass
+class RideSpec:
+    """
+    Parameters of a synthetic ride.
+
+    gaps are (start, stop) offsets in seconds from the start during which no
+    records are written, like when GPS reception is lost. Each sample is
+    saturated (+-32767) with saturation_probability, each second contains a
+    bump (a large acceleration) with bump_probability, and each record is
+    followed by a duplicate with the same timestamp and values with
+    duplicate_probability.
+    """
+    duration_seconds: int = 3600
+    sample_rate: int = fit_decoder.EXPECTED_ACCEL_VALUES_PER_MESSAGE
+    start: datetime.datetime = DEFAULT_START
+    gaps: tuple = ()
+    saturation_probability: float = 0
+    bump_probability: float = 0.01
+    duplicate_probability: float = 0
+    seed: int = 0
+    start_lat: float = 52.5
+    start_lon: float = 13.4
+
+    def __post_init__(self):
+        try:
+            assert self.duration_seconds >= 0
+            assert self.sample_rate > 0
+            assert all(0 <= start <= stop for start, stop in self.gaps)
+            for probability in [
+                    self.saturation_probability, self.bump_probability,
+                    self.duplicate_probability]:
+                assert 0 <= probability <= 1
+        except AssertionError as e:
+            raise ValueError('Invalid ride specification.') from e
+
+    @property
+    def num_accel_fields(self):
+        return math.ceil(self.sample_rate / SAMPLES_PER_FIELD)
+
+
+def generate(spec):
+    """Return the content of a .fit file for a RideSpec."""
+    start_timestamp = _fit_timestamp(spec.start)
+    body = b''.join([
+        _definition(_FILE_ID_LOCAL, FILE_ID_MESSAGE, [
+            (0, 1, _ENUM), (1, 2, _UINT16), (4, 4, _UINT32)]),
+        struct.pack(
+            '<BBHI', _FILE_ID_LOCAL, FILE_TYPE_ACTIVITY, MANUFACTURER_GARMIN,
+            start_timestamp),
+        _definition(
+            _DEVELOPER_DATA_ID_LOCAL, fit_decoder.DEVELOPER_DATA_ID_MESSAGE,
+            [(3, 1, _UINT8), (1, 16, _BYTE)]),
+        struct.pack('<BB16s', _DEVELOPER_DATA_ID_LOCAL, 0, bytes(16)),
+        _field_descriptions(spec),
+        _definition(_EVENT_LOCAL, EVENT_MESSAGE, [
+            (fit_decoder.TIMESTAMP_FIELD, 4, _UINT32), (0, 1, _ENUM),
+            (1, 1, _ENUM)]),
+        struct.pack(
+            '<BIBB', _EVENT_LOCAL, start_timestamp, EVENT_TIMER,
+            EVENT_TYPE_START),
+        _records(spec, start_timestamp),
+    ])
+    header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(body), b'.FIT')
+    header += struct.pack('<H', _crc(header))
+    data = header + body
+    return data + struct.pack('<H', _crc(data))
+
+
+def write(path, spec):
+    """Write a .fit file for a RideSpec to path."""
+    pathlib.Path(path).write_bytes(generate(spec))
+
+
+def _fit_timestamp(dt):
+    return (
+        int((dt - datetime.datetime(1970, 1, 1)).total_seconds())
+        - fit_decoder.FIT_EPOCH_OFFSET_SECONDS)
+
+
+def _crc(data):
+    crc = 0
+    for byte in data:
+        for nibble in (byte & 0xF, byte >> 4):
+            tmp = _CRC_TABLE[crc & 0xF]
+            crc = (crc >> 4) & 0x0FFF
+            crc = crc ^ tmp ^ _CRC_TABLE[nibble]
+    return crc
+
+
+def _definition(local_type, global_number, fields, developer_fields=()):
+    header = 0x40 | local_type | (0x20 if developer_fields else 0)
+    data = struct.pack('<BBBHB', header, 0, 0, global_number, len(fields))
+    data += b''.join(struct.pack('BBB', *field) for field in fields)
+    if developer_fields:
+        data += struct.pack('B', len(developer_fields))
+        data += b''.join(
+            struct.pack('BBB', number, size, 0)
+            for number, size in developer_fields)
+    return data
+
+
+def _developer_fields(spec):
+    """
+    Return (number, name, base type, count, native number) of each developer
+    field, as created by BumpTools.Recorder.
+    """
+    fields = [
+        (0, 'timestamp', _UINT32, 1, fit_decoder.TIMESTAMP_FIELD),
+        (1, 'lat', _SINT32, 1, fit_decoder.RECORD_LAT_FIELD),
+        (2, 'long', _SINT32, 1, fit_decoder.RECORD_LONG_FIELD),
+        (3, 'speed', _UINT16, 1, fit_decoder.RECORD_SPEED_FIELD),
+    ]
+    for i in range(spec.num_accel_fields):
+        fields.append((
+            5 + i,
+            f'accel_z_{i * SAMPLES_PER_FIELD}-{(i + 1) * SAMPLES_PER_FIELD}',
+            _SINT16, SAMPLES_PER_FIELD, None))
+    return fields
+
+
+def _field_descriptions(spec):
+    data = _definition(
+        _FIELD_DESCRIPTION_LOCAL, fit_decoder.FIELD_DESCRIPTION_MESSAGE, [
+            (0, 1, _UINT8), (1, 1, _UINT8), (2, 1, _UINT8), (3, 16, _STRING),
+            (15, 1, _UINT8)])
+    for number, name, base_type, _, native_number in _developer_fields(spec):
+        data += struct.pack(
+            '<BBBB16sB', _FIELD_DESCRIPTION_LOCAL, 0, number, base_type,
+            name.encode(), 0xFF if native_number is None else native_number)
+    return data
+
+
+def _record_dtype(spec):
+    """
+    Return a structured dtype matching the layout of a record message.
+    """
+    names = ['header', 'timestamp', 'lat', 'long', 'enhanced_speed']
+    formats = ['u1', '<u4', '<i4', '<i4', '<u4']
+    for number, name, base_type, count, _ in _developer_fields(spec):
+        names.append(f'dev_{number}')
+        formats.append((_NUMPY_TYPES[base_type], count) if count > 1
+                       else _NUMPY_TYPES[base_type])
+    return np.dtype({'names': names, 'formats': formats})
+
+
+def _records(spec, start_timestamp):
+    dtype = _record_dtype(spec)
+    native_fields = [
+        (fit_decoder.TIMESTAMP_FIELD, 4, _UINT32),
+        (fit_decoder.RECORD_LAT_FIELD, 4, _SINT32),
+        (fit_decoder.RECORD_LONG_FIELD, 4, _SINT32),
+        (fit_decoder.RECORD_ENHANCED_SPEED_FIELD, 4, _UINT32),
+    ]
+    developer_fields = [
+        (number, dtype[f'dev_{number}'].itemsize)
+        for number, *_ in _developer_fields(spec)]
+    definition = _definition(
+        _RECORD_LOCAL, fit_decoder.RECORD_MESSAGE, native_fields,
+        developer_fields)
+
+    rng = np.random.default_rng(spec.seed)
+    seconds = np.arange(spec.duration_seconds)
+    # Speed and heading vary smoothly, positions follow from them.
+    speeds = np.clip(
+        5 + 3 * np.sin(seconds / 30) + rng.normal(0, 0.3, len(seconds)),
+        0, None)
+    headings = np.cumsum(rng.normal(0, 0.05, len(seconds)))
+    lats = spec.start_lat + np.cumsum(
+        speeds * np.cos(headings)) / METERS_PER_DEGREE
+    lons = spec.start_lon + np.cumsum(
+        speeds * np.sin(headings)) / (
+            METERS_PER_DEGREE * math.cos(math.radians(spec.start_lat)))
+    accels = _accels(spec, rng, len(seconds))
+
+    recorded = np.ones(len(seconds), dtype=bool)
+    for start, stop in spec.gaps:
+        recorded[start:stop] = False
+    # Each recorded second is written once, or twice if duplicated.
+    counts = recorded * (
+        1 + (rng.random(len(seconds)) < spec.duplicate_probability))
+    records = np.zeros(len(seconds), dtype=dtype)
+    records['header'] = _RECORD_LOCAL
+    records['timestamp'] = start_timestamp + seconds
+    records['lat'] = _deg_to_semicircles(lats)
+    records['long'] = _deg_to_semicircles(lons)
+    records['enhanced_speed'] = np.round(speeds * fit_decoder.SPEED_SCALE)
+    records['dev_0'] = records['timestamp']
+    records['dev_1'] = records['lat']
+    records['dev_2'] = records['long']
+    # The Recorder writes whole m/s, scaled like the native field.
+    records['dev_3'] = np.trunc(speeds) * fit_decoder.SPEED_SCALE
+    padded_accels = np.full(
+        (len(seconds), spec.num_accel_fields * SAMPLES_PER_FIELD),
+        fit_decoder.NULL_ACCEL, dtype=np.int16)
+    padded_accels[:, :spec.sample_rate] = accels
+    for i in range(spec.num_accel_fields):
+        records[f'dev_{5 + i}'] = padded_accels[
+            :, i * SAMPLES_PER_FIELD:(i + 1) * SAMPLES_PER_FIELD]
+    return definition + np.repeat(records, counts).tobytes()
+
+
+def _accels(spec, rng, num_seconds):
+    """
+    Return raw acceleration samples in millig, including gravity, with one
+    row per second.
+    """
+    shape = (num_seconds, spec.sample_rate)
+    accels = rng.normal(-1000, 250, shape)
+    bumps = np.flatnonzero(rng.random(num_seconds) < spec.bump_probability)
+    accels[bumps, rng.integers(spec.sample_rate, size=len(bumps))] += (
+        rng.choice([-1, 1], len(bumps)) * rng.uniform(1500, 4500, len(bumps)))
+    # Capped like BumpTools.sampleAsInt16 does.
+    accels = np.clip(np.round(accels), -SATURATED_ACCEL, SATURATED_ACCEL)
+    saturated = rng.random(shape) < spec.saturation_probability
+    accels[saturated] = rng.choice(
+        [-SATURATED_ACCEL, SATURATED_ACCEL], np.count_nonzero(saturated))
+    return accels.astype(np.int16)
+
+
+def _deg_to_semicircles(degrees):
+    return np.round(degrees / 180 * 2**31).astype(np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic .fit files as recorded by the '
+        'BumpVisualizer.')
+    parser.add_argument('output_dir', type=pathlib.Path)
+    parser.add_argument(
+        '--count', type=int, default=1, help='Number of files to generate.')
+    parser.add_argument(
+        '--duration', type=int, default=3600,
+        help='Duration of each ride in seconds.')
+    parser.add_argument(
+        '--sample-rate', type=int,
+        default=fit_decoder.EXPECTED_ACCEL_VALUES_PER_MESSAGE,
+        help='Acceleration samples per second. The analyzer only accepts '
+        f'{fit_decoder.EXPECTED_ACCEL_VALUES_PER_MESSAGE}.')
+    parser.add_argument(
+        '--gaps', type=int, default=0,
+        help='Number of GPS gaps at random times in each ride.')
+    parser.add_argument(
+        '--gap-duration', type=int, default=30,
+        help='Duration of each GPS gap in seconds.')
+    parser.add_argument(
+        '--saturation-probability', type=float, default=0,
+        help='Probability of each sample to be saturated (+-32767), which '
+        'both decoders of the analyzer read as an infinite acceleration.')
+    parser.add_argument(
+        '--bump-probability', type=float, default=0.01,
+        help='Probability of each second to contain a bump.')
+    parser.add_argument(
+        '--duplicate-probability', type=float, default=0,
+        help='Probability of each record to be written twice, like in smart '
+        'recording mode.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the first ride, incremented for each following one.')
+    args = parser.parse_args()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(args.count):
+        seed = args.seed + i
+        rng = np.random.default_rng(seed)
+        gap_starts = np.sort(rng.integers(
+            0, max(1, args.duration - args.gap_duration), args.gaps))
+        spec = RideSpec(
+            duration_seconds=args.duration, sample_rate=args.sample_rate,
+            start=DEFAULT_START + datetime.timedelta(days=i),
+            gaps=tuple(
+                (int(start), int(start) + args.gap_duration)
+                for start in gap_starts),
+            saturation_probability=args.saturation_probability,
+            bump_probability=args.bump_probability,
+            duplicate_probability=args.duplicate_probability, seed=seed)
+        path = args.output_dir / f'synthetic-{seed:06d}.fit'
+        write(path, spec)
+        logger.info(f'Wrote {path}.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,230 @@
+"""
+Road quality of many rides as a raster.
+
+Every position's attenuated rolling average absolute acceleration is binned
+into the pixel containing it in the Web Mercator pixel grid at a zoom level,
+i.e. the tiles at that zoom level split into 256 by 256 pixels. 15 by default,
+where pixels are about 5 m wide at the equator and 3 m wide at 50 degrees
+latitude. HeatmapRaster keeps the sum and number of values of each pixel
+rides passed through. Merged rides are combined with np.bincount() once
+their pixels are needed, so merging many rides costs time proportional to
+their pixels rather than to the pixels merged so far. For drawing, these
+are laid out as planes covering all rides, with pixels combined as at lower
+zoom levels until the planes fit an image size, so the mean of each pixel can
+be drawn over the map as a single image however many rides there are.
+
+Rasters are stored as .npz files along with the hashes of the merged rides'
+files, so each ride is only merged once, and the rolling average window and
+attenuation, which are fixed when a raster is created.
+"""
+import dataclasses as dc
+import math
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+
+import aggregation
+
+DEFAULT_ZOOM = 15
+# Pixels per tile side are 2**TILE_SIZE_DOUBLINGS.
+TILE_SIZE_DOUBLINGS = 8
+# Pixel x and y are combined into int64 keys, which limits the zoom level.
+MAX_ZOOM = 31 - TILE_SIZE_DOUBLINGS
+# Half the width of the Web Mercator projection in metres.
+MERCATOR_HALF_WIDTH_M = math.pi * 6_378_137
+# Largest side in pixels of the planes laid out for drawing.
+MAX_PLANE_SIZE = 2048
+
+
+@dc.dataclass
+class RidePixels:
+    """Sums and numbers of values of the pixels a ride passed through."""
+    xs: np.ndarray
+    ys: np.ndarray
+    sums: np.ndarray
+    counts: np.ndarray
+
+    def __len__(self):
+        return len(self.xs)
+
+
+def ride_pixels(track, conf, zoom=DEFAULT_ZOOM):
+    """
+    Return the RidePixels of a track analyzed with an AnalysisConfig.
+
+    Positions with an infinite rolling average, caused by saturated
+    acceleration values, are left out.
+    """
+    att_abs_accels = track.rolling_average_absolute_accels(
+        conf.rolling_average_window_duration_seconds, conf.attenuator)
+    finite = np.isfinite(att_abs_accels)
+    pixel_zoom = zoom + TILE_SIZE_DOUBLINGS
+    xs, ys = aggregation.lon_lat_to_cells(
+        track.lons[finite], track.lats[finite], pixel_zoom)
+    return _combined(
+        xs, ys, att_abs_accels[finite], np.ones(len(xs), dtype=np.int64),
+        pixel_zoom)
+
+
+class HeatmapRaster:
+    """
+    Sums and numbers of values of the pixels many rides passed through.
+
+    settings describes how values were computed. pixels holds the RidePixels
+    of all merged rides combined. zoom must be at most MAX_ZOOM, ValueError
+    is raised otherwise.
+    """
+
+    def __init__(self, zoom=DEFAULT_ZOOM, settings=''):
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(
+                f'Invalid heatmap zoom level {zoom}, must be at most '
+                f'{MAX_ZOOM}.')
+        self.zoom = zoom
+        self.settings = settings
+        self._pixels = RidePixels(
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+            np.empty(0), np.empty(0, dtype=np.int64))
+        # RidePixels merged since pixels were last combined.
+        self._merged_pixels = []
+        self.ride_keys = set()
+
+    @staticmethod
+    def settings_for_config(conf):
+        return (
+            f'{conf.rolling_average_window_duration_seconds}s,'
+            f'{conf.attenuator.spec}')
+
+    @classmethod
+    def open(cls, path, conf, zoom=None):
+        """
+        Load the raster at path, or create one if there is none.
+
+        The raster must have been created for the rolling average window and
+        attenuation of the AnalysisConfig and, if given, zoom. Raises
+        ValueError otherwise.
+        """
+        settings = cls.settings_for_config(conf)
+        path = pathlib.Path(path)
+        if not path.exists():
+            return cls(DEFAULT_ZOOM if zoom is None else zoom, settings)
+        with np.load(path, allow_pickle=False) as arrays:
+            raster = cls(int(arrays['zoom']), str(arrays['settings']))
+            raster._pixels = RidePixels(
+                arrays['xs'], arrays['ys'], arrays['sums'], arrays['counts'])
+            raster.ride_keys = set(arrays['ride_keys'].tolist())
+        if zoom is not None and raster.zoom != zoom:
+            raise ValueError(
+                f'{path} uses zoom level {raster.zoom}, not {zoom}.')
+        if raster.settings != settings:
+            raise ValueError(
+                f'{path} was created with a rolling average window and '
+                f'attenuation of {raster.settings}, not {settings}.')
+        return raster
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pixels = self.pixels
+        # Written atomically, so a crash never leaves a broken raster.
+        with tempfile.NamedTemporaryFile(
+                dir=path.parent, suffix='.tmp', delete=False) as file:
+            np.savez(
+                file, zoom=self.zoom, settings=self.settings,
+                xs=pixels.xs, ys=pixels.ys, sums=pixels.sums,
+                counts=pixels.counts,
+                ride_keys=np.array(sorted(self.ride_keys), dtype=str))
+        os.replace(file.name, path)
+
+    def __len__(self):
+        return len(self.ride_keys)
+
+    def contains(self, ride_key):
+        return ride_key in self.ride_keys
+
+    def merge(self, ride_key, pixels):
+        """
+        Add the RidePixels of a ride.
+
+        Rides that were already merged are skipped. Returns whether the ride
+        was merged.
+        """
+        if ride_key in self.ride_keys:
+            return False
+        self.ride_keys.add(ride_key)
+        self._merged_pixels.append(pixels)
+        return True
+
+    @property
+    def pixels(self):
+        if self._merged_pixels:
+            self._pixels = _combined(
+                *(np.concatenate(columns) for columns in zip(*(
+                    dc.astuple(pixels) for pixels in
+                    [self._pixels] + self._merged_pixels))),
+                self.zoom + TILE_SIZE_DOUBLINGS)
+            self._merged_pixels = []
+        return self._pixels
+
+    def planes(self, max_size=MAX_PLANE_SIZE):
+        """
+        Return the pixels as planes of sums and numbers of values, indexed by
+        y and x, along with their pixel zoom level and the pixel x and y of
+        their top left corner.
+
+        Pixels are combined as at lower zoom levels until neither side of the
+        planes exceeds max_size. The raster must not be empty.
+        """
+        pixel_zoom = self.zoom + TILE_SIZE_DOUBLINGS
+        pixels = self.pixels
+        xs, ys = pixels.xs, pixels.ys
+        shift = 0
+        while max(
+                (xs.max() >> shift) - (xs.min() >> shift),
+                (ys.max() >> shift) - (ys.min() >> shift)) >= max_size:
+            shift += 1
+        xs, ys = xs >> shift, ys >> shift
+        x0, y0 = int(xs.min()), int(ys.min())
+        shape = (int(ys.max()) - y0 + 1, int(xs.max()) - x0 + 1)
+        idxs = (ys - y0) * shape[1] + (xs - x0)
+        size = shape[0] * shape[1]
+        sums = np.bincount(idxs, pixels.sums, minlength=size)
+        counts = np.bincount(idxs, pixels.counts, minlength=size)
+        return (
+            sums.reshape(shape), counts.astype(np.int64).reshape(shape),
+            pixel_zoom - shift, x0, y0)
+
+    @property
+    def bounds(self):
+        """min_lon, min_lat, max_lon and max_lat of the pixels."""
+        pixels = self.pixels
+        xs, ys = pixels.xs, pixels.ys
+        min_lons, min_lats, max_lons, max_lats = aggregation.cell_bounds(
+            [xs.min(), xs.max()], [ys.max(), ys.min()],
+            self.zoom + TILE_SIZE_DOUBLINGS)
+        return min_lons[0], min_lats[0], max_lons[1], max_lats[1]
+
+
+def _combined(xs, ys, sums, counts, pixel_zoom):
+    """Return RidePixels with the values of equal pixels added up."""
+    pixels, idxs = np.unique((xs << pixel_zoom) | ys, return_inverse=True)
+    return RidePixels(
+        pixels >> pixel_zoom, pixels & ((1 << pixel_zoom) - 1),
+        np.bincount(idxs, sums, minlength=len(pixels)),
+        np.bincount(idxs, counts, minlength=len(pixels)).astype(np.int64))
+
+
+def mercator_extent(pixel_zoom, x0, y0, shape):
+    """
+    Return left, right, bottom and top in Web Mercator metres of an image
+    of the given shape whose top left pixel is x0, y0 at pixel_zoom, as
+    taken by imshow().
+    """
+    height, width = shape
+    pixel_size_m = 2 * MERCATOR_HALF_WIDTH_M / (1 << pixel_zoom)
+    left = x0 * pixel_size_m - MERCATOR_HALF_WIDTH_M
+    top = MERCATOR_HALF_WIDTH_M - y0 * pixel_size_m
+    return (
+        left, left + width * pixel_size_m, top - height * pixel_size_m, top)
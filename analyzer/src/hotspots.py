@@ -0,0 +1,341 @@
+"""
+Spike hotspots across many rides.
+
+Spikes are the chunks of a track whose maximum absolute acceleration reaches
+the spike lower limit, as drawn on the map. Spikes of many rides at the same
+place, typically a pothole, are clustered: each spike joins the cluster with
+the nearest centroid within the cluster radius (10 m by default) or starts a
+new one, and a cluster's centroid is the mean position of its spikes.
+Clusters are hashed into a grid of cells as wide as the radius by their
+centroids, so a spike is only compared with the clusters in the cells around
+it rather than with all of them.
+
+HotspotStore keeps spikes and clusters in an SQLite database. Merging a ride
+only loads the clusters near its spikes, and each ride is identified by a
+hash of its file, so it is only merged once. Clusters are printed with their
+centroid, number of spikes and rides, median magnitude and the time of their
+last spike by
+    python src/hotspots.py [--bbox <min_lon>,<min_lat>,<max_lon>,<max_lat>]
+        [--min-rides <n>] <database>
+"""
+import argparse
+import dataclasses as dc
+import datetime
+import json
+import logging
+import math
+import pathlib
+import sqlite3
+
+import numpy as np
+
+import analysis
+import tiles
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLUSTER_RADIUS_M = 10
+EARTH_RADIUS_M = 6_371_008.8
+
+
+@dc.dataclass
+class RideSpikes:
+    """Times, positions and maximum absolute accelerations of spikes."""
+    tss_ns: np.ndarray
+    lons: np.ndarray
+    lats: np.ndarray
+    magnitudes: np.ndarray
+
+    def __len__(self):
+        return len(self.tss_ns)
+
+
+def ride_spikes(track, conf):
+    """Return the RideSpikes of a track analyzed with an AnalysisConfig."""
+    mids, max_accels = track.spikes(
+        conf.spike_time_slice_seconds, conf.spike_lower_limit_millig)
+    return RideSpikes(
+        track.tss_ns[mids], track.lons[mids].astype(np.float64),
+        track.lats[mids].astype(np.float64),
+        max_accels.astype(np.float64))
+
+
+def _mercator_cell(lon, lat, cell_size_m):
+    """
+    Return x and y of the grid cell containing a point, in Web Mercator
+    metres divided by cell_size_m.
+    """
+    lat = max(-tiles.MAX_LATITUDE, min(tiles.MAX_LATITUDE, lat))
+    x = EARTH_RADIUS_M * math.radians(lon)
+    y = EARTH_RADIUS_M * math.asinh(math.tan(math.radians(lat)))
+    return math.floor(x / cell_size_m), math.floor(y / cell_size_m)
+
+
+def _distances_m(lon, lat, lons, lats):
+    """
+    Return the distances between a point and arrays of points, approximated
+    for short distances.
+    """
+    dxs = np.radians(np.asarray(lons) - lon) * math.cos(math.radians(lat))
+    dys = np.radians(np.asarray(lats) - lat)
+    return EARTH_RADIUS_M * np.hypot(dxs, dys)
+
+
+@dc.dataclass
+class _Cluster:
+    id: int
+    lon: float
+    lat: float
+    hits: int
+    last_seen_ns: int
+    cell: tuple
+
+
+class HotspotStore:
+    """
+    Spikes clustered across many rides in an SQLite database.
+
+    The cluster radius is fixed when the database is created, to
+    cluster_radius_m or DEFAULT_CLUSTER_RADIUS_M if it's None. Opening an
+    existing database with a different cluster_radius_m raises ValueError.
+    With read_only, the database must exist (FileNotFoundError is raised
+    otherwise) and is never written.
+    """
+
+    def __init__(self, path, cluster_radius_m=None, read_only=False):
+        if cluster_radius_m is not None and not cluster_radius_m > 0:
+            raise ValueError(
+                f'Invalid cluster radius {cluster_radius_m}, must be '
+                'positive.')
+        self.path = pathlib.Path(path)
+        if read_only:
+            if not self.path.exists():
+                raise FileNotFoundError(
+                    f'No hotspot database at {self.path}.')
+            self._connection = sqlite3.connect(
+                f'{self.path.resolve().as_uri()}?mode=ro', uri=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._create_schema(
+                DEFAULT_CLUSTER_RADIUS_M if cluster_radius_m is None
+                else cluster_radius_m)
+        self.cluster_radius_m = float(self._metadata('cluster_radius_m'))
+        if (cluster_radius_m is not None
+                and self.cluster_radius_m != cluster_radius_m):
+            raise ValueError(
+                f'{self.path} uses a cluster radius of '
+                f'{self.cluster_radius_m} m, not {cluster_radius_m} m.')
+
+    def contains(self, ride_key):
+        """Return whether the ride with ride_key was merged."""
+        return self._connection.execute(
+            'SELECT 1 FROM rides WHERE ride_key = ?',
+            (ride_key,)).fetchone() is not None
+
+    def merge(self, ride_key, name, spikes):
+        """
+        Cluster the RideSpikes of a ride into the store.
+
+        ride_key identifies the ride, name describes it. Rides that were
+        already merged are skipped. Returns whether the ride was merged.
+        """
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO rides (ride_key, name, merged, '
+                'num_spikes) VALUES (?, ?, ?, ?)',
+                (ride_key, name,
+                 datetime.datetime.now().isoformat(timespec='seconds'),
+                 len(spikes)))
+            if not cursor.rowcount:
+                return False
+            ride_id = cursor.lastrowid
+            # Clusters near the ride's spikes by cell, loaded on demand.
+            grid = {}
+            changed = {}
+            spike_rows = []
+            for ts_ns, lon, lat, magnitude in zip(
+                    spikes.tss_ns.tolist(), spikes.lons.tolist(),
+                    spikes.lats.tolist(), spikes.magnitudes.tolist()):
+                cluster = self._nearest_cluster(grid, lon, lat)
+                if cluster is None:
+                    cluster = self._new_cluster(grid, lon, lat, ts_ns)
+                else:
+                    self._join(grid, cluster, lon, lat, ts_ns)
+                changed[cluster.id] = cluster
+                spike_rows.append(
+                    (cluster.id, ride_id, ts_ns, lon, lat, magnitude))
+            self._connection.executemany(
+                'UPDATE clusters SET cell_x = ?, cell_y = ?, lon = ?, '
+                'lat = ?, hits = ?, last_seen_ns = ? WHERE id = ?',
+                [(*c.cell, c.lon, c.lat, c.hits, c.last_seen_ns, c.id)
+                 for c in changed.values()])
+            self._connection.executemany(
+                'INSERT INTO spikes (cluster_id, ride_id, ts_ns, lon, lat, '
+                'magnitude_millig) VALUES (?, ?, ?, ?, ?, ?)', spike_rows)
+        return True
+
+    def query(self, bounds=None):
+        """
+        Return the clusters whose centroids are within bounds (min_lon,
+        min_lat, max_lon, max_lat), or all clusters if it's None, ordered by
+        their number of spikes.
+
+        Clusters are dicts with lon, lat, hits, rides, median_magnitude_millig
+        and last_seen_ns.
+        """
+        conditions, parameters = '1', ()
+        if bounds is not None:
+            min_lon, min_lat, max_lon, max_lat = bounds
+            min_x, min_y = _mercator_cell(
+                min_lon, min_lat, self.cluster_radius_m)
+            max_x, max_y = _mercator_cell(
+                max_lon, max_lat, self.cluster_radius_m)
+            conditions = (
+                'cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ? '
+                'AND lon BETWEEN ? AND ? AND lat BETWEEN ? AND ?')
+            parameters = (
+                min_x, max_x, min_y, max_y, min_lon, max_lon, min_lat,
+                max_lat)
+        clusters = {
+            row[0]: {
+                'lon': row[1], 'lat': row[2], 'hits': row[3],
+                'last_seen_ns': row[4]}
+            for row in self._connection.execute(
+                'SELECT id, lon, lat, hits, last_seen_ns FROM clusters '
+                f'WHERE {conditions}', parameters)}
+        spike_rows = self._connection.execute(
+            'SELECT cluster_id, ride_id, magnitude_millig FROM spikes '
+            f'WHERE cluster_id IN (SELECT id FROM clusters '
+            f'WHERE {conditions}) ORDER BY cluster_id', parameters).fetchall()
+        if spike_rows:
+            cluster_ids, ride_ids, magnitudes = map(np.array, zip(*spike_rows))
+            splits = np.flatnonzero(np.diff(cluster_ids)) + 1
+            for ids, rides, values in zip(
+                    np.split(cluster_ids, splits), np.split(ride_ids, splits),
+                    np.split(magnitudes, splits)):
+                clusters[int(ids[0])].update({
+                    'rides': len(np.unique(rides)),
+                    'median_magnitude_millig': float(np.median(values))})
+        return sorted(
+            clusters.values(), key=lambda cluster: cluster['hits'],
+            reverse=True)
+
+    @property
+    def num_rides(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM rides').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def _nearest_cluster(self, grid, lon, lat):
+        """
+        Return the cluster with the nearest centroid within the cluster
+        radius of a point, or None.
+        """
+        x, y = _mercator_cell(lon, lat, self.cluster_radius_m)
+        # Web Mercator stretches distances by 1 / cos(lat), so the radius
+        # spans more cells away from the equator.
+        span = math.ceil(1 / math.cos(math.radians(
+            min(abs(lat), tiles.MAX_LATITUDE))))
+        candidates = [
+            cluster
+            for cell_x in range(x - span, x + span + 1)
+            for cell_y in range(y - span, y + span + 1)
+            for cluster in self._cell_clusters(grid, (cell_x, cell_y))]
+        if not candidates:
+            return None
+        distances = _distances_m(
+            lon, lat, [c.lon for c in candidates], [c.lat for c in candidates])
+        nearest = np.argmin(distances)
+        if distances[nearest] > self.cluster_radius_m:
+            return None
+        return candidates[nearest]
+
+    def _cell_clusters(self, grid, cell):
+        clusters = grid.get(cell)
+        if clusters is None:
+            clusters = grid[cell] = [
+                _Cluster(*row, cell) for row in self._connection.execute(
+                    'SELECT id, lon, lat, hits, last_seen_ns FROM clusters '
+                    'WHERE cell_x = ? AND cell_y = ?', cell)]
+        return clusters
+
+    def _new_cluster(self, grid, lon, lat, ts_ns):
+        cell = _mercator_cell(lon, lat, self.cluster_radius_m)
+        cluster_id = self._connection.execute(
+            'INSERT INTO clusters (cell_x, cell_y, lon, lat, hits, '
+            'last_seen_ns) VALUES (?, ?, ?, ?, 1, ?)',
+            (*cell, lon, lat, ts_ns)).lastrowid
+        cluster = _Cluster(cluster_id, lon, lat, 1, ts_ns, cell)
+        self._cell_clusters(grid, cell).append(cluster)
+        return cluster
+
+    def _join(self, grid, cluster, lon, lat, ts_ns):
+        cluster.hits += 1
+        cluster.lon += (lon - cluster.lon) / cluster.hits
+        cluster.lat += (lat - cluster.lat) / cluster.hits
+        cluster.last_seen_ns = max(cluster.last_seen_ns, ts_ns)
+        cell = _mercator_cell(cluster.lon, cluster.lat, self.cluster_radius_m)
+        if cell != cluster.cell:
+            grid[cluster.cell].remove(cluster)
+            cluster.cell = cell
+            self._cell_clusters(grid, cell).append(cluster)
+
+    def _metadata(self, name):
+        return self._connection.execute(
+            'SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()[0]
+
+    def _create_schema(self, cluster_radius_m):
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS rides (
+                    id INTEGER PRIMARY KEY, ride_key TEXT UNIQUE, name TEXT,
+                    merged TEXT, num_spikes INTEGER);
+                CREATE TABLE IF NOT EXISTS clusters (
+                    id INTEGER PRIMARY KEY, cell_x INTEGER, cell_y INTEGER,
+                    lon REAL, lat REAL, hits INTEGER, last_seen_ns INTEGER);
+                CREATE INDEX IF NOT EXISTS clusters_cell
+                    ON clusters (cell_x, cell_y);
+                CREATE TABLE IF NOT EXISTS spikes (
+                    cluster_id INTEGER, ride_id INTEGER, ts_ns INTEGER,
+                    lon REAL, lat REAL, magnitude_millig REAL);
+                CREATE INDEX IF NOT EXISTS spikes_cluster
+                    ON spikes (cluster_id);
+            ''')
+            self._connection.execute(
+                'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                ('cluster_radius_m', str(float(cluster_radius_m))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print spike hotspots as lines of JSON, most hit first.')
+    parser.add_argument('database', type=pathlib.Path)
+    parser.add_argument(
+        '--bbox', type=tiles.parse_bounds,
+        help='Only clusters within a bounding box '
+        '<min_lon>,<min_lat>,<max_lon>,<max_lat>.')
+    parser.add_argument(
+        '--min-rides', type=int, default=1,
+        help='Only print clusters with spikes of at least this many rides.')
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f'No database at {args.database}.')
+    store = HotspotStore(args.database, read_only=True)
+    clusters = store.query(args.bbox)
+    store.close()
+    for cluster in clusters:
+        if cluster['rides'] < args.min_rides:
+            continue
+        cluster['last_seen'] = analysis.ns_to_datetime(
+            cluster.pop('last_seen_ns')).isoformat()
+        print(json.dumps(cluster))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,128 @@
+"""
+Timing and profiling of the stages of analyzing a file.
+
+timed_stage() logs a record for each stage with the attributes stage,
+seconds and path (the file being analyzed, as set by file_context()), so that
+handlers can process them in a structured way. While memory is traced, the
+records of outermost stages also have a peak_memory_bytes attribute.
+
+profiled() additionally runs cProfile and tracemalloc for a file and writes a
+pstats dump and a summary of stage times and memory usage next to it.
+"""
+import contextlib
+import contextvars
+import cProfile
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+NUM_TOP_ALLOCATIONS = 10
+
+_current_path = contextvars.ContextVar('current_path', default=None)
+_stage_depth = contextvars.ContextVar('stage_depth', default=0)
+_stage_records = contextvars.ContextVar('stage_records', default=None)
+_run_peaks = contextvars.ContextVar('run_peaks', default=None)
+
+
+@contextlib.contextmanager
+def file_context(path):
+    """Attribute stages within the context to the file at path."""
+    token = _current_path.set(path)
+    try:
+        yield
+    finally:
+        _current_path.reset(token)
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Time the enclosed code and log it as stage.
+
+    Stages may be nested. The peak memory is only measured for outermost
+    stages, since measuring it resets the peak.
+    """
+    depth = _stage_depth.get()
+    depth_token = _stage_depth.set(depth + 1)
+    measure_memory = depth == 0 and tracemalloc.is_tracing()
+    if measure_memory:
+        _reset_peak()
+        start_memory, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _stage_depth.reset(depth_token)
+        path = _current_path.get()
+        fields = {'stage': stage, 'seconds': seconds, 'path': path}
+        if measure_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            fields['peak_memory_bytes'] = peak - start_memory
+        records = _stage_records.get()
+        if records is not None:
+            records.append(fields)
+        logger.info(
+            f'Stage {stage}{f" of {path}" if path else ""} took '
+            f'{seconds:.3f}s.', extra=fields)
+
+
+@contextlib.contextmanager
+def profiled(base_path):
+    """
+    Profile the enclosed code with cProfile and trace its memory allocations.
+
+    Writes the profile to base_path with suffix .prof (readable with pstats)
+    and a summary of stages, peak memory and the largest allocations still
+    held at the end to base_path with suffix .memory.txt.
+    """
+    records_token = _stage_records.set([])
+    peaks_token = _run_peaks.set([])
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        # Stages reset the peak, so it is the largest of theirs and the last.
+        peak = max([peak, *_run_peaks.get()])
+        _run_peaks.reset(peaks_token)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        records = _stage_records.get()
+        _stage_records.reset(records_token)
+        profile_path = base_path.parent / (base_path.name + '.prof')
+        profiler.dump_stats(profile_path)
+        summary_path = base_path.parent / (base_path.name + '.memory.txt')
+        with open(summary_path, 'w') as file:
+            file.write(_memory_summary(peak, records, snapshot))
+        logger.info(f'Saved profile to {profile_path} and {summary_path}.')
+
+
+def _reset_peak():
+    peaks = _run_peaks.get()
+    if peaks is not None:
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak)
+    tracemalloc.reset_peak()
+
+
+def _memory_summary(peak, records, snapshot):
+    lines = [f'Peak traced memory: {_mib(peak)}', '', 'Stages:']
+    for record in records:
+        line = f'  {record["stage"]}: {record["seconds"]:.3f}s'
+        if 'peak_memory_bytes' in record:
+            line += f', peak {_mib(record["peak_memory_bytes"])}'
+        lines.append(line)
+    lines += ['', 'Largest allocations held at the end:']
+    for stat in snapshot.statistics('lineno')[:NUM_TOP_ALLOCATIONS]:
+        lines.append(f'  {stat}')
+    return '\n'.join(lines) + '\n'
+
+
+def _mib(num_bytes):
+    return f'{num_bytes / 2**20:.1f} MiB'
@@ -0,0 +1,530 @@
+"""
+Plotting of analyzed tracks with matplotlib and cartopy.
+
+Importing this module is slow, so it should only be imported when a figure is
+actually produced.
+"""
+import collections
+import io
+import logging
+import math
+import pathlib
+import threading
+
+import cartopy
+import cartopy.crs
+import cartopy.io.img_tiles
+import cartopy.mpl.geoaxes
+import matplotlib.collections
+import matplotlib.dates
+import matplotlib.pyplot as plt
+import numpy as np
+import PIL.Image
+
+import analysis
+import colors
+import decimation
+import heatmap
+import instrumentation
+import tiles
+
+logger = logging.getLogger(__name__)
+
+# Increment whenever stitching tiles changes, to invalidate cached basemaps.
+BASEMAP_CACHE_VERSION = 1
+BASEMAP_MEMORY_CACHE_MAX_BYTES = 256 * 2**20
+# Points drawn per horizontal pixel of the dynamics graphs.
+DECIMATED_POINTS_PER_PIXEL = 2
+OSM_CACHE_KEY = 'osm'
+
+# Stitched basemaps by key, least recently used first.
+_basemap_memory_cache = collections.OrderedDict()
+
+
+class MapSubplot:
+    def __init__(
+            self, figure, gridspec, conf, tile_source=None,
+            basemap_cache=None):
+        self.figure = figure
+        self.gridspec = gridspec
+        self.conf = conf
+        self.tile_source = tile_source
+        self.basemap_cache = basemap_cache
+        self._axes = None
+        self.projection = cartopy.crs.Mercator.GOOGLE
+        cartopy.config['cache_dir'] = (
+            pathlib.Path(__file__).parent.parent / 'cartopy_cache')
+        self._basemap_key = getattr(tile_source, 'cache_key', None)
+        if self.tile_source is None:
+            self.tile_source = cartopy.io.img_tiles.OSM(
+                desired_tile_form='L', cache=True)
+            self._basemap_key = OSM_CACHE_KEY
+
+    def plot(self, track, extent=None, zoom_level=None):
+        """
+        Plot the map of a track.
+
+        By default, the map shows the whole track at the highest zoom level
+        that fits the tile budget. extent (min_lon, max_lon, min_lat, max_lat)
+        and zoom_level override this, e.g. to show part of the track.
+        """
+        self._add_basemap(
+            self._buffered_bounds(track.bounds, 0.1) if extent is None
+            else extent, zoom_level)
+        with instrumentation.timed_stage('overlay'):
+            self._plot_track(track)
+            if self.conf.plot_spikes:
+                self._plot_spikes(track)
+
+    def plot_raster(self, raster):
+        """
+        Plot the mean of each pixel of a heatmap.HeatmapRaster over the map,
+        colored like track slices.
+        """
+        self._add_basemap(self._buffered_bounds(raster.bounds, 0.1))
+        with instrumentation.timed_stage('overlay'):
+            sums, counts, pixel_zoom, x0, y0 = raster.planes()
+            rgbas = colors.colors_for_accels(
+                sums / np.maximum(counts, 1), self.conf)
+            rgbas[counts == 0, 3] = 0
+            self._axes.imshow(
+                rgbas, origin='upper',
+                extent=heatmap.mercator_extent(
+                    pixel_zoom, x0, y0, counts.shape),
+                transform=self.projection, interpolation='nearest', zorder=2)
+
+    def _add_basemap(self, extent, zoom_level=None):
+        self._axes = self.figure.add_subplot(
+            self.gridspec, axes_class=self._geo_axes_class_with_projection())
+        if zoom_level is None:
+            zoom_level = self.zoom_level_within_budget(extent)
+        self._axes.set_extent(extent, crs=self.projection.as_geodetic())
+        # Tiles are only fetched when the figure is drawn.
+        tile_source = self.tile_source
+        if self._basemap_key is not None:
+            tile_source = _CachedBasemap(
+                tile_source, self._basemap_key, self.basemap_cache)
+        self._axes.add_image(
+            _TimedTileSource(tile_source), zoom_level, cmap='gray')
+
+    def _plot_track(self, track):
+        att_abs_accels = track.rolling_average_absolute_accels(
+            self.conf.rolling_average_window_duration_seconds,
+            self.conf.attenuator)
+        if not len(track):
+            return
+        starts, _ = track.slice_bounds(self.conf.track_time_slice_seconds)
+        avg_att_abs_accels = track.slice_means(
+            self.conf.track_time_slice_seconds, att_abs_accels)
+        # Draw all slices as a single artist in map coordinates, rather than
+        # one geometry per slice that cartopy would project separately.
+        segments = np.split(
+            self._project(track.lons, track.lats), starts[1:])
+        self._axes.add_collection(
+            matplotlib.collections.LineCollection(
+                segments, linewidths=3,
+                colors=colors.colors_for_accels(
+                    avg_att_abs_accels, self.conf)),
+            autolim=False)
+
+    def _plot_spikes(self, track):
+        mids, max_accels = track.spikes(
+            self.conf.spike_time_slice_seconds,
+            self.conf.spike_lower_limit_millig)
+        if not len(mids):
+            return
+        accels_over_min = max_accels - self.conf.spike_lower_limit_millig
+        spike_range = (
+            self.conf.spike_upper_limit_millig
+            - self.conf.spike_lower_limit_millig)
+        markersizes = 5 + 10 * analysis.capped_fraction(
+            accels_over_min, spike_range)
+        points = self._project(track.lons[mids], track.lats[mids])
+        # Scatter sizes are areas, marker sizes diameters.
+        self._axes.scatter(
+            points[:, 0], points[:, 1], s=markersizes**2, color='purple',
+            alpha=0.5, linewidths=1, zorder=2, transform=self.projection)
+
+    def _geo_axes_class_with_projection(self):
+        # We have to create a GeoAxes class that hardcodes our desired
+        # projection because matplotlib won't let us pass a kwarg named
+        # projection through to the axes class.
+        projection = self.projection
+
+        class GeoAxes(cartopy.mpl.geoaxes.GeoAxes):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs, projection=projection)
+
+        return GeoAxes
+
+    def zoom_level_within_budget(self, extent):
+        """
+        Return the zoom level for an extent, reduced until the number of
+        tiles fits conf.max_tiles.
+        """
+        requested_zoom_level = self._zoom_level_for_extent(*extent)
+        zoom_level = requested_zoom_level
+        while (zoom_level > 0
+               and self._num_tiles(extent, zoom_level) > self.conf.max_tiles):
+            zoom_level -= 1
+        num_tiles = self._num_tiles(extent, zoom_level)
+        if zoom_level < requested_zoom_level:
+            logger.warning(
+                f'Reduced zoom level from {requested_zoom_level} to '
+                f'{zoom_level} to stay within {self.conf.max_tiles} tiles '
+                f'({self._num_tiles(extent, requested_zoom_level)} needed).')
+        logger.info(f'Map uses {num_tiles} tiles at zoom level {zoom_level}.')
+        return zoom_level
+
+    def page_extents(self, track, zoom_level):
+        """
+        Split the map of a track into pages that each fit the tile budget at
+        zoom_level.
+
+        The track is split between chunks of track.slice_bounds() for the
+        track time slice, greedily starting a new page whenever the next chunk
+        doesn't fit. A single chunk that doesn't fit gets a page of its own.
+        Returns the extents of the pages.
+        """
+        starts, _ = track.slice_bounds(self.conf.track_time_slice_seconds)
+        chunk_bounds = np.column_stack([
+            np.minimum.reduceat(track.lons, starts),
+            np.minimum.reduceat(track.lats, starts),
+            np.maximum.reduceat(track.lons, starts),
+            np.maximum.reduceat(track.lats, starts)])
+        extents = []
+        page_bounds = None
+        for bounds in chunk_bounds:
+            if page_bounds is None:
+                page_bounds = bounds
+                continue
+            merged_bounds = np.concatenate([
+                np.minimum(page_bounds[:2], bounds[:2]),
+                np.maximum(page_bounds[2:], bounds[2:])])
+            if self._num_tiles(
+                    self._buffered_bounds(merged_bounds, 0.1),
+                    zoom_level) > self.conf.max_tiles:
+                extents.append(self._buffered_bounds(page_bounds, 0.1))
+                page_bounds = bounds
+            else:
+                page_bounds = merged_bounds
+        if page_bounds is not None:
+            extents.append(self._buffered_bounds(page_bounds, 0.1))
+        return extents
+
+    @staticmethod
+    def _num_tiles(extent, zoom_level):
+        min_lon, max_lon, min_lat, max_lat = extent
+        xs, ys = tiles.tile_range(
+            min_lon, min_lat, max_lon, max_lat, zoom_level)
+        return len(xs) * len(ys)
+
+    def _zoom_level_for_extent(self, min_lon, max_lon, min_lat, max_lat):
+        lon_fraction = (max_lon - min_lon) / 90
+        lat_fraction = (max_lat - min_lat) / 180
+        doublings = math.log2(1 / max(lon_fraction, lat_fraction))
+        # Zoom level 2 as base for the entire world.
+        base_zoom_level = 2 + self.conf.extra_zoom
+        return base_zoom_level + math.ceil(doublings)
+
+    @staticmethod
+    def _buffered_bounds(bounds, buffer_fraction):
+        min_x, min_y, max_x, max_y = bounds
+        width = max_x - min_x
+        height = max_y - min_y
+        buffer_x = width * buffer_fraction
+        buffer_y = height * buffer_fraction
+        return (
+            min_x - buffer_x, max_x + buffer_x, min_y - buffer_y,
+            max_y + buffer_y)
+
+    def _project(self, lons, lats):
+        """Transform geodetic coordinates to map coordinates in one go."""
+        return self.projection.transform_points(
+            self.projection.as_geodetic(), np.asarray(lons),
+            np.asarray(lats))[:, :2]
+
+
+class StoredTiles(cartopy.io.img_tiles.GoogleWTS):
+    """
+    Tiles read from a local store (see tiles.open_store()) instead of being
+    downloaded. Missing tiles are drawn blank.
+
+    get_image() reads tiles from the store, so the URLs of tiles are only
+    used to name them. They are the store's tile URIs.
+    """
+
+    def __init__(self, store, desired_tile_form='L'):
+        super().__init__(desired_tile_form=desired_tile_form)
+        self.store = store
+        self._warned_about_missing_tiles = False
+        # Tiles are read in several threads.
+        self._lock = threading.Lock()
+
+    def get_image(self, tile):
+        x, y, z = tile
+        data = self.store.get(x, y, z)
+        if data is None:
+            with self._lock:
+                warn = not self._warned_about_missing_tiles
+                self._warned_about_missing_tiles = True
+            if warn:
+                logger.warning(
+                    f'Tile {self._image_url(tile)} and possibly more are '
+                    'missing from the tile store, drawing them blank.')
+            image = PIL.Image.new('L', (256, 256), 250)
+        else:
+            image = PIL.Image.open(io.BytesIO(data))
+        return (
+            image.convert(self.desired_tile_form), self.tileextent(tile),
+            'lower')
+
+    @property
+    def cache_key(self):
+        return self.store.cache_key
+
+    def _image_url(self, tile):
+        x, y, z = tile
+        return self.store.tile_uri(x, y, z)
+
+
+def tile_source_for_spec(spec):
+    """
+    Return a tile source for a tiles.TileSourceSpec, or None for the default
+    (downloading from OpenStreetMap).
+    """
+    store = tiles.open_store(spec)
+    if store is None:
+        return None
+    return StoredTiles(store)
+
+
+class _CachedBasemap:
+    """
+    Forwards to a tile source and caches the stitched images it returns.
+
+    Images are kept in memory for the whole process (up to
+    BASEMAP_MEMORY_CACHE_MAX_BYTES) and, if a disk cache (a
+    track_cache.ArrayCache) is given, on disk. They are keyed by source_key,
+    the zoom level and the exact set of tiles, so a map of the same area is
+    only read and stitched once.
+    """
+
+    def __init__(self, tile_source, source_key, disk_cache=None):
+        self._tile_source = tile_source
+        self._source_key = source_key
+        self._disk_cache = disk_cache
+
+    def __getattr__(self, name):
+        return getattr(self._tile_source, name)
+
+    def image_for_domain(self, target_domain, target_z):
+        tiles = sorted(
+            self._tile_source.find_images(target_domain, target_z))
+        key = f'{self._source_key}|{target_z}|{tiles}'
+        basemap = _basemap_memory_cache.get(key)
+        if basemap is not None:
+            _basemap_memory_cache.move_to_end(key)
+            return basemap
+        if self._disk_cache is not None:
+            arrays = self._disk_cache.load(key)
+            if arrays is not None:
+                basemap = (
+                    arrays['image'], tuple(arrays['extent'].tolist()),
+                    str(arrays['origin']))
+        if basemap is None:
+            basemap = self._tile_source.image_for_domain(
+                target_domain, target_z)
+            if self._disk_cache is not None:
+                image, extent, origin = basemap
+                try:
+                    self._disk_cache.store(key, {
+                        'image': image, 'extent': np.array(extent),
+                        'origin': np.array(origin)})
+                except OSError as e:
+                    logger.warning(f'Failed to cache basemap: {e}')
+        self._remember(key, basemap)
+        return basemap
+
+    @staticmethod
+    def _remember(key, basemap):
+        _basemap_memory_cache[key] = basemap
+        total_size = sum(
+            image.nbytes for image, _, _ in _basemap_memory_cache.values())
+        while total_size > BASEMAP_MEMORY_CACHE_MAX_BYTES:
+            _, (image, _, _) = _basemap_memory_cache.popitem(last=False)
+            total_size -= image.nbytes
+
+
+class _TimedTileSource:
+    """
+    Forwards to a tile source and times fetching images as stage tile_fetch.
+    """
+
+    def __init__(self, tile_source):
+        self._tile_source = tile_source
+
+    def __getattr__(self, name):
+        return getattr(self._tile_source, name)
+
+    def image_for_domain(self, *args, **kwargs):
+        with instrumentation.timed_stage('tile_fetch'):
+            return self._tile_source.image_for_domain(*args, **kwargs)
+
+
+def plot_track(
+        track, path, plot_separately, conf, tile_source=None,
+        basemap_cache=None):
+    def make_figure():
+        figure = plt.figure(
+            layout='constrained', figsize=(19.2, 10.8), dpi=100)
+        figure.suptitle(f'{path}\n{conf}')
+        return figure
+
+    if plot_separately:
+        dynamics_figure, map_figure = make_figure(), make_figure()
+        figures = [(dynamics_figure, path.with_name(path.name + '.graphs')),
+                   (map_figure, path.with_name(path.name + '.map'))]
+        dynamics_specs = list(
+            dynamics_figure.add_gridspec(3, 1, height_ratios=[2, 1, 2]))
+        map_spec = map_figure.add_gridspec(1, 1)[0]
+    else:
+        figure = make_figure()
+        dynamics_figure = map_figure = figure
+        figures = [(figure, path)]
+        gridspec = figure.add_gridspec(
+            3, 2, figure=figure, height_ratios=[2, 1, 2])
+        dynamics_specs = [gridspec[0, 0:1], gridspec[1, 0:1], gridspec[2, 0:1]]
+        map_spec = gridspec[0:, 1]
+    add_dynamics_subplots(track, dynamics_figure, dynamics_specs, conf)
+    map_subplot = MapSubplot(
+        map_figure, map_spec, conf, tile_source, basemap_cache)
+    map_subplot.plot(track)
+    if conf.split_map:
+        figures += _plot_map_pages(
+            track, path, map_subplot, tile_source, basemap_cache,
+            make_figure)
+    return figures
+
+
+def plot_heatmap(raster, path, conf, tile_source=None, basemap_cache=None):
+    """
+    Plot a heatmap.HeatmapRaster over the map. Returns the figure with the
+    path to save it to.
+    """
+    figure = plt.figure(layout='constrained', figsize=(19.2, 10.8), dpi=100)
+    figure.suptitle(
+        f'{path}\n{len(raster)} rides; '
+        f'track range: {conf.track_lower_limit_millig}mg-'
+        f'{conf.track_upper_limit_millig}mg; {raster.settings}')
+    map_subplot = MapSubplot(
+        figure, figure.add_gridspec(1, 1)[0], conf, tile_source,
+        basemap_cache)
+    map_subplot.plot_raster(raster)
+    return [(figure, path)]
+
+
+def _plot_map_pages(
+        track, path, map_subplot, tile_source, basemap_cache, make_figure):
+    """
+    Plot the map split into pages at the zoom level the whole map would have
+    without a tile budget. Returns no pages if that already fits the budget.
+    """
+    extent = map_subplot._buffered_bounds(track.bounds, 0.1)
+    zoom_level = map_subplot._zoom_level_for_extent(*extent)
+    conf = map_subplot.conf
+    if map_subplot._num_tiles(extent, zoom_level) <= conf.max_tiles:
+        return []
+    page_extents = map_subplot.page_extents(track, zoom_level)
+    logger.info(
+        f'Splitting the map into {len(page_extents)} pages at zoom level '
+        f'{zoom_level}.')
+    figures = []
+    for i, page_extent in enumerate(page_extents, 1):
+        figure = make_figure()
+        page_subplot = MapSubplot(
+            figure, figure.add_gridspec(1, 1)[0], conf, tile_source,
+            basemap_cache)
+        page_subplot.plot(track, page_extent, zoom_level)
+        figures.append((figure, path.with_name(f'{path.name}.map{i}')))
+    return figures
+
+
+def add_dynamics_subplots(track, figure, gridspecs, conf):
+    assert len(gridspecs) == 3
+    accel_axes = figure.add_subplot(gridspecs[0])
+    speed_axes = figure.add_subplot(gridspecs[1], sharex=accel_axes)
+    accel_analysis_axes = figure.add_subplot(gridspecs[2], sharex=accel_axes)
+    _DecimatedLine(
+        accel_axes, track.tss, track.accels, conf.decimation, color='black',
+        label='Raw acceleration')
+    accel_axes.yaxis.set_label_text('mg')
+    accel_axes.hlines([
+        conf.spike_lower_limit_millig, conf.spike_upper_limit_millig,
+        -conf.spike_lower_limit_millig, -conf.spike_upper_limit_millig],
+                      track.tss[0], track.tss[-1], linestyles='dashed')
+    accel_axes.legend()
+    _DecimatedLine(
+        speed_axes, track.tss, track.speeds_kph, conf.decimation,
+        color='black', label='Speed')
+    speed_axes.yaxis.set_label_text('km/h')
+    speed_axes.hlines([conf.attenuator.speed_cap], track.tss[0], track.tss[-1],
+                      linestyles='dashed')
+    speed_axes.legend()
+    _DecimatedLine(
+        accel_analysis_axes, track.tss,
+        track.rolling_average_absolute_accels(
+            conf.rolling_average_window_duration_seconds, attenuator=None),
+        conf.decimation, color='black', label='Absolute acceleration')
+    _DecimatedLine(
+        accel_analysis_axes, track.tss,
+        track.rolling_average_absolute_accels(
+            conf.rolling_average_window_duration_seconds, conf.attenuator),
+        conf.decimation, color='blue',
+        label='Attenuated absolute acceleration')
+    accel_analysis_axes.yaxis.set_label_text('mg')
+    accel_analysis_axes.hlines([conf.track_lower_limit_millig], track.tss[0],
+                               track.tss[-1], linestyles='dashed')
+    accel_analysis_axes.hlines([conf.track_upper_limit_millig], track.tss[0],
+                               track.tss[-1], linestyles='dashed')
+    accel_analysis_axes.legend()
+
+
+class _DecimatedLine:
+    """
+    A line of a long series, drawn with DECIMATED_POINTS_PER_PIXEL points per
+    horizontal pixel of its axes.
+
+    Whenever the x limits change, e.g. by zooming or panning in the
+    interactive window, the visible range is decimated again, so zooming in
+    reveals all samples.
+    """
+
+    def __init__(self, axes, tss, values, method, **kwargs):
+        self._tss = tss
+        self._values = values
+        self._method = method
+        self._xs = matplotlib.dates.date2num(tss)
+        indices = self._decimated_indices(axes, 0, len(tss))
+        self._line, = axes.plot(tss[indices], values[indices], **kwargs)
+        if method != 'none':
+            # Callback registries only keep weak references to methods, but
+            # nothing else references this object.
+            axes.callbacks.connect(
+                'xlim_changed', lambda axes: self._update(axes))
+
+    def _update(self, axes):
+        min_x, max_x = axes.get_xlim()
+        # One sample beyond each side, so the line continues to the edges.
+        start = max(np.searchsorted(self._xs, min_x) - 1, 0)
+        stop = min(
+            np.searchsorted(self._xs, max_x, side='right') + 1, len(self._xs))
+        indices = self._decimated_indices(axes, start, stop)
+        self._line.set_data(self._tss[indices], self._values[indices])
+
+    def _decimated_indices(self, axes, start, stop):
+        num_points = max(
+            int(axes.bbox.width * DECIMATED_POINTS_PER_PIXEL), 2)
+        return start + decimation.decimate(
+            self._xs[start:stop], self._values[start:stop], num_points,
+            self._method)
@@ -0,0 +1,385 @@
+"""
+A database of ingested rides.
+
+Ingesting a .fit file stores its decoded columns and a row per track slice
+(time span, bounding box, length, mean attenuated and maximum absolute
+acceleration) in an SQLite database. Slices are indexed by start time and, in
+an R*Tree, by bounding box, so questions about many rides, like which of them
+crossed an area or where roads were worst within a month, are answered
+without parsing any files. Rides are identified by a hash of their file's
+content and only stored once.
+
+Slices depend on the track time slice, rolling average window and
+attenuation, which are fixed when the database is created.
+
+RideStoreCache serves the stored columns to Track.from_path() like a
+TrackCache, so ingested rides can be analyzed and plotted without parsing
+them again. Query a database with
+    python src/ride_store.py <database> rides [--bbox <bbox>]
+        [--since <date>] [--until <date>]
+    python src/ride_store.py <database> worst [--km <length>]
+        [--bbox <bbox>] [--since <date>] [--until <date>]
+"""
+import argparse
+import datetime
+import io
+import json
+import logging
+import pathlib
+import sqlite3
+
+import numpy as np
+
+import analysis
+import tiles
+import track_cache
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6_371_008.8
+DEFAULT_WORST_LENGTH_KM = 10
+SLICE_COLUMNS = (
+    'start_ns', 'end_ns', 'min_lon', 'min_lat', 'max_lon', 'max_lat',
+    'length_m', 'mean_attenuated_accel_millig', 'max_abs_accel_millig')
+
+
+def slice_table(track, conf):
+    """
+    Return the slices of a track analyzed with an AnalysisConfig as a dict
+    mapping SLICE_COLUMNS to arrays.
+
+    Slices are those drawn on the map, i.e. track.slice_bounds() for the
+    configured track time slice.
+    """
+    if not len(track):
+        return {name: np.empty(0) for name in SLICE_COLUMNS}
+    att_abs_accels = track.rolling_average_absolute_accels(
+        conf.rolling_average_window_duration_seconds, conf.attenuator)
+    starts, stops = track.slice_bounds(conf.track_time_slice_seconds)
+    # Lengths of the segments between consecutive positions, summed up to
+    # each position.
+    lons, lats = np.radians(track.lons), np.radians(track.lats)
+    haversines = (
+        np.sin(np.diff(lats) / 2)**2
+        + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(lons) / 2)**2)
+    distances = np.concatenate(([0], np.cumsum(
+        2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(haversines)))))
+    return {
+        'start_ns': track.tss_ns[starts],
+        'end_ns': track.tss_ns[stops - 1],
+        'min_lon': np.minimum.reduceat(track.lons, starts),
+        'min_lat': np.minimum.reduceat(track.lats, starts),
+        'max_lon': np.maximum.reduceat(track.lons, starts),
+        'max_lat': np.maximum.reduceat(track.lats, starts),
+        'length_m': distances[stops - 1] - distances[starts],
+        'mean_attenuated_accel_millig': track.slice_means(
+            conf.track_time_slice_seconds, att_abs_accels),
+        'max_abs_accel_millig': np.maximum.reduceat(
+            np.abs(track.accels), starts),
+    }
+
+
+class RideStore:
+    """
+    Rides in an SQLite database.
+
+    If an AnalysisConfig is given, rides can be added. It must match the
+    settings the database was created with. With read_only, the database
+    must exist (FileNotFoundError is raised otherwise) and is never written.
+    """
+
+    def __init__(self, path, conf=None, read_only=False):
+        self.path = pathlib.Path(path)
+        if read_only:
+            if not self.path.exists():
+                raise FileNotFoundError(f'No ride store at {self.path}.')
+            self._connection = sqlite3.connect(
+                f'{self.path.resolve().as_uri()}?mode=ro', uri=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+        self._connection.row_factory = sqlite3.Row
+        if not read_only:
+            self._create_schema()
+        self._settings = None
+        if conf is not None:
+            self._settings = self._check_settings(conf)
+
+    def contains(self, content_hash):
+        return self._connection.execute(
+            'SELECT 1 FROM rides WHERE content_hash = ?',
+            (content_hash,)).fetchone() is not None
+
+    def add(self, content_hash, name, arrays, slices):
+        """
+        Add a ride, given its MessageColumns.to_arrays() and slice_table().
+
+        Returns False if the ride was already stored.
+        """
+        if self._settings is None:
+            raise ValueError('Rides can only be added with a configuration.')
+        start_ns, end_ns = (
+            (int(slices['start_ns'][0]), int(slices['end_ns'][-1]))
+            if len(slices['start_ns']) else (None, None))
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO rides (content_hash, name, start_ns, '
+                'end_ns, num_messages, ingested) VALUES (?, ?, ?, ?, ?, ?)',
+                (content_hash, name, start_ns, end_ns,
+                 len(arrays['message_tss']),
+                 datetime.datetime.now().isoformat(timespec='seconds')))
+            if not cursor.rowcount:
+                return False
+            ride_id = cursor.lastrowid
+            self._connection.executemany(
+                'INSERT INTO ride_columns (ride_id, name, data) '
+                'VALUES (?, ?, ?)',
+                [(ride_id, name, _array_bytes(array))
+                 for name, array in arrays.items()])
+            first_id, = self._connection.execute(
+                'SELECT COALESCE(MAX(id), 0) + 1 FROM slices').fetchone()
+            ids = range(first_id, first_id + len(slices['start_ns']))
+            columns = [slices[name].tolist() for name in SLICE_COLUMNS]
+            self._connection.executemany(
+                'INSERT INTO slices (id, ride_id, start_ns, end_ns, length_m, '
+                'mean_attenuated_accel_millig, max_abs_accel_millig) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(slice_id, ride_id, start, end, length, mean, max_abs)
+                 for slice_id, (start, end, _, _, _, _, length, mean, max_abs)
+                 in zip(ids, zip(*columns))])
+            self._connection.executemany(
+                'INSERT INTO slice_bounds (id, min_lon, max_lon, min_lat, '
+                'max_lat) VALUES (?, ?, ?, ?, ?)',
+                [(slice_id, min_lon, max_lon, min_lat, max_lat)
+                 for slice_id, (_, _, min_lon, min_lat, max_lon, max_lat, *_)
+                 in zip(ids, zip(*columns))])
+        return True
+
+    def load_columns(self, content_hash):
+        """
+        Return the MessageColumns.to_arrays() of a ride, or None if it isn't
+        stored.
+        """
+        if self._metadata('columns_version') != str(
+                analysis.Track.CACHE_VERSION):
+            return None
+        rows = self._connection.execute(
+            'SELECT ride_columns.name, data FROM ride_columns '
+            'JOIN rides ON rides.id = ride_id WHERE content_hash = ?',
+            (content_hash,)).fetchall()
+        if not rows:
+            return None
+        return {
+            row['name']: np.load(io.BytesIO(row['data']), allow_pickle=False)
+            for row in rows}
+
+    def rides(self, bounds=None, since=None, until=None):
+        """
+        Return the rides with a slice intersecting bounds (min_lon, min_lat,
+        max_lon, max_lat) within the time from since to until (datetimes,
+        in UTC if naive), each of which may be None. Rides are dicts of their
+        columns, ordered by start time.
+        """
+        conditions, parameters = self._slice_conditions(bounds, since, until)
+        return [dict(row) for row in self._connection.execute(
+            'SELECT DISTINCT rides.id, rides.name, rides.content_hash, '
+            'rides.start_ns, rides.end_ns FROM slices '
+            'JOIN rides ON rides.id = slices.ride_id '
+            f'{self._bounds_join(bounds)} WHERE {conditions} '
+            'ORDER BY rides.start_ns', parameters)]
+
+    def worst_slices(
+            self, length_m, bounds=None, since=None, until=None):
+        """
+        Yield the slices with the highest mean attenuated acceleration until
+        their total length reaches length_m, optionally limited to bounds and
+        to the time from since to until as for rides().
+
+        Slices are dicts of their columns plus the ride's name.
+        """
+        conditions, parameters = self._slice_conditions(bounds, since, until)
+        total_length_m = 0
+        for row in self._connection.execute(
+                'SELECT slices.*, slice_bounds.min_lon, slice_bounds.min_lat, '
+                'slice_bounds.max_lon, slice_bounds.max_lat, rides.name '
+                'FROM slices JOIN rides ON rides.id = slices.ride_id '
+                'JOIN slice_bounds ON slice_bounds.id = slices.id '
+                f'WHERE {conditions} '
+                'ORDER BY mean_attenuated_accel_millig DESC', parameters):
+            if total_length_m >= length_m:
+                break
+            total_length_m += row['length_m']
+            yield dict(row)
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _bounds_join(bounds):
+        if bounds is None:
+            return ''
+        return 'JOIN slice_bounds ON slice_bounds.id = slices.id'
+
+    @staticmethod
+    def _slice_conditions(bounds, since, until):
+        conditions = ['1']
+        parameters = []
+        if bounds is not None:
+            min_lon, min_lat, max_lon, max_lat = bounds
+            conditions += [
+                'slice_bounds.max_lon >= ?', 'slice_bounds.min_lon <= ?',
+                'slice_bounds.max_lat >= ?', 'slice_bounds.min_lat <= ?']
+            parameters += [min_lon, max_lon, min_lat, max_lat]
+        if since is not None:
+            conditions.append('slices.end_ns >= ?')
+            parameters.append(analysis.datetime_to_ns(since))
+        if until is not None:
+            conditions.append('slices.start_ns < ?')
+            parameters.append(analysis.datetime_to_ns(until))
+        return ' AND '.join(conditions), parameters
+
+    def _metadata(self, name):
+        row = self._connection.execute(
+            'SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row['value']
+
+    def _check_settings(self, conf):
+        settings = {
+            'columns_version': str(analysis.Track.CACHE_VERSION),
+            'track_time_slice_seconds': str(conf.track_time_slice_seconds),
+            'rolling_average_window_duration_seconds':
+                str(conf.rolling_average_window_duration_seconds),
+            'attenuation': conf.attenuator.spec,
+        }
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                settings.items())
+        mismatches = [
+            f'{name} {self._metadata(name)}'
+            for name, value in settings.items()
+            if self._metadata(name) != value]
+        if mismatches:
+            raise ValueError(
+                f'{self.path} was created with different settings '
+                f'({", ".join(mismatches)}).')
+        return settings
+
+    def _create_schema(self):
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS rides (
+                    id INTEGER PRIMARY KEY, content_hash TEXT UNIQUE,
+                    name TEXT, start_ns INTEGER, end_ns INTEGER,
+                    num_messages INTEGER, ingested TEXT);
+                CREATE INDEX IF NOT EXISTS rides_start ON rides (start_ns);
+                CREATE TABLE IF NOT EXISTS ride_columns (
+                    ride_id INTEGER, name TEXT, data BLOB,
+                    PRIMARY KEY (ride_id, name)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS slices (
+                    id INTEGER PRIMARY KEY, ride_id INTEGER,
+                    start_ns INTEGER, end_ns INTEGER, length_m REAL,
+                    mean_attenuated_accel_millig REAL,
+                    max_abs_accel_millig REAL);
+                CREATE INDEX IF NOT EXISTS slices_start ON slices (start_ns);
+                CREATE INDEX IF NOT EXISTS slices_ride ON slices (ride_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS slice_bounds USING rtree(
+                    id, min_lon, max_lon, min_lat, max_lat);
+            ''')
+
+
+class RideStoreCache:
+    """
+    Serves the columns of rides in a RideStore to Track.from_path().
+
+    Rides that aren't stored are taken from or stored in fallback, a
+    TrackCache, if given. Files are looked up by the content hashes in the
+    fallback's index if there is one. The database is opened read-only on
+    first use, so instances can be passed to worker processes.
+    """
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self._store = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'fallback': self.fallback, '_store': None}
+
+    def load(self, file_path):
+        if self._store is None:
+            self._store = RideStore(self.path, read_only=True)
+        if self.fallback:
+            content_hash = self.fallback.content_hash(file_path)
+        else:
+            content_hash = track_cache.file_hash(file_path)
+        arrays = self._store.load_columns(content_hash)
+        if arrays is not None:
+            logger.debug(f'Loaded {file_path} from {self.path}.')
+            return arrays
+        if self.fallback:
+            return self.fallback.load(file_path)
+        return None
+
+    def store(self, file_path, arrays):
+        if self.fallback:
+            self.fallback.store(file_path, arrays)
+
+
+def _array_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _ns_to_iso(ns):
+    if ns is None:
+        return None
+    return analysis.ns_to_datetime(ns).isoformat()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query a database of rides written by analyze.py ingest. '
+        'Prints lines of JSON.')
+    parser.add_argument('database', type=pathlib.Path)
+    parser.add_argument(
+        'query', choices=('rides', 'worst'),
+        help='rides lists the rides with a slice matching the filters, worst '
+        'the worst slices.')
+    parser.add_argument(
+        '--bbox', type=tiles.parse_bounds,
+        help='Only slices intersecting a bounding box '
+        '<min_lon>,<min_lat>,<max_lon>,<max_lat>.')
+    parser.add_argument(
+        '--since', type=datetime.datetime.fromisoformat,
+        help='Only slices ending at or after this time (ISO format, UTC '
+        'unless it has an offset).')
+    parser.add_argument(
+        '--until', type=datetime.datetime.fromisoformat,
+        help='Only slices starting before this time (ISO format, UTC unless '
+        'it has an offset).')
+    parser.add_argument(
+        '--km', type=float, default=DEFAULT_WORST_LENGTH_KM,
+        help='Total length of the worst slices to print.')
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f'No database at {args.database}.')
+    store = RideStore(args.database, read_only=True)
+    if args.query == 'rides':
+        rows = store.rides(args.bbox, args.since, args.until)
+    else:
+        rows = store.worst_slices(
+            args.km * 1000, args.bbox, args.since, args.until)
+    for row in rows:
+        row['start'] = _ns_to_iso(row.pop('start_ns'))
+        row['end'] = _ns_to_iso(row.pop('end_ns'))
+        print(json.dumps(row))
+    store.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
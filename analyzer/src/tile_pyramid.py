@@ -0,0 +1,308 @@
+"""
+XYZ tile pyramids of the road quality overlay, for maps in a browser.
+
+The track slices of rides are drawn in the colors of the map plots onto
+transparent tiles of 256 by 256 pixels, written as <directory>/{z}/{x}/{y}.png
+for a range of zoom levels, 10 to 16 by default. Such a directory can be shown
+over a map, e.g. with Leaflet's L.tileLayer('<url>/{z}/{x}/{y}.png').
+
+Rides are added to a pyramid over time. The positions and slice means of each
+ride are kept in the pyramid's directory and the tiles each ride covers are
+recorded in a manifest, pyramid.json, so adding rides only renders the tiles
+they cover again, drawing all rides that cover them. Tiles are rendered by
+render_tile(), which can run in worker processes. Rides are identified by a
+hash of their file, so each is added once. The zoom levels and the settings
+that determine colors (track time slice, rolling average window, attenuation
+and track limits) are fixed when a pyramid is created.
+"""
+import collections
+import dataclasses as dc
+import io
+import json
+import logging
+import pathlib
+
+import numpy as np
+
+import colors
+import tiles
+import track_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ZOOM_LEVELS = range(10, 17)
+TILE_SIZE_PIXELS = 256
+LINE_WIDTH_PIXELS = 4
+MANIFEST_NAME = 'pyramid.json'
+RIDES_DIR_NAME = '.rides'
+# Rides projected to pixels at a zoom level, kept while rendering tiles.
+MAX_PROJECTED_RIDES = 64
+
+# Pyramids opened by render_tile() by directory and manifest version.
+_pyramids = {}
+
+
+@dc.dataclass
+class RideOverlay:
+    """Positions of a ride, its slices' start indices and their means."""
+    lons: np.ndarray
+    lats: np.ndarray
+    starts: np.ndarray
+    means: np.ndarray
+
+
+def ride_overlay(track, conf):
+    """Return the RideOverlay of a track analyzed with an AnalysisConfig."""
+    att_abs_accels = track.rolling_average_absolute_accels(
+        conf.rolling_average_window_duration_seconds, conf.attenuator)
+    starts, _ = track.slice_bounds(conf.track_time_slice_seconds)
+    return RideOverlay(
+        track.lons.astype(np.float64), track.lats.astype(np.float64),
+        np.asarray(starts),
+        track.slice_means(conf.track_time_slice_seconds, att_abs_accels))
+
+
+def settings_for_config(conf):
+    """Describe the settings of an AnalysisConfig that determine colors."""
+    return (
+        f'{conf.track_time_slice_seconds}s,'
+        f'{conf.rolling_average_window_duration_seconds}s,'
+        f'{conf.attenuator.spec},{conf.track_lower_limit_millig}mg-'
+        f'{conf.track_upper_limit_millig}mg')
+
+
+@dc.dataclass
+class _ProjectedRide:
+    """
+    A RideOverlay at a zoom level, with positions in pixels of the whole
+    world and the bounding boxes of the slices' lines in pixels.
+    """
+    xs: np.ndarray
+    ys: np.ndarray
+    overlay: RideOverlay
+    min_xs: np.ndarray
+    min_ys: np.ndarray
+    max_xs: np.ndarray
+    max_ys: np.ndarray
+
+    @classmethod
+    def project(cls, overlay, zoom):
+        num_pixels = TILE_SIZE_PIXELS << zoom
+        lats = np.clip(overlay.lats, -tiles.MAX_LATITUDE, tiles.MAX_LATITUDE)
+        xs = (overlay.lons + 180) / 360 * num_pixels
+        ys = (1 - np.arcsinh(np.tan(np.radians(lats))) / np.pi) / 2 * (
+            num_pixels)
+        if not len(overlay.starts):
+            empty = np.empty(0)
+            return cls(xs, ys, overlay, empty, empty, empty, empty)
+        # Lines reach beyond their positions by half their width.
+        margin = LINE_WIDTH_PIXELS / 2 + 1
+        return cls(
+            xs, ys, overlay,
+            np.minimum.reduceat(xs, overlay.starts) - margin,
+            np.minimum.reduceat(ys, overlay.starts) - margin,
+            np.maximum.reduceat(xs, overlay.starts) + margin,
+            np.maximum.reduceat(ys, overlay.starts) + margin)
+
+    def tiles(self, zoom):
+        """Yield the tiles that the lines of slices reach into."""
+        max_tile = (1 << zoom) - 1
+
+        def tile_indices(pixels):
+            return np.clip(
+                np.floor(pixels / TILE_SIZE_PIXELS), 0, max_tile
+            ).astype(np.int64).tolist()
+
+        for min_x, min_y, max_x, max_y in zip(
+                tile_indices(self.min_xs), tile_indices(self.min_ys),
+                tile_indices(self.max_xs), tile_indices(self.max_ys)):
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    yield zoom, x, y
+
+    def lines(self, x, y, conf):
+        """
+        Return the lines of the slices reaching into tile x, y as pairs of
+        points, in pixels of the tile, and RGBA colors.
+        """
+        left, top = x * TILE_SIZE_PIXELS, y * TILE_SIZE_PIXELS
+        crossing = np.flatnonzero(
+            (self.max_xs >= left) & (self.min_xs < left + TILE_SIZE_PIXELS)
+            & (self.max_ys >= top) & (self.min_ys < top + TILE_SIZE_PIXELS))
+        rgbas = np.round(colors.colors_for_accels(
+            self.overlay.means[crossing], conf) * 255).astype(np.uint8)
+        stops = np.append(self.overlay.starts[1:], len(self.xs))
+        return [
+            (np.column_stack((
+                self.xs[start:stop] - left, self.ys[start:stop] - top
+            )).astype(np.float32), tuple(rgba.tolist()))
+            for start, stop, rgba in zip(
+                self.overlay.starts[crossing], stops[crossing], rgbas)]
+
+
+class TilePyramid:
+    """
+    A pyramid of overlay tiles in a directory.
+
+    Opening an existing pyramid with an AnalysisConfig whose colors differ or
+    with other zoom_levels raises ValueError. New pyramids use zoom_levels
+    or DEFAULT_ZOOM_LEVELS if it's None.
+    """
+
+    def __init__(self, directory, conf, zoom_levels=None):
+        self.directory = pathlib.Path(directory)
+        self.conf = conf
+        self.store = tiles.DirectoryStore(
+            str(self.directory / '{z}' / '{x}' / '{y}.png'))
+        self.manifest_path = self.directory / MANIFEST_NAME
+        settings = settings_for_config(conf)
+        try:
+            with open(self.manifest_path) as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            zoom_levels = zoom_levels or DEFAULT_ZOOM_LEVELS
+            manifest = {
+                'settings': settings,
+                'zoom_levels': [zoom_levels.start, zoom_levels.stop - 1],
+                'rides': {}, 'dirty': []}
+        min_zoom, max_zoom = manifest['zoom_levels']
+        self.zoom_levels = range(min_zoom, max_zoom + 1)
+        if zoom_levels is not None and zoom_levels != self.zoom_levels:
+            raise ValueError(
+                f'{self.directory} has zoom levels {min_zoom}-{max_zoom}.')
+        if manifest['settings'] != settings:
+            raise ValueError(
+                f'{self.directory} was created with the settings '
+                f'{manifest["settings"]}, not {settings}.')
+        self._rides = manifest['rides']
+        self._dirty = {_parse_tile(tile) for tile in manifest['dirty']}
+        # Keys of the rides covering each tile.
+        self._tile_rides = collections.defaultdict(list)
+        for ride_key, ride in self._rides.items():
+            for tile in ride['tiles']:
+                self._tile_rides[_parse_tile(tile)].append(ride_key)
+        self._projected = collections.OrderedDict()
+        for directory in (self.directory, self.directory / RIDES_DIR_NAME):
+            track_cache.remove_stale_temporary_files(directory)
+
+    def __len__(self):
+        return len(self._rides)
+
+    def contains(self, ride_key):
+        return ride_key in self._rides
+
+    def add(self, ride_key, name, overlay):
+        """
+        Add the RideOverlay of a ride and mark the tiles it covers to be
+        rendered. Rides that were already added are skipped. Returns the
+        number of tiles the ride covers.
+        """
+        if ride_key in self._rides:
+            return 0
+        path = self._overlay_path(ride_key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with track_cache.atomic_write(path) as file:
+            np.savez(file, **dc.asdict(overlay))
+        ride_tiles = set()
+        for zoom in self.zoom_levels:
+            ride_tiles.update(
+                _ProjectedRide.project(overlay, zoom).tiles(zoom))
+        self._rides[ride_key] = {
+            'name': name, 'tiles': sorted(map(_format_tile, ride_tiles))}
+        for tile in ride_tiles:
+            self._tile_rides[tile].append(ride_key)
+        self._dirty.update(ride_tiles)
+        return len(ride_tiles)
+
+    def dirty_tiles(self):
+        """Return the tiles to be rendered, ordered by zoom level, x and y."""
+        return sorted(self._dirty)
+
+    def mark_rendered(self, tile):
+        self._dirty.discard(tile)
+
+    def render(self, tile):
+        """Draw all rides covering tile (z, x, y) and write it."""
+        zoom, x, y = tile
+        lines = []
+        # In an order that doesn't depend on when rides were added, so
+        # overlapping lines look the same however the pyramid was built.
+        for ride_key in sorted(self._tile_rides.get(tile, [])):
+            lines += self._projected_ride(ride_key, zoom).lines(
+                x, y, self.conf)
+        self.store.put(x, y, zoom, render_png(lines))
+
+    def save(self):
+        """Save the manifest, including the tiles still to be rendered."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Written atomically, so a crash never leaves a broken manifest.
+        with track_cache.atomic_write(self.manifest_path, 'w') as file:
+            json.dump({
+                'settings': settings_for_config(self.conf),
+                'zoom_levels': [self.zoom_levels.start,
+                                self.zoom_levels.stop - 1],
+                'rides': self._rides,
+                'dirty': sorted(map(_format_tile, self._dirty)),
+            }, file)
+
+    def _overlay_path(self, ride_key):
+        return self.directory / RIDES_DIR_NAME / f'{ride_key}.npz'
+
+    def _projected_ride(self, ride_key, zoom):
+        key = (ride_key, zoom)
+        projected = self._projected.get(key)
+        if projected is None:
+            path = self._overlay_path(ride_key)
+            with np.load(path, allow_pickle=False) as arrays:
+                overlay = RideOverlay(**arrays)
+            projected = self._projected[key] = _ProjectedRide.project(
+                overlay, zoom)
+            if len(self._projected) > MAX_PROJECTED_RIDES:
+                self._projected.popitem(last=False)
+        else:
+            self._projected.move_to_end(key)
+        return projected
+
+
+def render_tile(directory, conf, tile):
+    """
+    Render a tile of the pyramid in directory as saved.
+
+    Opens the pyramid once per process and manifest version, so it can be
+    called for many tiles in worker processes.
+    """
+    manifest_path = pathlib.Path(directory) / MANIFEST_NAME
+    key = (manifest_path.resolve(), manifest_path.stat().st_mtime_ns)
+    pyramid = _pyramids.get(key)
+    if pyramid is None:
+        _pyramids.clear()
+        pyramid = _pyramids[key] = TilePyramid(directory, conf)
+    pyramid.render(tile)
+
+
+def render_png(lines):
+    """
+    Draw lines, pairs of points in pixels and RGBA colors, onto a
+    transparent tile and return it as PNG.
+    """
+    # Imported here, as only rendering needs it.
+    import PIL.Image
+    import PIL.ImageDraw
+    image = PIL.Image.new(
+        'RGBA', (TILE_SIZE_PIXELS, TILE_SIZE_PIXELS), (0, 0, 0, 0))
+    draw = PIL.ImageDraw.Draw(image)
+    for points, rgba in lines:
+        draw.line(
+            points.ravel().tolist(), fill=rgba, width=LINE_WIDTH_PIXELS,
+            joint='curve')
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _format_tile(tile):
+    return '/'.join(map(str, tile))
+
+
+def _parse_tile(value):
+    return tuple(map(int, value.split('/')))
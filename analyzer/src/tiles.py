@@ -0,0 +1,379 @@
+"""
+Local stores of map tiles, so that maps can be drawn without network access.
+
+Tile sources are given as strings:
+    osm                 Download tiles from OpenStreetMap (the default).
+    mbtiles:<path>      Read tiles from an MBTiles file (an SQLite database).
+    dir:<template>      Read tiles from files named by a template containing
+                        {z}, {x} and {y}, e.g. tiles/{z}/{x}/{y}.png.
+
+Tiles are addressed by x, y and zoom level as in the XYZ scheme used by
+OpenStreetMap, MBTiles files use the flipped TMS rows internally. This module
+only depends on the standard library and imports quickly. Stores can be
+filled ahead of time for a bounding box and range of zoom levels with
+    python src/tiles.py --bbox <min_lon>,<min_lat>,<max_lon>,<max_lat>
+        --zoom <min>-<max> --url-template <url> <tile_source>
+from a tile server that allows bulk downloads. OpenStreetMap's tile servers
+don't (see https://operations.osmfoundation.org/policies/tiles/), so they
+are refused.
+"""
+import argparse
+import dataclasses as dc
+import logging
+import math
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TILE_SOURCE_KINDS = ('osm', 'mbtiles', 'dir')
+# Hosts whose usage policy forbids bulk downloads, including subdomains.
+NO_BULK_DOWNLOAD_HOSTS = ('tile.openstreetmap.org',)
+USER_AGENT = 'BumpVisualizer-analyzer'
+# Size of the memory map SQLite uses to read MBTiles files.
+MBTILES_MMAP_SIZE_BYTES = 1 << 30
+# Latitude limit of the Web Mercator projection.
+MAX_LATITUDE = 85.0511287798
+# Pause between downloads, to go easy on tile servers.
+DEFAULT_DOWNLOAD_INTERVAL_SECONDS = 0.1
+
+
+@dc.dataclass(frozen=True)
+class TileSourceSpec:
+    """
+    A parsed tile source string. location is None for osm.
+    """
+    kind: str
+    location: str = None
+
+    @classmethod
+    def parse(cls, spec):
+        kind, _, location = spec.partition(':')
+        if kind not in TILE_SOURCE_KINDS:
+            raise ValueError(
+                f'Unknown tile source "{spec}", expected one of '
+                f'{", ".join(TILE_SOURCE_KINDS)}.')
+        if kind == 'osm':
+            if location:
+                raise ValueError('The osm tile source takes no location.')
+            return cls(kind)
+        if not location:
+            raise ValueError(f'Tile source {kind} needs a location.')
+        if kind == 'dir' and not all(
+                f'{{{key}}}' in location for key in 'zxy'):
+            raise ValueError(
+                'Tile directory templates must contain {z}, {x} and {y}.')
+        return cls(kind, location)
+
+    def __str__(self):
+        return self.kind if self.location is None else (
+            f'{self.kind}:{self.location}')
+
+
+class MBTilesStore:
+    """
+    Tiles in an MBTiles file.
+
+    Reads use a separate connection per thread, since tiles are fetched from
+    several threads, and memory-map the database.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = pathlib.Path(path)
+        self.writable = writable
+        self._local = threading.local()
+        if writable:
+            self._create_schema()
+        elif not self.path.exists():
+            raise FileNotFoundError(f'No MBTiles file at {self.path}.')
+
+    def get(self, x, y, z):
+        """Return the encoded image of a tile, or None if it's missing."""
+        row = self._connection().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+            'tile_column = ? AND tile_row = ?',
+            (z, x, _flipped_row(y, z))).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, x, y, z, data):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO tiles '
+            '(zoom_level, tile_column, tile_row, tile_data) '
+            'VALUES (?, ?, ?, ?)', (z, x, _flipped_row(y, z), data))
+
+    def contains(self, x, y, z):
+        row = self._connection().execute(
+            'SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+            'AND tile_row = ?', (z, x, _flipped_row(y, z))).fetchone()
+        return row is not None
+
+    def commit(self):
+        self._connection().commit()
+
+    def tile_uri(self, x, y, z):
+        """Return a URI identifying a tile, e.g. for messages."""
+        return f'{self.path.resolve().as_uri()}#{z}/{x}/{y}'
+
+    @property
+    def cache_key(self):
+        """Identifies the store's content, for caching images made of it."""
+        return f'mbtiles:{self.path.resolve()}:{self.path.stat().st_mtime_ns}'
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.writable:
+                connection = sqlite3.connect(self.path)
+            else:
+                connection = sqlite3.connect(
+                    f'{self.path.resolve().as_uri()}?mode=ro', uri=True)
+                connection.execute(
+                    f'PRAGMA mmap_size = {MBTILES_MMAP_SIZE_BYTES}')
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = self._connection()
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS metadata_name
+                ON metadata (name);
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                tile_data BLOB);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                ON tiles (zoom_level, tile_column, tile_row);
+        ''')
+        connection.executemany(
+            'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+            [('name', self.path.stem), ('format', 'png')])
+        connection.commit()
+
+
+class DirectoryStore:
+    """Tiles in files named by a template containing {z}, {x} and {y}."""
+    # Touched in the root directory whenever a tile is written, so changes
+    # can be detected without walking the whole tree.
+    STAMP_FILE_NAME = '.modified'
+
+    def __init__(self, template):
+        self.template = template
+
+    def get(self, x, y, z):
+        try:
+            return self._path(x, y, z).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, x, y, z, data):
+        path = self._path(x, y, z)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written atomically, so readers never see partial tiles.
+        with tempfile.NamedTemporaryFile(
+                dir=path.parent, suffix='.tmp', delete=False) as file:
+            file.write(data)
+        os.replace(file.name, path)
+        # With an explicit time, as file systems may update mtimes coarsely.
+        stamp_path = self._stamp_path()
+        stamp_path.touch()
+        now_ns = time.time_ns()
+        os.utime(stamp_path, ns=(now_ns, now_ns))
+
+    def contains(self, x, y, z):
+        return self._path(x, y, z).exists()
+
+    def commit(self):
+        pass
+
+    def tile_uri(self, x, y, z):
+        """Return the file URI of a tile."""
+        return self._path(x, y, z).resolve().as_uri()
+
+    @property
+    def cache_key(self):
+        """
+        Identifies the store's content, for caching images made of it.
+
+        Includes the modification time of the stamp file, which put()
+        touches, and of the root directory. Tiles that other tools add to or
+        remove from subdirectories without touching either aren't noticed.
+        """
+        mtimes_ns = []
+        for path in (self._root(), self._stamp_path()):
+            try:
+                mtimes_ns.append(path.stat().st_mtime_ns)
+            except FileNotFoundError:
+                mtimes_ns.append(None)
+        root_mtime_ns, stamp_mtime_ns = mtimes_ns
+        return (
+            f'dir:{pathlib.Path(self.template).resolve()}:{root_mtime_ns}:'
+            f'{stamp_mtime_ns}')
+
+    def _path(self, x, y, z):
+        return pathlib.Path(self.template.format(x=x, y=y, z=z))
+
+    def _root(self):
+        """The deepest directory containing all tiles."""
+        path = pathlib.Path(self.template).resolve()
+        return next(
+            parent for parent in path.parents if '{' not in str(parent))
+
+    def _stamp_path(self):
+        return self._root() / self.STAMP_FILE_NAME
+
+
+def open_store(spec, writable=False):
+    """
+    Return the store for a TileSourceSpec, or None for osm.
+    """
+    if spec.kind == 'mbtiles':
+        return MBTilesStore(spec.location, writable)
+    if spec.kind == 'dir':
+        return DirectoryStore(spec.location)
+    return None
+
+
+def _flipped_row(y, z):
+    return (1 << z) - 1 - y
+
+
+def tile_range(min_lon, min_lat, max_lon, max_lat, z):
+    """
+    Return the ranges of x and y of the tiles covering a bounding box.
+    """
+    min_x, max_y = lon_lat_to_tile(min_lon, min_lat, z)
+    max_x, min_y = lon_lat_to_tile(max_lon, max_lat, z)
+    return range(min_x, max_x + 1), range(min_y, max_y + 1)
+
+
+def lon_lat_to_tile(lon, lat, z):
+    """Return x and y of the tile containing a point at zoom level z."""
+    num_tiles = 1 << z
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = (lon + 180) / 360 * num_tiles
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * num_tiles
+    return (
+        min(num_tiles - 1, max(0, int(x))), min(num_tiles - 1, max(0, int(y))))
+
+
+def prefetch(
+        store, bounds, zoom_levels, url_template, overwrite=False,
+        download_interval_seconds=DEFAULT_DOWNLOAD_INTERVAL_SECONDS):
+    """
+    Download all tiles covering bounds (min_lon, min_lat, max_lon, max_lat)
+    at zoom_levels from url_template into store.
+
+    Tiles that are already in the store are skipped unless overwrite is
+    given. Returns the numbers of downloaded, skipped and failed tiles.
+    Raises ValueError for servers in NO_BULK_DOWNLOAD_HOSTS.
+    """
+    check_bulk_downloads_allowed(url_template)
+    # Imported here, as it takes a while and is only needed for downloads.
+    import urllib.request
+    num_downloaded = num_skipped = num_failed = 0
+    for z in zoom_levels:
+        xs, ys = tile_range(*bounds, z)
+        logger.info(
+            f'Fetching up to {len(xs) * len(ys)} tiles at zoom level {z}.')
+        for x in xs:
+            for y in ys:
+                if not overwrite and store.contains(x, y, z):
+                    num_skipped += 1
+                    continue
+                url = url_template.format(x=x, y=y, z=z)
+                try:
+                    request = urllib.request.Request(
+                        url, headers={'User-Agent': USER_AGENT})
+                    with urllib.request.urlopen(request) as response:
+                        data = response.read()
+                except OSError as e:
+                    logger.warning(f'Failed to download {url}: {e}')
+                    num_failed += 1
+                    continue
+                store.put(x, y, z, data)
+                num_downloaded += 1
+                time.sleep(download_interval_seconds)
+            store.commit()
+    return num_downloaded, num_skipped, num_failed
+
+
+def check_bulk_downloads_allowed(url_template):
+    """Raise ValueError if url_template is on one of NO_BULK_DOWNLOAD_HOSTS."""
+    # Imported here, as it's only needed for downloads.
+    import urllib.parse
+    host = urllib.parse.urlsplit(url_template).hostname or ''
+    if any(
+            host == no_bulk_host or host.endswith('.' + no_bulk_host)
+            for no_bulk_host in NO_BULK_DOWNLOAD_HOSTS):
+        raise ValueError(
+            f'The usage policy of {host} forbids bulk downloads, use another '
+            'tile server.')
+
+
+def parse_bounds(value):
+    """
+    Parse a bounding box argument <min_lon>,<min_lat>,<max_lon>,<max_lat>.
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = map(float, value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Expected <min_lon>,<min_lat>,<max_lon>,<max_lat>.') from None
+    if min_lon > max_lon or min_lat > max_lat:
+        raise argparse.ArgumentTypeError('Minimum exceeds maximum.')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def parse_zoom_levels(value):
+    """Parse a zoom level or range of zoom levels argument like 10-16."""
+    try:
+        min_zoom, _, max_zoom = value.partition('-')
+        return range(int(min_zoom), int(max_zoom or min_zoom) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Expected a zoom level or range like 10-16.') from None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Download map tiles for a bounding box into a local '
+        'tile source, for drawing maps without network access.')
+    parser.add_argument(
+        'tile_source', type=TileSourceSpec.parse,
+        help='Where to store tiles, mbtiles:<path> or dir:<template>.')
+    parser.add_argument(
+        '--bbox', type=parse_bounds, required=True,
+        help='Bounding box as <min_lon>,<min_lat>,<max_lon>,<max_lat>.')
+    parser.add_argument(
+        '--zoom', type=parse_zoom_levels, required=True,
+        help='Zoom level or range of zoom levels, e.g. 10-16.')
+    parser.add_argument(
+        '--url-template', required=True,
+        help='URL to download tiles from, with {z}, {x} and {y}. The tile '
+        'server must allow bulk downloads.')
+    parser.add_argument(
+        '--overwrite', action='store_true',
+        help='Download tiles again that are already stored.')
+    args = parser.parse_args()
+    if args.tile_source.kind == 'osm':
+        parser.error('Tiles can only be prefetched into a local source.')
+    try:
+        check_bulk_downloads_allowed(args.url_template)
+    except ValueError as e:
+        parser.error(str(e))
+    store = open_store(args.tile_source, writable=True)
+    num_downloaded, num_skipped, num_failed = prefetch(
+        store, args.bbox, args.zoom, args.url_template, args.overwrite)
+    logger.info(
+        f'Downloaded {num_downloaded} tiles, skipped {num_skipped} that were '
+        f'already stored, {num_failed} failed.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
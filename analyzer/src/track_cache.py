@@ -0,0 +1,265 @@
+"""
+Persistent caches of NumPy arrays.
+
+ArrayCache stores dicts of arrays as .npz files named after a hash of a key
+and a version string supplied by the caller, so that changing what is cached
+invalidates old entries. Caches are bounded in size. When one grows too big,
+the least recently used entries (by mtime, which is updated on every hit) are
+deleted. The sizes of the entries are tracked in memory, so storing an entry
+doesn't list the directory unless another process changed it. Files are
+written with atomic_write(), and temporary files left behind by interrupted
+writers are removed when a cache is opened.
+
+TrackCache caches decoded .fit files, keyed by the files' content. A small
+index maps paths along with their size and mtime to content hashes, so files
+that haven't changed don't have to be read and hashed again.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TEMPORARY_SUFFIX = '.tmp'
+# Temporary files older than this are assumed to be left behind, rather than
+# still being written.
+STALE_TEMPORARY_FILE_AGE_SECONDS = 3600
+
+
+def file_hash(file_path):
+    """Return a hash of a file's content as a hex string."""
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Open a temporary file next to path and replace path with it once the
+    enclosed code is done, so readers never see a partially written file. If
+    the enclosed code or the replacement fails, the temporary file is removed.
+    """
+    path = pathlib.Path(path)
+    file = tempfile.NamedTemporaryFile(
+        mode, dir=path.parent, suffix=TEMPORARY_SUFFIX, delete=False)
+    try:
+        with file:
+            yield file
+        os.replace(file.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(file.name)
+        raise
+
+
+def remove_stale_temporary_files(directory):
+    """
+    Remove the temporary files that atomic_write() left in directory when
+    writers were interrupted.
+    """
+    cutoff_ns = time.time_ns() - round(STALE_TEMPORARY_FILE_AGE_SECONDS * 1e9)
+    for path in pathlib.Path(directory).glob(f'*{TEMPORARY_SUFFIX}'):
+        try:
+            if path.stat().st_mtime_ns < cutoff_ns:
+                logger.info(f'Removing stale temporary file {path}.')
+                path.unlink()
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.warning(f'Failed to remove {path}: {e}')
+
+
+class ArrayCache:
+    ENTRY_SUFFIX = '.npz'
+
+    def __init__(self, directory, version, max_size_bytes):
+        self.directory = pathlib.Path(directory)
+        self.version = version
+        self.max_size_bytes = max_size_bytes
+        # mtimes and sizes of the entries by path and their total size, as of
+        # the directory's mtime _directory_mtime_ns.
+        self._entries = None
+        self._total_size = 0
+        self._directory_mtime_ns = None
+        remove_stale_temporary_files(self.directory)
+
+    def __getstate__(self):
+        # Entries are listed again in each process.
+        return {**self.__dict__, '_entries': None}
+
+    def load(self, key):
+        """
+        Return the cached arrays for a key as a dict, or None.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning(f'Removing broken cache entry {entry_path}: {e}')
+            self._remove(entry_path)
+            return None
+        # Mark the entry as recently used. Read-only caches are still used,
+        # they just can't track this.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        else:
+            if self._entries is not None and entry_path in self._entries:
+                _, size = self._entries[entry_path]
+                self._entries[entry_path] = (time.time_ns(), size)
+        return arrays
+
+    def store(self, key, arrays):
+        """
+        Store a dict of arrays for a key and evict old entries if necessary.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry_path = self._entry_path(key)
+        if not self._entries_up_to_date():
+            self._list_entries()
+        with atomic_write(entry_path) as file:
+            np.savez(file, **arrays)
+        stat = entry_path.stat()
+        _, replaced_size = self._entries.get(entry_path, (None, 0))
+        self._entries[entry_path] = (stat.st_mtime_ns, stat.st_size)
+        self._total_size += stat.st_size - replaced_size
+        self._evict()
+        self._directory_mtime_ns = self.directory.stat().st_mtime_ns
+
+    @staticmethod
+    def _remove(entry_path):
+        try:
+            entry_path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f'Failed to remove {entry_path}: {e}')
+
+    def _entry_path(self, key):
+        return self.directory / (
+            f'{self._entry_name(key)}-{self.version}{self.ENTRY_SUFFIX}')
+
+    def _entry_name(self, key):
+        return hashlib.blake2b(str(key).encode(), digest_size=16).hexdigest()
+
+    def _entries_up_to_date(self):
+        """
+        Return whether the tracked entries are up to date, i.e. nothing but
+        this instance changed the directory since they were listed.
+        """
+        return (
+            self._entries is not None
+            and self.directory.stat().st_mtime_ns == self._directory_mtime_ns)
+
+    def _list_entries(self):
+        self._entries = {}
+        for path in self.directory.glob(f'*{self.ENTRY_SUFFIX}'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            self._entries[path] = (stat.st_mtime_ns, stat.st_size)
+        self._total_size = sum(size for _, size in self._entries.values())
+
+    def _evict(self):
+        if self._total_size <= self.max_size_bytes:
+            return
+        evicted_paths = []
+        for path, (_, size) in sorted(
+                self._entries.items(), key=lambda entry: entry[1]):
+            if self._total_size <= self.max_size_bytes:
+                break
+            self._remove(path)
+            del self._entries[path]
+            self._total_size -= size
+            evicted_paths.append(path)
+            logger.info(f'Evicted {path.name} from {self.directory}.')
+        self._evicted(evicted_paths)
+
+    def _evicted(self, paths):
+        """Called with the paths of entries after they were evicted."""
+
+
+class TrackCache(ArrayCache):
+    """
+    A cache of decoded .fit files. Keys are paths of .fit files.
+    """
+    INDEX_FILE_NAME = 'index.json'
+
+    def __init__(self, directory, version, max_size_bytes):
+        super().__init__(directory, version, max_size_bytes)
+        self._index = None
+
+    def _entry_name(self, file_path):
+        return self.content_hash(file_path)
+
+    def content_hash(self, file_path):
+        """
+        Return the file_hash() of a file, from the index if the file's size
+        and mtime haven't changed.
+        """
+        file_path = pathlib.Path(file_path).resolve()
+        stat = file_path.stat()
+        index = self._load_index()
+        key = str(file_path)
+        try:
+            size, mtime_ns, content_hash = index[key]
+            if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                return content_hash
+        except (KeyError, ValueError):
+            pass
+        content_hash = file_hash(file_path)
+        index[key] = [stat.st_size, stat.st_mtime_ns, content_hash]
+        self._save_index()
+        return content_hash
+
+    def _evicted(self, paths):
+        # Entries are named after the content hash and version.
+        evicted_hashes = {path.name.partition('-')[0] for path in paths}
+        index = self._load_index()
+        evicted_keys = [
+            key for key, entry in index.items()
+            if entry[-1] in evicted_hashes]
+        if not evicted_keys:
+            return
+        for key in evicted_keys:
+            del index[key]
+        self._save_index()
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.directory / self.INDEX_FILE_NAME) as file:
+                    self._index = json.load(file)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        # Written atomically. Concurrent writers may lose each other's
+        # entries, which only means some files get hashed again.
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            entries_up_to_date = self._entries_up_to_date()
+            with atomic_write(
+                    self.directory / self.INDEX_FILE_NAME, 'w') as file:
+                json.dump(self._index, file)
+            # The index isn't an entry, so writing it doesn't outdate them.
+            if entries_up_to_date:
+                self._directory_mtime_ns = self.directory.stat().st_mtime_ns
+        except OSError as e:
+            logger.warning(
+                f'Failed to save the index of {self.directory}: {e}')
@@ -0,0 +1,255 @@
+"""
+Watching a directory for new rides.
+
+FolderWatcher polls a directory for .fit files and hands each one to a pool
+of worker processes once it has stopped changing, so files that are still
+being copied aren't analyzed half-written. What was processed is recorded in
+a manifest, a small JSON file keyed by file name along with the size and
+mtime the file had, so after a restart only new or changed files are
+processed again. Files that failed are recorded too, but processed again
+once they change (e.g. if they were caught while still being copied) or
+after a restart. If a worker process dies, the pool is replaced and the
+files it was processing are retried once.
+
+Queue depth and the latency of each file (from its last modification until
+its analysis finished) are logged with the attributes queue_depth,
+in_progress, path, seconds and latency_seconds for structured processing.
+"""
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTLE_SECONDS = 5
+DEFAULT_POLL_INTERVAL_SECONDS = 2
+MANIFEST_NAME = '.analyzed.json'
+
+
+class Manifest:
+    """
+    Records of processed files, stored as JSON.
+
+    Each record holds the size and mtime of the file when it was processed,
+    so changed files can be told apart from processed ones.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        try:
+            with open(self.path) as file:
+                self._records = json.load(file)
+        except FileNotFoundError:
+            self._records = {}
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f'Ignoring unreadable manifest {self.path}, all files will be '
+                f'processed again: {e}')
+            self._records = {}
+
+    def is_processed(self, name, signature):
+        """Return whether a file was processed successfully as it is."""
+        record = self._records.get(name)
+        return record is not None and 'error' not in record and (
+            (record['size'], record['mtime_ns']) == signature)
+
+    def record(self, name, signature, **fields):
+        """
+        Record a processed file and save the manifest. Failures are
+        recorded with an error field.
+        """
+        size, mtime_ns = signature
+        self._records[name] = {'size': size, 'mtime_ns': mtime_ns, **fields}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Written atomically, so a crash never leaves a broken manifest.
+        with tempfile.NamedTemporaryFile(
+                'w', dir=self.path.parent, suffix='.tmp',
+                delete=False) as file:
+            json.dump(self._records, file, indent=1)
+        os.replace(file.name, self.path)
+
+
+class FolderWatcher:
+    """
+    Processes .fit files in a directory as they appear.
+
+    process is called with the path of each file in a pool of worker
+    processes and returns the list of written paths. make_executor creates
+    the pool, and is called again to replace it if it breaks because a
+    worker process died. A file is submitted once its size and mtime haven't
+    changed for settle_seconds. At most max_in_progress files are submitted
+    at a time, the others wait in a queue. close() shuts the pool down.
+    """
+
+    def __init__(
+            self, directory, process, make_executor, max_in_progress,
+            manifest_path=None, settle_seconds=DEFAULT_SETTLE_SECONDS,
+            poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS):
+        self.directory = pathlib.Path(directory)
+        self.process = process
+        self._make_executor = make_executor
+        self.executor = make_executor()
+        self.max_in_progress = max_in_progress
+        self.manifest = Manifest(
+            manifest_path or self.directory / MANIFEST_NAME)
+        self.settle_seconds = settle_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        # Changing files by path, with their signature and when it was
+        # first seen.
+        self._unsettled = {}
+        # Settled files waiting to be submitted, with their signatures.
+        self._queue = collections.OrderedDict()
+        # Futures of submitted files, with path, signature, the time they
+        # were submitted and the executor.
+        self._in_progress = {}
+        # Signatures of files that failed in this run, and of files that
+        # were in progress when a worker process died, by path.
+        self._failed = {}
+        self._crashed = {}
+        self._last_status = None
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def num_in_progress(self):
+        return len(self._in_progress)
+
+    def run(self):
+        """Process files until interrupted."""
+        logger.info(f'Watching {self.directory} for .fit files.')
+        while True:
+            self.poll()
+            self.wait(self.poll_interval_seconds)
+
+    def close(self):
+        """Shut the pool of worker processes down, cancelling queued files."""
+        self.executor.shutdown(cancel_futures=True)
+
+    def poll(self):
+        """Scan the directory once and submit settled files."""
+        now = time.time()
+        paths = sorted(self.directory.glob('*.fit'))
+        # Forget files that disappeared while they were changing.
+        for path in self._unsettled.keys() - set(paths):
+            del self._unsettled[path]
+        for path in paths:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if (self.manifest.is_processed(path.name, signature)
+                    or self._failed.get(path) == signature
+                    or self._queue.get(path) == signature
+                    or any(
+                        (path, signature) == in_progress[:2]
+                        for in_progress in self._in_progress.values())):
+                continue
+            unsettled = self._unsettled.get(path)
+            if unsettled is None or unsettled[0] != signature:
+                self._unsettled[path] = (signature, now)
+            elif now - unsettled[1] >= self.settle_seconds:
+                del self._unsettled[path]
+                self._queue[path] = signature
+        self._submit()
+        self._log_status()
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for files in progress and record the
+        finished ones.
+        """
+        if not self._in_progress:
+            time.sleep(timeout)
+            return
+        done, _ = concurrent.futures.wait(
+            self._in_progress, timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            self._finish(future, *self._in_progress.pop(future))
+        if done:
+            self._submit()
+            self._log_status()
+
+    def _submit(self):
+        while self._queue and len(self._in_progress) < self.max_in_progress:
+            path, signature = self._queue.popitem(last=False)
+            try:
+                future = self.executor.submit(self.process, path)
+            except concurrent.futures.process.BrokenProcessPool:
+                self._replace_executor()
+                future = self.executor.submit(self.process, path)
+            self._in_progress[future] = (
+                path, signature, time.time(), self.executor)
+
+    def _replace_executor(self):
+        logger.error('A worker process died, starting new ones.')
+        self.executor.shutdown(wait=False)
+        self.executor = self._make_executor()
+
+    def _finish(self, future, path, signature, submitted, executor):
+        finished = time.time()
+        seconds = finished - submitted
+        latency_seconds = finished - signature[1] / 1e9
+        fields = {
+            'path': path, 'seconds': seconds,
+            'latency_seconds': latency_seconds}
+        try:
+            saved_paths = future.result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            if executor is self.executor:
+                self._replace_executor()
+            # All files in progress fail when a worker dies, not just the
+            # one that killed it, so each is retried once.
+            if self._crashed.get(path) != signature:
+                self._crashed[path] = signature
+                logger.warning(
+                    f'Analyzing {path} was interrupted, retrying it.',
+                    extra=fields)
+                self._queue[path] = signature
+                self._queue.move_to_end(path, last=False)
+                return
+            self._fail(path, signature, e, fields)
+            return
+        except Exception as e:
+            self._fail(path, signature, e, fields)
+            return
+        self._failed.pop(path, None)
+        self._crashed.pop(path, None)
+        logger.info(
+            f'Analyzed {path} in {seconds:.1f}s, {latency_seconds:.1f}s after '
+            f'it was last modified. Saved '
+            f'{", ".join(map(str, saved_paths))}.', extra=fields)
+        self.manifest.record(
+            path.name, signature, saved_paths=list(map(str, saved_paths)),
+            seconds=seconds, latency_seconds=latency_seconds)
+
+    def _fail(self, path, signature, error, fields):
+        logger.error(
+            f'Failed to analyze {path}.', exc_info=error, extra=fields)
+        self._failed[path] = signature
+        self._crashed.pop(path, None)
+        self.manifest.record(
+            path.name, signature, error=f'{type(error).__name__}: {error}',
+            seconds=fields['seconds'],
+            latency_seconds=fields['latency_seconds'])
+
+    def _log_status(self):
+        status = (self.queue_depth, self.num_in_progress)
+        if status == self._last_status:
+            return
+        self._last_status = status
+        logger.info(
+            f'{self.queue_depth} files queued, {self.num_in_progress} being '
+            'analyzed.',
+            extra={
+                'queue_depth': self.queue_depth,
+                'in_progress': self.num_in_progress})
@@ -0,0 +1,64 @@
+import pathlib
+import sys
+
+import pytest
+
+# The analyzer's modules are imported by name, as when running src/analyze.py.
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'src'))
+
+import analysis  # noqa: E402
+import fit_generator  # noqa: E402
+
+# Synthetic rides exercising the quirks of real recordings.
+RIDE_SPECS = {
+    'plain': {},
+    'saturated': {'saturation_probability': 0.01},
+    'gaps': {'gaps': ((60, 90), (200, 201))},
+    'duplicates': {'duplicate_probability': 0.05},
+}
+
+
+@pytest.fixture
+def conf():
+    """An AnalysisConfig with the command line defaults."""
+    return analysis.AnalysisConfig(
+        track_time_slice_seconds=20, spike_time_slice_seconds=5,
+        rolling_average_window_duration_seconds=10,
+        track_lower_limit_millig=0, track_upper_limit_millig=400,
+        plot_spikes=True, spike_lower_limit_millig=2500,
+        spike_upper_limit_millig=3000,
+        attenuator=analysis.Attenuator('cubic,40,0.75'), extra_zoom=0)
+
+
+@pytest.fixture
+def write_ride(tmp_path):
+    """Return a function writing a synthetic ride and returning its path."""
+    def write(name='ride.fit', **spec):
+        path = tmp_path / name
+        fit_generator.write(
+            path, fit_generator.RideSpec(**{'duration_seconds': 300, **spec}))
+        return path
+    return write
+
+
+@pytest.fixture(params=RIDE_SPECS.values(), ids=RIDE_SPECS.keys())
+def ride_spec(request):
+    """The RideSpec arguments of each of RIDE_SPECS."""
+    return request.param
+
+
+@pytest.fixture
+def ride_paths(write_ride):
+    """Paths of a few synthetic rides, by key."""
+    return {
+        f'ride-{seed}': write_ride(
+            f'ride-{seed}.fit', seed=seed, duplicate_probability=0.02)
+        for seed in range(3)}
+
+
+@pytest.fixture
+def tracks(ride_paths):
+    """The Tracks of ride_paths by key."""
+    return {
+        key: analysis.Track.from_path(path)
+        for key, path in ride_paths.items()}
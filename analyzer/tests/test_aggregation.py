@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import aggregation
+
+
+def test_road_quality_store_merges_rides_once(tmp_path, conf, tracks):
+    path = tmp_path / 'road_quality.sqlite'
+    everywhere = (-180, -85, 180, 85)
+    store = aggregation.RoadQualityStore(path)
+    for key, track in tracks.items():
+        assert store.merge(key, key, aggregation.ride_cells(track, conf))
+    expected = store.query(everywhere)
+    assert not store.merge(
+        'ride-0', 'ride-0', aggregation.ride_cells(tracks['ride-0'], conf))
+    store.close()
+    store = aggregation.RoadQualityStore(path)
+    assert not store.merge(
+        'ride-1', 'ride-1', aggregation.ride_cells(tracks['ride-1'], conf))
+    assert store.num_rides == len(tracks)
+    cells = store.query(everywhere)
+    store.close()
+    for name in ('xs', 'ys', 'counts', 'means', 'm2s'):
+        np.testing.assert_array_equal(
+            getattr(cells, name), getattr(expected, name), err_msg=name)
+
+
+def test_road_quality_store_merges_in_any_order(tmp_path, conf, tracks):
+    everywhere = (-180, -85, 180, 85)
+    results = []
+    for name, keys in [('a', sorted(tracks)), ('b', sorted(tracks)[::-1])]:
+        store = aggregation.RoadQualityStore(tmp_path / f'{name}.sqlite')
+        for key in keys:
+            store.merge(key, key, aggregation.ride_cells(tracks[key], conf))
+        results.append(store.query(everywhere))
+        store.close()
+    for name in ('xs', 'ys', 'counts'):
+        np.testing.assert_array_equal(
+            getattr(results[0], name), getattr(results[1], name))
+    for name in ('means', 'm2s'):
+        np.testing.assert_allclose(
+            getattr(results[0], name), getattr(results[1], name), rtol=1e-9)
+
+
+def test_road_quality_store_read_only(tmp_path):
+    path = tmp_path / 'road_quality.sqlite'
+    with pytest.raises(FileNotFoundError):
+        aggregation.RoadQualityStore(path, read_only=True)
+    assert not path.exists()
+    aggregation.RoadQualityStore(path, 17).close()
+    store = aggregation.RoadQualityStore(path, read_only=True)
+    assert store.cell_zoom == 17
+    assert not len(store.query((-180, -85, 180, 85)))
+    store.close()
+
+
+def test_too_many_slices_for_cell_keys_fail(conf, tracks):
+    track = tracks['ride-0']
+    starts, _ = track.slice_bounds(conf.track_time_slice_seconds)
+    # Leaves too few bits for the slice indices.
+    cell_zoom = (64 - len(starts).bit_length()) // 2
+    with pytest.raises(ValueError, match='Too many slices'):
+        aggregation.ride_cells(track, conf, cell_zoom)
+    aggregation.ride_cells(track, conf, cell_zoom - 1)
@@ -0,0 +1,23 @@
+import numpy as np
+
+import analysis
+
+
+def test_decoders_agree(write_ride, ride_spec):
+    path = write_ride(seed=1, **ride_spec)
+    native = analysis.Track._decode_native(path)
+    fitparse = analysis.Track._decode_fitparse(path)
+    for name in (
+            'message_tss', 'lons_semicircles', 'lats_semicircles', 'speeds',
+            'accels'):
+        np.testing.assert_array_equal(
+            getattr(native, name), getattr(fitparse, name), err_msg=name)
+    assert native.messages_start_ts == fitparse.messages_start_ts
+    assert native.messages_end_ts == fitparse.messages_end_ts
+
+
+def test_decoders_read_saturated_samples_as_infinite(write_ride):
+    path = write_ride(seed=1, saturation_probability=0.01)
+    for decoder in analysis.DECODERS:
+        accels = analysis.Track.from_path(path, decoder).accels
+        assert np.isposinf(accels).any() and np.isneginf(accels).any()
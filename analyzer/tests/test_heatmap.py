@@ -0,0 +1,50 @@
+import dataclasses as dc
+
+import numpy as np
+import pytest
+
+import heatmap
+
+
+def test_heatmap_raster_merges_rides_once(tmp_path, conf, tracks):
+    path = tmp_path / 'heatmap.npz'
+    raster = heatmap.HeatmapRaster.open(path, conf)
+    for key, track in tracks.items():
+        assert raster.merge(key, heatmap.ride_pixels(track, conf))
+    assert not raster.merge(
+        'ride-0', heatmap.ride_pixels(tracks['ride-0'], conf))
+    raster.save(path)
+    expected = raster.pixels
+    raster = heatmap.HeatmapRaster.open(path, conf)
+    assert not raster.merge(
+        'ride-1', heatmap.ride_pixels(tracks['ride-1'], conf))
+    assert len(raster) == len(tracks)
+    for actual, expected in zip(
+            dc.astuple(raster.pixels), dc.astuple(expected)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_heatmap_raster_merges_in_any_batches(tmp_path, conf, tracks):
+    pixels = {
+        key: heatmap.ride_pixels(track, conf)
+        for key, track in tracks.items()}
+    at_once = heatmap.HeatmapRaster.open(tmp_path / 'a.npz', conf)
+    for key in sorted(pixels):
+        at_once.merge(key, pixels[key])
+    # Pixels are combined after each ride, and rides are merged in reverse.
+    one_by_one = heatmap.HeatmapRaster.open(tmp_path / 'b.npz', conf)
+    for key in sorted(pixels, reverse=True):
+        one_by_one.merge(key, pixels[key])
+        one_by_one.save(tmp_path / 'b.npz')
+    xs, ys, sums, counts = dc.astuple(at_once.pixels)
+    np.testing.assert_array_equal(one_by_one.pixels.xs, xs)
+    np.testing.assert_array_equal(one_by_one.pixels.ys, ys)
+    np.testing.assert_allclose(one_by_one.pixels.sums, sums, rtol=1e-9)
+    np.testing.assert_array_equal(one_by_one.pixels.counts, counts)
+    assert counts.sum() == sum(p.counts.sum() for p in pixels.values())
+
+
+def test_heatmap_zoom_is_bounded():
+    heatmap.HeatmapRaster(heatmap.MAX_ZOOM)
+    with pytest.raises(ValueError):
+        heatmap.HeatmapRaster(heatmap.MAX_ZOOM + 1)
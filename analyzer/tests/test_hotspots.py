@@ -0,0 +1,15 @@
+import pytest
+
+import hotspots
+
+
+def test_hotspot_store_read_only(tmp_path):
+    path = tmp_path / 'hotspots.sqlite'
+    with pytest.raises(FileNotFoundError):
+        hotspots.HotspotStore(path, read_only=True)
+    assert not path.exists()
+    hotspots.HotspotStore(path, 20).close()
+    store = hotspots.HotspotStore(path, read_only=True)
+    assert store.cluster_radius_m == 20
+    assert store.query(None) == []
+    store.close()
@@ -0,0 +1,65 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import analysis
+import ride_store
+
+
+def ride_store_rows(path, conf):
+    columns = analysis.Track.read_message_columns(path)
+    return columns.to_arrays(), ride_store.slice_table(
+        analysis.Track.from_message_columns(columns), conf)
+
+
+def test_ride_store_adds_rides_once(tmp_path, conf, ride_paths):
+    path = tmp_path / 'rides.sqlite'
+    store = ride_store.RideStore(path, conf)
+    for key, ride_path in ride_paths.items():
+        assert store.add(key, key, *ride_store_rows(ride_path, conf))
+    expected = store.rides(), list(store.worst_slices(10_000))
+    assert not store.add(
+        'ride-0', 'ride-0', *ride_store_rows(ride_paths['ride-0'], conf))
+    store.close()
+    store = ride_store.RideStore(path, conf)
+    assert not store.add(
+        'ride-2', 'ride-2', *ride_store_rows(ride_paths['ride-2'], conf))
+    assert (store.rides(), list(store.worst_slices(10_000))) == expected
+    stored = analysis.Track.from_message_columns(
+        analysis.MessageColumns.from_arrays(store.load_columns('ride-1')))
+    store.close()
+    np.testing.assert_array_equal(
+        stored.accels, analysis.Track.from_path(ride_paths['ride-1']).accels)
+
+
+def test_ride_store_read_only(tmp_path, conf):
+    path = tmp_path / 'rides.sqlite'
+    with pytest.raises(FileNotFoundError):
+        ride_store.RideStore(path, read_only=True)
+    assert not path.exists()
+    ride_store.RideStore(path, conf).close()
+    store = ride_store.RideStore(path, read_only=True)
+    assert store.rides() == []
+    store.close()
+
+
+def test_ride_store_time_filters_convert_time_zones(
+        tmp_path, conf, ride_paths):
+    store = ride_store.RideStore(tmp_path / 'rides.sqlite', conf)
+    for key, ride_path in ride_paths.items():
+        store.add(key, key, *ride_store_rows(ride_path, conf))
+    worst = list(store.worst_slices(10_000))
+    middle_ns = sorted(slice_['start_ns'] for slice_ in worst)[len(worst) // 2]
+    naive = analysis.ns_to_datetime(middle_ns)
+    aware = naive.replace(tzinfo=datetime.timezone.utc).astimezone(
+        datetime.timezone(datetime.timedelta(hours=2)))
+    assert aware.hour != naive.hour
+    for since, until in [(naive, None), (None, naive)]:
+        expected = list(store.worst_slices(10_000, since=since, until=until))
+        assert 0 < len(expected) < len(worst)
+        actual = list(store.worst_slices(
+            10_000, since=since and aware, until=until and aware))
+        assert actual == expected
+    assert store.rides(since=aware) == store.rides(since=naive)
+    store.close()
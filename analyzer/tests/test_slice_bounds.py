@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+import analysis
+
+NANOSECONDS_PER_SECOND = analysis.NANOSECONDS_PER_SECOND
+
+
+def baseline_slice_starts(tss, duration_seconds):
+    """The starts of the time slices as computed originally."""
+    slice_duration = round(duration_seconds * NANOSECONDS_PER_SECOND)
+    starts = []
+    closed = True
+    for i, ts in enumerate(tss.tolist()):
+        if closed:
+            starts.append(i)
+            slice_start_ts = ts
+        closed = ts - slice_start_ts >= slice_duration
+    return np.array(starts)
+
+
+@pytest.mark.parametrize('duration_seconds', [20, 5, 0.5, 7.3])
+def test_slice_bounds_match_baseline(write_ride, duration_seconds):
+    path = write_ride(seed=4, duplicate_probability=0.05, gaps=((100, 130),))
+    track = analysis.Track.from_path(path)
+    starts, stops = track.slice_bounds(duration_seconds)
+    expected_starts = baseline_slice_starts(track.tss_ns, duration_seconds)
+    np.testing.assert_array_equal(starts, expected_starts)
+    np.testing.assert_array_equal(
+        stops, np.append(expected_starts[1:], len(track)))
@@ -0,0 +1,88 @@
+import dataclasses as dc
+import io
+
+import numpy as np
+import PIL.Image
+import pytest
+
+import tile_pyramid
+import track_cache
+
+ZOOM_LEVELS = range(12, 15)
+
+
+def build(directory, conf, batches):
+    """Add batches of overlays by key, rendering the tiles after each."""
+    for overlays in batches:
+        pyramid = tile_pyramid.TilePyramid(directory, conf, ZOOM_LEVELS)
+        for key, overlay in overlays.items():
+            pyramid.add(key, key, overlay)
+        pyramid.save()
+        for tile in pyramid.dirty_tiles():
+            tile_pyramid.render_tile(directory, conf, tile)
+            pyramid.mark_rendered(tile)
+        pyramid.save()
+    return {
+        path.relative_to(directory): path.read_bytes()
+        for path in directory.glob('*/*/*.png')}
+
+
+@pytest.fixture
+def overlays(conf, tracks):
+    return {
+        key: tile_pyramid.ride_overlay(track, conf)
+        for key, track in tracks.items()}
+
+
+def test_rendering_rides_draws_their_tiles(tmp_path, conf, overlays):
+    pyramid = tile_pyramid.TilePyramid(tmp_path, conf, ZOOM_LEVELS)
+    num_tiles = pyramid.add('ride-0', 'ride-0', overlays['ride-0'])
+    assert num_tiles == len(pyramid.dirty_tiles())
+    assert {z for z, _, _ in pyramid.dirty_tiles()} == set(ZOOM_LEVELS)
+    assert pyramid.add('ride-0', 'ride-0', overlays['ride-0']) == 0
+    pyramid.save()
+    tile_paths = build(tmp_path, conf, [])
+    assert not tile_paths
+    tile_paths = build(tmp_path, conf, [{}])
+    assert len(tile_paths) == num_tiles
+    alphas = [
+        np.asarray(PIL.Image.open(io.BytesIO(png)))[..., 3]
+        for png in tile_paths.values()]
+    assert all(alpha.shape == (256, 256) for alpha in alphas)
+    assert all(alpha.any() for alpha in alphas)
+    pyramid = tile_pyramid.TilePyramid(tmp_path, conf)
+    assert pyramid.zoom_levels == ZOOM_LEVELS
+    assert pyramid.contains('ride-0') and len(pyramid) == 1
+    assert not pyramid.dirty_tiles()
+
+
+def test_adding_rides_renders_the_same_tiles(tmp_path, conf, overlays):
+    at_once = build(tmp_path / 'a', conf, [overlays])
+    one_by_one = build(tmp_path / 'b', conf, [
+        {key: overlays[key]} for key in sorted(overlays, reverse=True)])
+    assert at_once.keys() == one_by_one.keys()
+    for path, png in at_once.items():
+        assert one_by_one[path] == png, path
+
+
+def test_reopening_with_other_settings_fails(tmp_path, conf, overlays):
+    build(tmp_path, conf, [{'ride-0': overlays['ride-0']}])
+    with pytest.raises(ValueError):
+        tile_pyramid.TilePyramid(tmp_path, conf, range(10, 17))
+    with pytest.raises(ValueError):
+        tile_pyramid.TilePyramid(tmp_path, dc.replace(
+            conf, track_upper_limit_millig=conf.track_upper_limit_millig + 1))
+
+
+def test_failed_adds_leave_no_temporary_files(
+        tmp_path, conf, overlays, monkeypatch):
+    pyramid = tile_pyramid.TilePyramid(tmp_path, conf, ZOOM_LEVELS)
+
+    def savez(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(np, 'savez', savez)
+    with pytest.raises(OSError):
+        pyramid.add('ride-0', 'ride-0', overlays['ride-0'])
+    assert not pyramid.contains('ride-0')
+    assert not list(tmp_path.rglob(f'*{track_cache.TEMPORARY_SUFFIX}'))
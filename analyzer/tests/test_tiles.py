@@ -0,0 +1,47 @@
+import pytest
+
+import tiles
+
+
+def test_directory_store_cache_key_changes_with_tiles(tmp_path):
+    store = tiles.DirectoryStore(str(tmp_path / 'tiles/{z}/{x}/{y}.png'))
+    keys = [store.cache_key]
+    store.put(1, 2, 3, b'tile')
+    keys.append(store.cache_key)
+    # Replaced in a directory that already exists.
+    store.put(1, 2, 3, b'other tile')
+    keys.append(store.cache_key)
+    assert len(set(keys)) == len(keys)
+    assert store.cache_key == keys[-1]
+    assert store.get(1, 2, 3) == b'other tile'
+
+
+def test_prefetch_copies_missing_tiles(tmp_path):
+    source = tiles.DirectoryStore(str(tmp_path / 'source/{z}/{x}/{y}.png'))
+    bounds = (13.3, 52.4, 13.5, 52.6)
+    xs, ys = tiles.tile_range(*bounds, 12)
+    for x in xs:
+        for y in ys:
+            source.put(x, y, 12, f'{x},{y}'.encode())
+    store = tiles.MBTilesStore(tmp_path / 'tiles.mbtiles', writable=True)
+    url_template = f'file://{tmp_path}/source/{{z}}/{{x}}/{{y}}.png'
+    num_tiles = len(xs) * len(ys)
+    assert tiles.prefetch(
+        store, bounds, [12], url_template, download_interval_seconds=0) == (
+            num_tiles, 0, 0)
+    # Tiles at zoom level 11 are missing from the source.
+    xs, ys = tiles.tile_range(*bounds, 11)
+    assert tiles.prefetch(
+        store, bounds, [11, 12], url_template,
+        download_interval_seconds=0) == (0, num_tiles, len(xs) * len(ys))
+    xs, ys = tiles.tile_range(*bounds, 12)
+    assert store.get(xs[0], ys[0], 12) == f'{xs[0]},{ys[0]}'.encode()
+
+
+def test_prefetch_refuses_osm_tile_servers(tmp_path):
+    store = tiles.DirectoryStore(str(tmp_path / '{z}/{x}/{y}.png'))
+    with pytest.raises(ValueError):
+        tiles.prefetch(
+            store, (13.3, 52.4, 13.5, 52.6), [12],
+            'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png')
+    assert not list(tmp_path.iterdir())
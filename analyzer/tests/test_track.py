@@ -0,0 +1,54 @@
+import collections
+
+import numpy as np
+import pytest
+
+import analysis
+
+NANOSECONDS_PER_SECOND = analysis.NANOSECONDS_PER_SECOND
+
+
+def baseline_rolling_averages(tss, accels, window_duration_seconds):
+    """The rolling averages as computed position by position originally."""
+    window_duration = round(window_duration_seconds * NANOSECONDS_PER_SECOND)
+    window = collections.deque()
+    averages = []
+    for ts, accel in zip(tss.tolist(), accels.tolist()):
+        window.append((ts, accel))
+        while window[0][0] < ts - window_duration:
+            window.popleft()
+        averages.append(sum(abs(a) for _, a in window) / len(window))
+    return np.array(averages)
+
+
+def test_duplicate_records_are_dropped(write_ride):
+    track = analysis.Track.from_path(
+        write_ride('duplicates.fit', seed=2, duplicate_probability=0.05))
+    expected = analysis.Track.from_path(write_ride('plain.fit', seed=2))
+    assert np.all(np.diff(track.tss_ns) > 0)
+    for name in ('tss_ns', 'lons', 'lats', 'speeds', 'accels'):
+        np.testing.assert_array_equal(
+            getattr(track, name), getattr(expected, name), err_msg=name)
+
+
+def test_positions_are_ordered_by_timestamp():
+    track = analysis.Track(
+        [3, 1, 2, 1], [0, 1, 2, 3], [0, 0, 0, 0], [1, 1, 1, 1], [5, 6, 7, 8])
+    np.testing.assert_array_equal(track.tss_ns, [1, 2, 3])
+    # Of equal timestamps, the first is kept.
+    np.testing.assert_array_equal(track.lons, [1, 2, 0])
+    np.testing.assert_array_equal(track.accels, [6, 7, 5])
+
+
+@pytest.mark.parametrize('window_duration_seconds', [10, 3, 0.5])
+def test_rolling_averages_match_baseline(
+        write_ride, window_duration_seconds):
+    path = write_ride(
+        seed=3, duplicate_probability=0.05, saturation_probability=0.001,
+        gaps=((100, 130),))
+    track = analysis.Track.from_path(path)
+    expected = baseline_rolling_averages(
+        track.tss_ns, track.accels, window_duration_seconds)
+    np.testing.assert_allclose(
+        track.rolling_average_absolute_accels(window_duration_seconds, None),
+        expected, rtol=1e-9)
@@ -0,0 +1,72 @@
+import json
+import os
+import time
+
+import numpy as np
+
+import analysis
+import track_cache
+
+
+def test_eviction_bounds_size_and_prunes_index(tmp_path, write_ride):
+    paths = [write_ride(f'ride-{seed}.fit', seed=seed) for seed in range(4)]
+    directory = tmp_path / 'cache'
+    cache = track_cache.TrackCache(
+        directory, analysis.Track.CACHE_VERSION, 1 << 30)
+    analysis.Track.from_path(paths[0], cache=cache)
+    # Rides of the same duration make entries of about the same size.
+    entry_size = next(directory.glob('*.npz')).stat().st_size
+    max_size = int(entry_size * 2.5)
+    cache = track_cache.TrackCache(
+        directory, analysis.Track.CACHE_VERSION, max_size)
+    for path in paths:
+        analysis.Track.from_path(path, cache=cache)
+    entries = list(directory.glob('*.npz'))
+    assert len(entries) == 2
+    assert sum(entry.stat().st_size for entry in entries) <= max_size
+    with open(directory / track_cache.TrackCache.INDEX_FILE_NAME) as file:
+        index = json.load(file)
+    assert sorted(index) == sorted(str(path.resolve()) for path in paths[2:])
+    for path in paths[2:]:
+        assert cache.load(path) is not None
+
+
+def test_failing_cache_doesnt_fail_parsing(tmp_path, write_ride):
+    path = write_ride()
+    # A file where the cache directory should be makes every write fail.
+    not_a_directory = tmp_path / 'cache'
+    not_a_directory.write_bytes(b'')
+    cache = track_cache.TrackCache(
+        not_a_directory, analysis.Track.CACHE_VERSION, 1 << 30)
+    track = analysis.Track.from_path(path, cache=cache)
+    np.testing.assert_array_equal(
+        track.accels, analysis.Track.from_path(path).accels)
+
+
+def test_failed_writes_leave_no_temporary_files(
+        tmp_path, write_ride, monkeypatch):
+    path = write_ride()
+    directory = tmp_path / 'cache'
+    cache = track_cache.TrackCache(
+        directory, analysis.Track.CACHE_VERSION, 1 << 30)
+
+    def savez(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(np, 'savez', savez)
+    analysis.Track.from_path(path, cache=cache)
+    assert list(directory.iterdir()) == [
+        directory / track_cache.TrackCache.INDEX_FILE_NAME]
+
+
+def test_opening_removes_stale_temporary_files(tmp_path):
+    stale = tmp_path / f'stale{track_cache.TEMPORARY_SUFFIX}'
+    recent = tmp_path / f'recent{track_cache.TEMPORARY_SUFFIX}'
+    stale.write_bytes(b'')
+    recent.write_bytes(b'')
+    old = time.time() - track_cache.STALE_TEMPORARY_FILE_AGE_SECONDS - 60
+    os.utime(stale, (old, old))
+    track_cache.ArrayCache(tmp_path, 'v1', 1 << 30)
+    assert not stale.exists()
+    # It may still be written by another process.
+    assert recent.exists()
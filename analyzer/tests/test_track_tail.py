@@ -0,0 +1,69 @@
+import numpy as np
+
+import analysis
+
+
+def test_track_tail_matches_full_parse(write_ride, tmp_path, conf, ride_spec):
+    path = write_ride(seed=5, **ride_spec)
+    data = path.read_bytes()
+    windows = [conf.rolling_average_window_duration_seconds, 0.5]
+    durations = [conf.track_time_slice_seconds, 7.3]
+    attenuators = [None, conf.attenuator]
+
+    def analyze(track):
+        for window in windows:
+            track.rolling_average_absolute_accels_for_all(window, attenuators)
+        for duration in durations:
+            track.slice_bounds(duration)
+
+    growing_path = tmp_path / 'growing.fit'
+    growing_path.write_bytes(b'')
+    tail = analysis.TrackTail(growing_path)
+    rng = np.random.default_rng(0)
+    size = 0
+    while size < len(data):
+        size = min(len(data), size + int(rng.integers(1, 20_000)))
+        growing_path.write_bytes(data[:size])
+        # Analysis is extended on each update, rather than done once.
+        analyze(tail.update())
+    track = tail.track
+    expected = analysis.Track.from_path(path)
+    analyze(expected)
+    for name in ('tss_ns', 'lons', 'lats', 'speeds', 'accels'):
+        np.testing.assert_array_equal(
+            getattr(track, name), getattr(expected, name), err_msg=name)
+    for window in windows:
+        np.testing.assert_allclose(
+            track.rolling_average_absolute_accels_for_all(
+                window, attenuators),
+            expected.rolling_average_absolute_accels_for_all(
+                window, attenuators), rtol=1e-9)
+    for duration in durations:
+        for bounds, expected_bounds in zip(
+                track.slice_bounds(duration),
+                expected.slice_bounds(duration)):
+            np.testing.assert_array_equal(bounds, expected_bounds)
+
+
+def test_track_tail_updates_dont_process_the_whole_track(
+        write_ride, tmp_path, monkeypatch):
+    data = write_ride(seed=6).read_bytes()
+    checked_lengths = []
+    monotonic_indices = analysis.Track._monotonic_indices
+
+    def checking_monotonic_indices(tss):
+        checked_lengths.append(len(tss))
+        return monotonic_indices(tss)
+
+    monkeypatch.setattr(
+        analysis.Track, '_monotonic_indices',
+        staticmethod(checking_monotonic_indices))
+    growing_path = tmp_path / 'growing.fit'
+    growing_path.write_bytes(b'')
+    tail = analysis.TrackTail(growing_path)
+    chunk_size = len(data) // 20
+    for size in range(chunk_size, len(data) + chunk_size, chunk_size):
+        growing_path.write_bytes(data[:size])
+        tail.update()
+    # Only the appended positions are checked for their order.
+    assert len(tail.track) > 10 * max(checked_lengths)
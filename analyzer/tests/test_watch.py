@@ -0,0 +1,90 @@
+import concurrent.futures
+import concurrent.futures.process
+import os
+
+import watch
+
+
+class FakeExecutor(concurrent.futures.Executor):
+    """Runs submitted calls at once, or breaks like a dead process pool."""
+
+    def __init__(self, broken=False):
+        self.broken = broken
+
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        if self.broken:
+            future.set_exception(
+                concurrent.futures.process.BrokenProcessPool())
+            return future
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def make_watcher(directory, process, executors):
+    return watch.FolderWatcher(
+        directory, process, lambda: executors.pop(0), 2, settle_seconds=0,
+        poll_interval_seconds=0)
+
+
+def run(watcher, num_polls=3):
+    for _ in range(num_polls):
+        watcher.poll()
+        watcher.wait(0)
+
+
+def test_failed_files_are_retried_once_they_change(tmp_path):
+    path = tmp_path / 'ride.fit'
+    path.write_bytes(b'partial')
+    processed = []
+
+    def process(path):
+        processed.append(path.read_bytes())
+        if path.read_bytes() == b'partial':
+            raise ValueError('Truncated file')
+        return []
+
+    watcher = make_watcher(tmp_path, process, [FakeExecutor()])
+    run(watcher)
+    assert processed == [b'partial']
+    path.write_bytes(b'complete')
+    run(watcher)
+    assert processed == [b'partial', b'complete']
+    assert watcher.manifest.is_processed(
+        path.name, (path.stat().st_size, path.stat().st_mtime_ns))
+    run(make_watcher(tmp_path, process, [FakeExecutor()]))
+    assert len(processed) == 2
+
+
+def test_failed_files_are_retried_after_a_restart(tmp_path):
+    path = tmp_path / 'ride.fit'
+    path.write_bytes(b'')
+    failures = [ValueError('Out of disk space')]
+
+    def process(path):
+        if failures:
+            raise failures.pop()
+        return []
+
+    run(make_watcher(tmp_path, process, [FakeExecutor()]))
+    assert not failures
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    watcher = make_watcher(tmp_path, process, [FakeExecutor()])
+    assert not watcher.manifest.is_processed(path.name, signature)
+    run(watcher)
+    assert watcher.manifest.is_processed(path.name, signature)
+
+
+def test_broken_pools_are_replaced(tmp_path):
+    path = tmp_path / 'ride.fit'
+    path.write_bytes(b'')
+    executors = [FakeExecutor(broken=True), FakeExecutor()]
+    watcher = make_watcher(tmp_path, lambda path: [], executors)
+    run(watcher)
+    assert not executors
+    assert watcher.manifest.is_processed(
+        path.name, (path.stat().st_size, path.stat().st_mtime_ns))